@@ -0,0 +1,273 @@
+"""Health Checks
+
+Background health checking of the servers listed in the load balancer's
+config.json. Every server is probed at a fixed interval, all servers at the
+same time, and the list of available servers is updated without blocking the
+balancer's accept loop. config.json is reloaded whenever it changes.
+
+"""
+
+import json
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import http, metrics
+
+EWMA_ALPHA = 0.3  # weight of the latest probe in the average response time
+DEFAULT_SETTINGS = {
+    "interval": 5.0,  # seconds between rounds of probes
+    "timeout": 2.0,  # seconds before a probe counts as failed
+    "rise": 2,  # consecutive successes before a down server is marked up
+    "fall": 3,  # consecutive failures before an up server is marked down
+    "path": "/health"  # file requested by each probe
+}
+
+probe_duration = metrics.histogram(
+    "balancer_probe_duration_seconds",
+    "Time taken by successful health check probes, by backend", ["backend"])
+probe_failures = metrics.counter(
+    "balancer_probe_failures_total", "Failed health check probes, by backend",
+    ["backend"])
+backend_up = metrics.gauge(
+    "balancer_backend_up", "Whether a backend is available (1) or not (0)",
+    ["backend"])
+
+
+def probe(server, path, timeout):
+    """Sends one health check request to a server.
+
+    Args:
+        server: Server (dictionary with 'host' and 'port')
+        path: Path of the file to request
+        timeout: Seconds before the probe counts as failed
+
+    Returns:
+        Time taken (in ns) to receive the whole response, or None if the
+        server could not be reached or did not answer with 200 OK.
+    """
+    t_start = time.time_ns()
+    try:
+        with socket.create_connection(
+                (server['host'], server['port']), timeout=timeout) as sock:
+            req = f"""GET {path} HTTP/1.1\r
+Host: {server['host']}:{server['port']}\r
+Connection: close\r
+\r
+"""
+            sock.sendall(req.encode())
+            response, buffer = http.recv_response(sock)
+            if response is None or response.status_code != 200:
+                return None
+            # Read the rest of the response, so the time includes the transfer
+            http.recv_body(sock, buffer, http.get_body_length(
+                "GET", response.status_code, response.headers),
+                lambda data: None)
+    except (OSError, ValueError):
+        return None
+    return time.time_ns() - t_start
+
+
+class HealthChecker:
+    """Keeps track of which servers in config.json are available.
+
+    A server's first probe decides whether it starts out up or down. After
+    that, it takes `rise` consecutive successful probes to bring a server
+    back up and `fall` consecutive failed probes to take it down. Each server
+    records the time taken by its last successful probe ('time') and an
+    exponentially weighted moving average of it ('ewma').
+
+    The settings are read from the optional "health_check" object in
+    config.json, see DEFAULT_SETTINGS.
+
+    Attributes:
+        config_file: Path to config.json
+        config: Contents of config.json, as last loaded
+        settings: Current health check settings
+    """
+
+    def __init__(self, config_file):
+        """
+        Args:
+            config_file: Path to config.json
+        """
+        self.config_file = config_file
+        self.config = {}
+        self.settings = dict(DEFAULT_SETTINGS)
+        self._servers = []
+        self._available = []
+        self._config_mtime = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def available(self):
+        """Returns the servers that are currently up.
+
+        Returns:
+            List of servers, sorted by the time taken by their last probe in
+            descending order (the slowest server first)
+        """
+        return self._available
+
+    def reload(self):
+        """Reloads config.json if it has changed since it was last read.
+
+        Servers keep their health state across reloads as long as their host
+        and port stay the same. If the file cannot be read, the current
+        configuration is kept.
+
+        Returns:
+            True if the configuration was reloaded
+        """
+        try:
+            mtime = os.stat(self.config_file).st_mtime
+            if mtime == self._config_mtime:
+                return False
+            with open(self.config_file) as f:
+                config = json.load(f)
+            servers = config['servers']
+        except (OSError, ValueError, KeyError) as err:
+            print(f"Could not load {self.config_file}: {err}")
+            return False
+
+        with self._lock:
+            current = {(s['host'], s['port']): s for s in self._servers}
+            self._servers = []
+            for server in servers:
+                if not isinstance(server, dict) or not (
+                        {'host', 'port'} <= server.keys()):
+                    print(f"Skipping server without host and port: "
+                          f"{server!r}")
+                    continue
+                old = current.get((server['host'], server['port']))
+                if old is not None:
+                    old.update(server)
+                    self._servers.append(old)
+                else:
+                    self._servers.append(dict(
+                        server, isAvailable=None, time=0, ewma=0, successes=0,
+                        failures=0))
+            self.settings = dict(
+                DEFAULT_SETTINGS, **config.get('health_check', {}))
+            self.config = config
+            self._config_mtime = mtime
+            self._update_available()
+        print(f"Loaded {len(self._servers)} servers from {self.config_file}")
+        return True
+
+    def check(self):
+        """Probes every server once, all at the same time.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            servers = list(self._servers)
+            path = self.settings['path']
+            timeout = self.settings['timeout']
+            rise = self.settings['rise']
+            fall = self.settings['fall']
+        if not servers:
+            return
+        with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            results = list(executor.map(
+                lambda server: probe(server, path, timeout), servers))
+
+        with self._lock:
+            for server, t in zip(servers, results):
+                try:
+                    backend = (f"{server['host']}:{server['port']}",)
+                    if t is not None:
+                        probe_duration.observe(t / 1e9, labels=backend)
+                        server['time'] = t
+                        if server['ewma']:
+                            server['ewma'] += EWMA_ALPHA * (t - server['ewma'])
+                        else:
+                            server['ewma'] = t
+                        server['successes'] += 1
+                        server['failures'] = 0
+                    else:
+                        probe_failures.inc(labels=backend)
+                        server['failures'] += 1
+                        server['successes'] = 0
+                    was_available = server['isAvailable']
+                    if was_available is None:
+                        server['isAvailable'] = t is not None
+                    elif not was_available and server['successes'] >= rise:
+                        server['isAvailable'] = True
+                    elif was_available and server['failures'] >= fall:
+                        server['isAvailable'] = False
+                    self._note_state(server, was_available)
+                except (KeyError, TypeError) as err:
+                    # A malformed entry in config.json must not stop the
+                    # checks of the other servers
+                    print(f"Could not check server {server!r}: {err!r}")
+            self._update_available()
+
+    def report_failure(self, server, elapsed):
+        """Records a request that a server failed to answer in time.
+
+        The failure counts towards `fall` like a failed probe, and the time
+        waited is folded into the server's average response time, so that
+        latency-aware strategies move away from a server that hangs before
+        the next round of probes.
+
+        Args:
+            server: Server the request was sent to
+            elapsed: Time waited (in ns) before giving up on the server
+
+        Returns:
+            None
+        """
+        with self._lock:
+            server['failures'] += 1
+            server['successes'] = 0
+            if server['ewma']:
+                server['ewma'] += EWMA_ALPHA * (elapsed - server['ewma'])
+            else:
+                server['ewma'] = elapsed
+            was_available = server['isAvailable']
+            if was_available and server['failures'] >= self.settings['fall']:
+                server['isAvailable'] = False
+                self._note_state(server, was_available)
+                self._update_available()
+
+    def run(self):
+        """Reloads config.json and probes every server, forever.
+
+        Returns:
+            None
+        """
+        while True:
+            self.reload()
+            self.check()
+            time.sleep(self.settings['interval'])
+
+    def start(self):
+        """Runs the first round of probes, then keeps checking on a thread.
+
+        Returns:
+            None
+        """
+        self.check()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def _note_state(self, server, was_available):
+        # Reports a server going up or down (lock held)
+        backend = f"{server['host']}:{server['port']}"
+        if server['isAvailable'] != was_available:
+            state = "up" if server['isAvailable'] else "down"
+            print(f"Server {server.get('id', backend)} ({backend}) is "
+                  f"{state}")
+        backend_up.set(int(server['isAvailable']), labels=(backend,))
+
+    def _update_available(self):
+        # Replace the list rather than changing it, so that readers never see
+        # it half updated
+        self._available = sorted(
+            (server for server in self._servers if server['isAvailable']),
+            key=lambda k: k['time'],
+            reverse=True
+        )
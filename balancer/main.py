@@ -1,126 +1,485 @@
+import os
 import socket
-import json
-import random
+import sys
+import threading
 import time
 
+# Make the shared modules in common/ importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common import accesslog, http, metrics  # noqa: E402
+from common.pool import ConnectionPool  # noqa: E402
+from health import HealthChecker  # noqa: E402
+from strategies import DEFAULT_STRATEGY, create_strategy  # noqa: E402
+
 HOST = 'localhost'
 PORT = 8500
 BUFFER_SIZE = 1024
-TIMEOUT_LEN = 10.0  # seconds
+KEEP_ALIVE_TIMEOUT = 15.0  # seconds
+CONFIG_FILE = './config.json'
+DEFAULT_MODE = 'proxy'  # or 'redirect'
+POOL_SIZE = 8  # idle connections per server
+POOL_IDLE_TIMEOUT = 10.0  # seconds, shorter than the server's keep-alive
+CONNECT_TIMEOUT = 2.0  # seconds
+BACKEND_TIMEOUT = 30.0  # seconds to wait on a server before giving up on it
+METRICS_PORT = 8501  # port the metrics are served on (`/metrics`), 0 for none
+# Hop-by-hop header fields, which are not forwarded
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-connection", "te",
+              "trailer", "upgrade"}
+
+# Health checks of the servers in config.json, created by main()
+checker = None
+# Persistent connections to the servers, created by main()
+connection_pool = None
+# Strategy currently used to choose servers, see get_strategy()
+strategy_name = None
+strategy = None
+strategy_lock = threading.Lock()
+# Log of every request answered, opened by main() if enabled
+access_log = None
+# Response sent to the client on the current thread, see note_response()
+exchange = threading.local()
+
+requests_total = metrics.counter(
+    "balancer_requests_total", "Requests answered, by status code", ["code"])
+request_duration = metrics.histogram(
+    "balancer_request_duration_seconds", "Time taken to answer a request")
+response_bytes = metrics.counter(
+    "balancer_response_bytes_total", "Bytes of response bodies sent")
+active_connections = metrics.gauge(
+    "balancer_connections_active", "Client connections currently open")
+backend_selections = metrics.counter(
+    "balancer_backend_selections_total",
+    "Times a backend was chosen for a request, by backend", ["backend"])
+
+
+def strip_hop_by_hop(fields):
+    """Removes the header fields that only apply to a single connection.
+
+    Args:
+        fields: List of (name, value) tuples, see http.split_header()
+
+    Returns:
+        List of (name, value) tuples to forward
+    """
+    return [(name, value) for name, value in fields
+            if name.lower() not in HOP_BY_HOP]
+
+
+def build_header(start_line, fields):
+    """Builds a request or response header to forward.
+
+    Args:
+        start_line: Request or status line
+        fields: List of (name, value) tuples
+
+    Returns:
+        Header (bytes), including the terminating empty line
+    """
+    return http.encode(start_line + "\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in fields) + "\r\n")
+
+
+def send_response(client_socket, status, fields, body_file):
+    """Sends a response and closes the sending side of the connection.
+
+    Args:
+        client_socket: Client socket instance
+        status: Status code and reason phrase, e.g. "200 OK"
+        fields: Dictionary of header field names to values
+        body_file: Path of file to send as body, or None for no body
+
+    Returns:
+        None
+    """
+    length = os.stat(body_file).st_size if body_file is not None else 0
+    fields = dict(fields, **{
+        "Content-Length": length,
+        "Content-Type": "text/html",
+        "Connection": "close"
+    })
+    response_header = f"HTTP/1.1 {status}\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in fields.items()) + "\r\n"
+    client_socket.send(response_header.encode())
+    note_response(int(status[:3]), length)
+    if body_file is not None:
+        with open(body_file, 'rb') as f:
+            data = f.read(BUFFER_SIZE)
+            while data:
+                client_socket.send(data)
+                data = f.read(BUFFER_SIZE)
+    client_socket.shutdown(socket.SHUT_WR)
+
+
+def note_response(status_code, length):
+    """Notes the response being sent for the request of the current thread.
+
+    Called wherever a response header is sent to the client, so that
+    record_request() can account for it.
+
+    Args:
+        status_code: Status code of the response (int)
+        length: Length of the response body in bytes, or None if unknown
+
+    Returns:
+        None
+    """
+    exchange.status_code = status_code
+    exchange.length = length
+
+
+def select_server(selected, server_list, target):
+    """Chooses the server to send the request of the current thread to.
+
+    Args:
+        selected: Strategy to choose with, see get_strategy()
+        server_list: Available servers
+        target: Target of the request, e.g. "/index.html"
+
+    Returns:
+        Chosen server, which must be released with selected.release()
+    """
+    server = selected.select(server_list, target)
+    exchange.backend = f"{server['host']}:{server['port']}"
+    backend_selections.inc(labels=(exchange.backend,))
+    return server
+
+
+def record_request(client, request, started):
+    """Updates the metrics and the access log once a request is answered.
+
+    Args:
+        client: Address of the client ("<host>:<port>")
+        request: Request header (without the terminating empty line)
+        started: time.perf_counter() when the request was received
+
+    Returns:
+        None
+    """
+    status_code = exchange.status_code
+    if status_code is None:
+        return
+    duration = time.perf_counter() - started
+    length = exchange.length or 0
+    if status_code == 304:
+        length = 0
+    requests_total.inc(labels=(str(status_code),))
+    request_duration.observe(duration)
+    response_bytes.inc(length)
+    if access_log is not None:
+        request_line, _ = http.split_header(request)
+        method, path = (request_line.split(' ') + [None])[:2]
+        access_log.log(
+            client=client,
+            method=method,
+            path=path,
+            status=status_code,
+            bytes=length,
+            backend=exchange.backend,
+            duration_ms=round(duration * 1000, 3)
+        )
+
+
+def get_strategy():
+    """Returns the strategy set in config.json.
 
+    A new strategy is created whenever the setting changes.
+
+    Returns:
+        Strategy
+    """
+    global strategy_name, strategy
+    name = checker.config.get('strategy', DEFAULT_STRATEGY)
+    with strategy_lock:
+        if name != strategy_name:
+            strategy_name = name
+            try:
+                strategy = create_strategy(name)
+            except ValueError as err:
+                print(f"{err}, using {DEFAULT_STRATEGY!r}")
+                strategy = create_strategy(DEFAULT_STRATEGY)
+        return strategy
 
-def performance_test(server_list):
-    """Runs performance test on all provided servers.
+
+def send_upstream(server, request):
+    """Sends a request to a server and reads the response header.
+
+    A pooled connection to the server is used if there is one. If the server
+    turns out to have closed it already, the request is sent again on a new
+    connection.
 
     Args:
-        server_list: List of servers
+        server: Server
+        request: Request (bytes), including the terminating empty line and
+            any body
 
     Returns:
-        List of available servers, sorted by speed of processing requests in
-        descending order (where is the first element takes the most amount of
-        time)
+        Tuple of (server socket, http.Response, body bytes already received)
+
+    Raises:
+        OSError: If the server could not be reached, did not answer within
+            BACKEND_TIMEOUT (socket.timeout) or sent an invalid response.
     """
-    for server in server_list:
+    host, port = server['host'], server['port']
+    while True:
+        server_socket, reused = connection_pool.acquire(host, port)
         try:
-            t_start = time.time_ns()
-            # Connect to server
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((server['host'], server['port']))
-        except ConnectionRefusedError:
-            server['isAvailable'] = False
-        else:
-            server['isAvailable'] = True
-            print(f"Running performance test on Server {server['id']}...")
-
-            req = f"""GET /test.jpg HTTP/1.1\r
-Host: {server['host']}:{server['port']}\r
-\r"""
-            server_socket.send(req.encode())
-
-            while True:
-                res = server_socket.recv(BUFFER_SIZE).decode()
-                print(res)
-                data = server_socket.recv(BUFFER_SIZE)
-                while data:
-                    data = server_socket.recv(BUFFER_SIZE)
-                if res:
-                    break
-            server['time'] = time.time_ns() - t_start
-            print(f"Complete. ({server['time']} ns)\n")
+            server_socket.sendall(request)
+            response, buffer = http.recv_response(server_socket)
+        except socket.timeout:
+            # The server is there but not answering, so do not wait on it
+            # again on a new connection
             server_socket.close()
-    # Remove unavailable servers
-    server_list = [server for server in servers if server['isAvailable']]
-    # Sort by time descending
-    return sorted(server_list, key=lambda k: k['time'], reverse=True)
+            raise
+        except OSError:
+            server_socket.close()
+            if not reused:
+                raise
+            continue
+        except ValueError as err:
+            server_socket.close()
+            raise ConnectionError(f"Invalid response from server: {err}")
+        if response is not None:
+            return server_socket, response, buffer
+        server_socket.close()
+        if not reused:
+            raise ConnectionError("Server closed the connection")
+
+
+def redirect_request(client_socket, request):
+    """Redirects a client to one of the available servers.
+
+    Args:
+        client_socket: Client socket instance
+        request: Request header (without the terminating empty line)
+
+    Returns:
+        None
+    """
+    server_list = checker.available()
+    if not server_list:
+        send_response(client_socket, "503 Service Unavailable", {},
+                      'files/503.html')
+        return
+    request_line, _ = http.split_header(request)
+    _, target, _ = http.parse_request_line(request_line)
+    file = target.lstrip('/')
+    selected = get_strategy()
+    server = select_server(selected, server_list, target)
+    try:
+        send_response(client_socket, "301 Moved Permanently", {
+            "Location": f"{server['host']}:{server['port']}/{file}"
+        }, 'files/301.html')
+    finally:
+        selected.release(server)
+
+
+def proxy_request(client_socket, request, buffer):
+    """Forwards a request to one of the available servers.
+
+    The response is streamed back to the client as it arrives. If the chosen
+    server cannot be reached or does not answer within BACKEND_TIMEOUT, a GET
+    or HEAD request is tried once more on another server (the one that failed
+    is left out of the choice). A server that times out is also reported to
+    the health checker, see `HealthChecker.report_failure`.
+
+    Args:
+        client_socket: Client socket instance
+        request: Request header (without the terminating empty line)
+        buffer: Bytes received from the client past the end of the header
+
+    Returns:
+        Tuple of (whether the client connection can be kept open, bytes
+        received from the client past the end of the request)
+    """
+    start_line, fields = http.split_header(request)
+    headers = http.get_headers(fields)
+    try:
+        method, target, protocol = http.parse_request_line(start_line)
+        length = int(headers.get("content-length", 0))
+        if length < 0:
+            raise ValueError(f"invalid Content-Length: {length}")
+    except ValueError:
+        send_response(client_socket, "400 Bad Request", {}, None)
+        return False, b""
+    body = []
+    buffer = http.recv_body(client_socket, buffer, length, body.append)
+    upstream_request = build_header(
+        start_line, strip_hop_by_hop(fields)) + b"".join(body)
+    keep_alive = (
+        protocol == "HTTP/1.1"
+        and headers.get("connection", "").lower() != "close"
+    )
+
+    attempts = 2 if method in ("GET", "HEAD") else 1
+    failed = None
+    for _ in range(attempts):
+        server_list = checker.available()
+        if failed is not None and len(server_list) > 1:
+            server_list = [s for s in server_list if s is not failed]
+        if not server_list:
+            send_response(client_socket, "503 Service Unavailable", {},
+                          'files/503.html')
+            return False, b""
+        selected = get_strategy()
+        server = select_server(selected, server_list, target)
+        try:
+            sent_at = time.monotonic_ns()
+            try:
+                server_socket, response, upstream_buffer = send_upstream(
+                    server, upstream_request)
+            except OSError as err:
+                if isinstance(err, socket.timeout):
+                    checker.report_failure(
+                        server, time.monotonic_ns() - sent_at)
+                failed = server
+                continue
+            response_headers = response.headers
+            status_line, response_fields = http.split_header(response.header)
+            response_length = http.get_body_length(
+                method, response.status_code, response_headers)
+            keep_alive &= response_length is not None
+            response_fields = strip_hop_by_hop(response_fields)
+            if not keep_alive:
+                response_fields.append(("Connection", "close"))
+            note_response(response.status_code, response_length)
+            # The header goes out together with the first part of the body,
+            # as a separate small send would wait for the client's (delayed)
+            # ACK before the body could follow
+            pending = build_header(status_line, response_fields)
+
+            def send(data):
+                nonlocal pending
+                client_socket.sendall(pending + data)
+                pending = b""
+            try:
+                leftover = http.recv_body(server_socket, upstream_buffer,
+                                          response_length, send)
+                if pending:
+                    client_socket.sendall(pending)
+            except OSError:
+                server_socket.close()
+                raise
+            connection_pool.release(
+                server['host'], server['port'], server_socket,
+                reusable=(
+                    response_length is not None
+                    and not leftover
+                    and response_headers.get("connection", "").lower()
+                    != "close"
+                )
+            )
+            return keep_alive, buffer
+        finally:
+            selected.release(server)
+    send_response(client_socket, "502 Bad Gateway", {}, 'files/502.html')
+    return False, b""
 
 
-def select_server(server_list):
-    """Chooses a server based off performance test.
+def handle_client(client_socket):
+    """Serves a single client connection.
 
-    The server_list array is sorted from slowest to fastest, where the slowest
-    server is at index 0. Servers with greater indices will receive an
-    increasingly greater chance of being selected. The number of 'tickets' the
-    server will have in the lottery system will be equal to its index position
-    in server_list + 1. For example, server at position 0 will receive (0 + 1)
-    tickets, server at position 5 will receive (5 + 1) tickets. A random number
-    will be chosen between (0, len(lottery)).
+    Runs on its own thread. In proxy mode, the connection is kept alive and
+    requests are answered in the order they arrive until the client closes
+    it, asks for `Connection: close`, or stays idle for longer than
+    KEEP_ALIVE_TIMEOUT. In redirect mode, the connection is closed after the
+    redirect.
 
     Args:
-        server_list: List of servers (sorted by performance)
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    with client_socket:
+        client_socket.settimeout(KEEP_ALIVE_TIMEOUT)
+        buffer = b""
+        keep_alive = True
+        active_connections.inc()
+        try:
+            client = "%s:%d" % client_socket.getpeername()[:2]
+            while keep_alive:
+                request, buffer = http.recv_header(client_socket, buffer)
+                if request is None:
+                    break
+                started = time.perf_counter()
+                exchange.status_code = None
+                exchange.backend = None
+                if checker.config.get('mode', DEFAULT_MODE) == 'redirect':
+                    redirect_request(client_socket, request)
+                    record_request(client, request, started)
+                    break
+                keep_alive, buffer = proxy_request(
+                    client_socket, request, buffer)
+                record_request(client, request, started)
+        except (OSError, ValueError, IndexError):
+            pass
+        finally:
+            active_connections.dec()
+
+
+def reap_connections():
+    """Periodically closes pooled connections that have been idle too long.
 
     Returns:
-        Server
+        None
     """
-    lottery = []
-    n = 1
-    for server in server_list:
-        lottery += [server] * n
-        n += 1
-    i = random.randint(0, len(lottery) - 1)
-    return lottery[i]
+    while True:
+        time.sleep(connection_pool.idle_timeout)
+        connection_pool.reap()
+
+
+def main(config_file):
+    """Main function of the script.
+
+    Health checks run on a background thread (see `HealthChecker`), which
+    keeps the list of available servers up to date and reloads config.json
+    whenever it changes. Each request is sent to one of the servers available
+    at the time it arrives, chosen by the strategy set in config.json (see
+    `strategies`), or answered with 503 if there are none.
+
+    The "mode" setting in config.json decides how requests are sent to the
+    chosen server:
+        proxy       The request is forwarded to the server over a pooled
+                    connection and the response is streamed back (default)
+        redirect    The client is redirected to the server with a 301
 
+    The metrics of the balancer are served on the port set by "metrics_port"
+    in config.json (METRICS_PORT by default, 0 for none), and every request is
+    logged to the file set by "access_log" ("-" for standard output), if any.
+    Both are only read at startup.
 
-def main(server_list):
+    Args:
+        config_file: Path to config.json
+
+    Returns:
+        None
+    """
+    global checker, connection_pool, access_log
+    checker = HealthChecker(config_file)
+    checker.start()
+    if checker.config.get('access_log') is not None:
+        access_log = accesslog.AccessLog(checker.config['access_log'])
+    metrics_port = checker.config.get('metrics_port', METRICS_PORT)
+    if metrics_port:
+        metrics.start(HOST, metrics_port)
+        print(f"""Metrics served on port {metrics_port}...""")
+    connection_pool = ConnectionPool(
+        POOL_SIZE, POOL_IDLE_TIMEOUT, CONNECT_TIMEOUT, BACKEND_TIMEOUT)
+    threading.Thread(target=reap_connections, daemon=True).start()
     balancer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    balancer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     balancer_socket.bind((HOST, PORT))
-    balancer_socket.listen(1)
+    balancer_socket.listen(socket.SOMAXCONN)
     print(f"""Load balancer listening on port {PORT}...\n""")
-    server_list = performance_test(server_list)
-    balancer_socket.settimeout(TIMEOUT_LEN)
 
     while True:
-        try:
-            # Connect to client
-            client_socket, client_address = balancer_socket.accept()
-            request = client_socket.recv(BUFFER_SIZE).decode()
-            if request:
-                # Cancel timeout
-                balancer_socket.settimeout(None)
-                # Choose a server based on performance test
-                server = select_server(server_list)
-                req_info, server_info, _ = request.split('\n')
-                file = req_info.split(' ')[1].lstrip('/')
-                server_host = server['host']
-                server_port = server['port']
-                response_header = f"""HTTP/1.1 301 Moved Permanently\r
-Location: {server_host}:{server_port}/{file}\r
-\r"""
-                client_socket.send(response_header.encode())
-                with open('files/301.html', 'rb') as f:
-                    data = f.read(BUFFER_SIZE)
-                    while data:
-                        client_socket.send(data)
-                        data = f.read(BUFFER_SIZE)
-                client_socket.shutdown(socket.SHUT_WR)
-                # Restart timeout
-                balancer_socket.settimeout(TIMEOUT_LEN)
-        except socket.timeout:
-            # Run performance test
-            server_list = performance_test(server_list)
+        # Connect to client
+        client_socket, client_address = balancer_socket.accept()
+        threading.Thread(
+            target=handle_client, args=(client_socket,), daemon=True
+        ).start()
 
 
 if __name__ == '__main__':
-    with open('./config.json') as f:
-        data = json.load(f)
-        servers = data['servers']
-    main(servers)
+    main(CONFIG_FILE)
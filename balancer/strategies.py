@@ -0,0 +1,358 @@
+"""Selection Strategies
+
+Ways of choosing which available server a request is sent to. A strategy is
+chosen with the "strategy" setting in config.json:
+
+    random              Random, weighted by response time (alias method)
+    round_robin         Smooth weighted round-robin, weighted by response time
+    p2c                 Power of two choices over EWMA response time
+    least_outstanding   Fewest requests in progress
+    consistent_hash     Same server for the same path, with bounded load
+
+Weights are inversely proportional to each server's EWMA response time, as
+measured by the health checks, so a server twice as fast receives twice as
+many requests. consistent_hash instead uses the "weight" of each server in
+config.json (1 by default), as its aim is to keep sending each path to the
+same server, so that its cache stays warm.
+
+"""
+
+import bisect
+import hashlib
+import math
+import random
+import threading
+from abc import ABC, abstractmethod
+
+DEFAULT_STRATEGY = "random"
+VIRTUAL_NODES = 100  # points on the hash ring per unit of weight
+# A server takes no more than this many times its weighted share of the
+# requests in progress before requests for its paths overflow to the next
+# server on the ring
+LOAD_FACTOR = 1.25
+
+
+def get_weight(server):
+    """Returns the weight of a server, inversely proportional to its latency.
+
+    Args:
+        server: Server
+
+    Returns:
+        Weight (a positive number)
+    """
+    return 1 / max(server.get('ewma', 0), 1)
+
+
+def get_config_weight(server):
+    """Returns the weight set for a server in config.json.
+
+    Args:
+        server: Server
+
+    Returns:
+        Weight (a positive number), 1 if none is set
+    """
+    weight = server.get('weight', 1)
+    if not isinstance(weight, (int, float)) or weight <= 0:
+        return 1
+    return weight
+
+
+def build_alias_table(weights):
+    """Builds Vose's alias table for weighted random sampling in O(1).
+
+    Args:
+        weights: List of positive weights
+
+    Returns:
+        Tuple of (probabilities, aliases), both lists as long as weights
+    """
+    n = len(weights)
+    total = sum(weights)
+    probabilities = [weight * n / total for weight in weights]
+    aliases = list(range(n))
+    small = [i for i, p in enumerate(probabilities) if p < 1]
+    large = [i for i, p in enumerate(probabilities) if p >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        aliases[less] = more
+        probabilities[more] += probabilities[less] - 1
+        if probabilities[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    # Whatever is left over is only off from 1 by rounding errors
+    for i in small + large:
+        probabilities[i] = 1
+    return probabilities, aliases
+
+
+def get_hash(value):
+    """Hashes a string onto the ring.
+
+    Args:
+        value: String, e.g. a request path
+
+    Returns:
+        64-bit unsigned integer
+    """
+    return int.from_bytes(
+        hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class Strategy(ABC):
+    """Chooses a server for each request.
+
+    Strategies also count the requests in progress on each server: every
+    select() must be matched with a release() once the request is over.
+    Derived precomputed state (weights, tables) is only rebuilt when the list
+    of available servers changes.
+    """
+
+    def __init__(self):
+        self._servers = None
+        self._outstanding = {}  # (host, port) -> requests in progress
+        self._lock = threading.Lock()
+
+    def select(self, servers, key=None):
+        """Chooses a server.
+
+        Args:
+            servers: List of available servers (must not be empty)
+            key: Target of the request (its path), for strategies that send
+                the same path to the same server
+
+        Returns:
+            Server
+        """
+        with self._lock:
+            # The health checker replaces the list whenever it changes
+            if servers is not self._servers:
+                self._servers = servers
+                self._rebuild(servers)
+            server = self._select(servers, key)
+            key = (server['host'], server['port'])
+            self._outstanding[key] = self._outstanding.get(key, 0) + 1
+            return server
+
+    def release(self, server):
+        """Records that a request sent to a server is over.
+
+        Args:
+            server: Server returned by select()
+
+        Returns:
+            None
+        """
+        key = (server['host'], server['port'])
+        with self._lock:
+            self._outstanding[key] -= 1
+            if not self._outstanding[key]:
+                del self._outstanding[key]
+
+    def _get_outstanding(self, server):
+        return self._outstanding.get((server['host'], server['port']), 0)
+
+    def _rebuild(self, servers):
+        pass
+
+    @abstractmethod
+    def _select(self, servers, key):
+        """Chooses a server (lock held).
+
+        Args:
+            servers: List of available servers, as last passed to _rebuild()
+            key: Target of the request, or None
+
+        Returns:
+            Server
+        """
+
+
+class WeightedRandom(Strategy):
+    """Picks a server at random, weighted by response time, in O(1)."""
+
+    def _rebuild(self, servers):
+        self._table = build_alias_table(
+            [get_weight(server) for server in servers])
+
+    def _select(self, servers, key):
+        probabilities, aliases = self._table
+        i = random.randrange(len(servers))
+        if random.random() >= probabilities[i]:
+            i = aliases[i]
+        return servers[i]
+
+
+class SmoothRoundRobin(Strategy):
+    """Smooth weighted round-robin (as used by nginx).
+
+    Every pick adds each server's weight to its running total, chooses the
+    server with the highest total and takes the sum of all weights off it. The
+    picks are spread out evenly, rather than sending a fast server several
+    requests in a row. Each pick is a single pass over the available servers.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._current = {}  # (host, port) -> running total
+
+    def _rebuild(self, servers):
+        self._weights = [get_weight(server) for server in servers]
+        self._total = sum(self._weights)
+        keys = {(server['host'], server['port']) for server in servers}
+        # Keep the running totals of servers that are still available
+        self._current = {
+            key: total for key, total in self._current.items() if key in keys}
+
+    def _select(self, servers, key):
+        best = None
+        best_total = None
+        for server, weight in zip(servers, self._weights):
+            key = (server['host'], server['port'])
+            total = self._current.get(key, 0) + weight
+            self._current[key] = total
+            if best_total is None or total > best_total:
+                best = server
+                best_total = total
+        self._current[(best['host'], best['port'])] -= self._total
+        return best
+
+
+class PowerOfTwoChoices(Strategy):
+    """Picks the better of two random servers, in O(1).
+
+    Servers are compared by their EWMA response time multiplied by one more
+    than their number of requests in progress, so a fast server that is
+    already busy loses to a slightly slower idle one.
+    """
+
+    def _select(self, servers, key):
+        if len(servers) == 1:
+            return servers[0]
+        first, second = random.sample(servers, 2)
+        if self._get_cost(second) < self._get_cost(first):
+            return second
+        return first
+
+    def _get_cost(self, server):
+        return server.get('ewma', 0) * (self._get_outstanding(server) + 1)
+
+
+class LeastOutstanding(Strategy):
+    """Picks the server with the fewest requests in progress.
+
+    Ties are broken in turn, starting from a different server on each pick, so
+    idle servers share requests evenly.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._next = 0
+
+    def _select(self, servers, key):
+        n = len(servers)
+        start = self._next % n
+        self._next = start + 1
+        best = None
+        for i in range(n):
+            server = servers[(start + i) % n]
+            if best is None or (self._get_outstanding(server)
+                                < self._get_outstanding(best)):
+                best = server
+        return best
+
+
+class ConsistentHash(Strategy):
+    """Consistent hashing of request paths, with bounded loads.
+
+    Every server is placed on a hash ring at VIRTUAL_NODES points per unit of
+    weight, and a request goes to the server owning the first point at or
+    after the hash of its path. The same path therefore keeps going to the
+    same server, and adding or removing one of N servers only moves about
+    1/N of the paths.
+
+    So that a hot path cannot pin a single server, no server is given more
+    than LOAD_FACTOR times its weighted share of the requests in progress
+    (counting the new one): a server at that bound is skipped for the next
+    one along the ring (Mirrokni et al., "Consistent Hashing with Bounded
+    Loads"). Picks are O(log n) in the number of points while no server is
+    at its bound.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._ring_servers = None  # ((host, port, weight), ...) of the ring
+        self._points = []  # sorted hashes of the points on the ring
+        self._owners = []  # (host, port) owning each point
+
+    def _rebuild(self, servers):
+        self._by_key = {(server['host'], server['port']): server
+                        for server in servers}
+        self._weights = {
+            (server['host'], server['port']): get_config_weight(server)
+            for server in servers
+        }
+        self._total_weight = sum(self._weights.values())
+        ring_servers = tuple(sorted(
+            (host, port, weight)
+            for (host, port), weight in self._weights.items()))
+        if ring_servers == self._ring_servers:
+            # Only the order (or the health state) of the list changed
+            return
+        points = []
+        for host, port, weight in ring_servers:
+            for i in range(max(1, round(VIRTUAL_NODES * weight))):
+                points.append((get_hash(f"{host}:{port}#{i}"), (host, port)))
+        points.sort()
+        self._ring_servers = ring_servers
+        self._points = [point for point, _ in points]
+        self._owners = [owner for _, owner in points]
+
+    def _select(self, servers, key):
+        in_progress = sum(self._outstanding.values()) + 1
+        n = len(self._points)
+        start = bisect.bisect_left(self._points, get_hash(key or "/")) % n
+        seen = set()
+        for i in range(n):
+            owner = self._owners[(start + i) % n]
+            if owner in seen:
+                continue
+            seen.add(owner)
+            bound = math.ceil(LOAD_FACTOR * in_progress
+                              * self._weights[owner] / self._total_weight)
+            if self._outstanding.get(owner, 0) < bound:
+                return self._by_key[owner]
+        # Not reached, as the bounds add up to more than the requests in
+        # progress
+        return self._by_key[self._owners[start]]
+
+
+STRATEGIES = {
+    "random": WeightedRandom,
+    "round_robin": SmoothRoundRobin,
+    "p2c": PowerOfTwoChoices,
+    "least_outstanding": LeastOutstanding,
+    "consistent_hash": ConsistentHash
+}
+
+
+def create_strategy(name):
+    """Creates a strategy from its name in config.json.
+
+    Args:
+        name: Strategy name, one of STRATEGIES
+
+    Returns:
+        Strategy
+
+    Raises:
+        ValueError: If there is no strategy with that name.
+    """
+    try:
+        return STRATEGIES[name]()
+    except KeyError:
+        raise ValueError(f"unknown strategy {name!r}, expected one of "
+                         f"{', '.join(STRATEGIES)}")
@@ -0,0 +1,580 @@
+"""Load Benchmark
+
+This script measures the server, the cache proxy and the load balancer under
+load, and can be executed by the following:
+    `python3 benchmarks/load.py [KEY=VALUE ...]`
+
+Every run starts its own instances on free ports on localhost (SERVERS
+servers, a cache in front of the first server and a load balancer in front
+of all of them), sends each target the same workload and prints the results
+as JSON, so that runs of different builds can be compared. The processes are
+stopped once the run is over, and nothing in the repository is written to.
+
+Workloads:
+    files       Every file in `server/files/`, equally popular (default)
+    zipf        FILES synthetic files of 1 KiB to 1 MiB, requested with
+                Zipf-distributed popularity (exponent ZIPF_S)
+    replay      The requests listed in REPLAY, in order. Each line is either
+                a path or a JSON object with a "path" (and optionally
+                "headers"); lines without a path are skipped.
+
+Load is either closed loop (CONCURRENCY connections each sending a request as
+soon as the previous response is read) or, with RATE set, open loop (requests
+are started RATE times a second whether or not earlier ones have finished,
+and latency is measured from when each request should have started).
+
+Arguments:
+    TARGETS         Comma-separated targets: server, cache, balancer
+    WORKLOAD        files, zipf or replay
+    FILES           Number of files in the zipf workload
+    ZIPF_S          Exponent of the zipf workload
+    REPLAY          Path to the requests to replay
+    CONCURRENCY     Number of connections
+    RATE            Requests per second (0 for closed loop)
+    DURATION        Seconds of load per target
+    REQUESTS        Requests per target (0 to run for DURATION instead)
+    SERVERS         Number of servers
+    STRATEGY        Load balancer strategy
+    SEED            Seed of the random workload
+    OUTPUT          Path to write the JSON results to (default: print them)
+
+This script requires python3 to be installed.
+"""
+
+import bisect
+import itertools
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SERVER_DIR = os.path.join(ROOT, "server")
+CACHE_DIR = os.path.join(ROOT, "cache")
+BALANCER_DIR = os.path.join(ROOT, "balancer")
+TARGETS = ["server", "cache", "balancer"]
+RECV_BUFFER_SIZE = 65536
+MAX_HEADER_SIZE = 8192
+START_TIMEOUT = 10.0  # seconds for a process to start listening
+MIN_FILE_SIZE = 1024  # bytes, smallest synthetic file
+MAX_FILE_SIZE = 1024 * 1024  # bytes, largest synthetic file
+PERCENTILES = {"p50": 0.5, "p99": 0.99, "p999": 0.999}
+DEFAULT_SETTINGS = {
+    "TARGETS": ",".join(TARGETS),
+    "WORKLOAD": "files",
+    "FILES": 1000,
+    "ZIPF_S": 1.0,
+    "REPLAY": None,
+    "CONCURRENCY": 16,
+    "RATE": 0.0,
+    "DURATION": 10.0,
+    "REQUESTS": 0,
+    "SERVERS": 2,
+    "STRATEGY": "least_outstanding",
+    "SEED": 1,
+    "OUTPUT": None
+}
+# Runs the main() of a script with its PORT constant set, for scripts that do
+# not take the port as an argument, and without serving metrics on a fixed
+# port
+BOOTSTRAP = """
+import sys
+directory, port = sys.argv[1], int(sys.argv[2])
+sys.argv = [sys.argv[0]] + sys.argv[3:]
+sys.path.insert(0, directory)
+import main
+main.PORT = port
+main.METRICS_PORT = 0
+main.main(*sys.argv[1:])
+"""
+
+
+def get_free_port():
+    """Returns a port on localhost that nothing is listening on.
+
+    Returns:
+        Port number
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, process):
+    """Waits until a process accepts connections on a port.
+
+    Args:
+        port: Port number on localhost
+        process: subprocess.Popen of the process
+
+    Returns:
+        None
+
+    Raises:
+        RuntimeError: If the process exits or does not start listening
+            within START_TIMEOUT seconds.
+    """
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"{process.args} exited with {process.returncode}")
+        try:
+            socket.create_connection(("localhost", port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{process.args} did not start listening on {port}")
+
+
+def start_process(args, cwd, port, log):
+    """Starts a server, cache or load balancer process.
+
+    Args:
+        args: Command line
+        cwd: Directory to run it in
+        port: Port number it listens on
+        log: File object its output is written to
+
+    Returns:
+        subprocess.Popen
+    """
+    process = subprocess.Popen(
+        args, cwd=cwd, stdout=log, stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL)
+    try:
+        wait_for_port(port, process)
+    except RuntimeError:
+        stop_process(process)
+        raise
+    return process
+
+
+def stop_process(process):
+    """Stops a process with Ctrl-C, as a user would.
+
+    Args:
+        process: subprocess.Popen
+
+    Returns:
+        None
+    """
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def make_zipf_files(directory, count, rng):
+    """Creates the files of the zipf workload.
+
+    File sizes are spread log-uniformly between MIN_FILE_SIZE and
+    MAX_FILE_SIZE.
+
+    Args:
+        directory: Directory to create the files in
+        count: Number of files
+        rng: random.Random
+
+    Returns:
+        List of paths, most popular first
+    """
+    os.makedirs(os.path.join(directory, "zipf"), exist_ok=True)
+    paths = []
+    for rank in range(count):
+        size = int(MIN_FILE_SIZE * (MAX_FILE_SIZE / MIN_FILE_SIZE)
+                   ** rng.random())
+        name = f"zipf/{rank:05d}.bin"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(rng.randbytes(size))
+        paths.append("/" + name)
+    return paths
+
+
+def list_files(directory):
+    """Lists the files a server serves, other than its error pages.
+
+    Args:
+        directory: The server's files/ directory
+
+    Returns:
+        Sorted list of paths
+    """
+    paths = []
+    for parent, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.relpath(os.path.join(parent, name), directory)
+            path = "/" + path.replace(os.sep, "/")
+            if not path.startswith("/errors/"):
+                paths.append(path)
+    return sorted(paths)
+
+
+def read_replay(filename):
+    """Reads the requests of the replay workload.
+
+    Args:
+        filename: Path to a file with one request per line
+
+    Returns:
+        List of (path, header fields) tuples
+    """
+    requests = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                path = record.get("path")
+                if not isinstance(path, str):
+                    continue
+                requests.append((path, record.get("headers", {})))
+            else:
+                requests.append((line, {}))
+    return requests
+
+
+def make_workload(settings, server_files, rng):
+    """Builds the function that picks the next request of a workload.
+
+    Args:
+        settings: Dictionary of settings
+        server_files: Directory the servers serve files from
+        rng: random.Random
+
+    Returns:
+        Tuple of (function taking a request number and returning a (path,
+        header fields) tuple, description of the workload)
+    """
+    workload = settings["WORKLOAD"]
+    if workload == "zipf":
+        paths = make_zipf_files(server_files, settings["FILES"], rng)
+        weights = itertools.accumulate(
+            1 / (rank + 1) ** settings["ZIPF_S"] for rank in range(len(paths)))
+        weights = list(weights)
+        # Drawn up front, so that every target gets the same sequence
+        draws = [rng.random() * weights[-1] for _ in range(65536)]
+
+        def pick(i):
+            return paths[bisect.bisect(weights, draws[i % len(draws)])], {}
+        return pick, {"name": "zipf", "files": len(paths),
+                      "zipf_s": settings["ZIPF_S"]}
+    if workload == "replay":
+        if not settings["REPLAY"]:
+            raise ValueError("REPLAY must be set for the replay workload")
+        requests = read_replay(settings["REPLAY"])
+        if not requests:
+            raise ValueError(
+                f"no requests with a path in {settings['REPLAY']}")
+        return (lambda i: requests[i % len(requests)]), {
+            "name": "replay", "file": settings["REPLAY"],
+            "requests": len(requests)}
+    if workload == "files":
+        paths = list_files(server_files)
+        return (lambda i: (paths[i % len(paths)], {})), {
+            "name": "files", "files": len(paths)}
+    raise ValueError(f"unknown workload: {workload}")
+
+
+def send_request(sock, buffer, request):
+    """Sends a request and reads the whole response.
+
+    Args:
+        sock: Connected socket instance
+        buffer: Bytes received past the end of the previous response
+        request: Request (bytes)
+
+    Returns:
+        Tuple of (status code, response headers, body length, remaining
+        buffer). The response headers are keyed by lowercase field name. If
+        they include `Connection: close`, the connection cannot be reused.
+
+    Raises:
+        OSError: If the connection failed or was closed.
+    """
+    sock.sendall(request)
+    while (end := buffer.find(b"\r\n\r\n")) == -1:
+        if len(buffer) > MAX_HEADER_SIZE:
+            raise ConnectionError("Response header too large")
+        data = sock.recv(RECV_BUFFER_SIZE)
+        if not data:
+            raise ConnectionError("Connection closed")
+        buffer += data
+    status_line, *lines = buffer[:end].decode(errors="replace").split("\r\n")
+    buffer = buffer[end + 4:]
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    status_code = int(status_line.split(' ')[1])
+    if status_code == 304:
+        length = 0
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+    else:
+        raise ConnectionError("Response without Content-Length")
+
+    # Read the body into a reused buffer rather than keeping it
+    remaining = length - min(length, len(buffer))
+    buffer = buffer[length:]
+    scratch = bytearray(min(remaining, RECV_BUFFER_SIZE))
+    while remaining > 0:
+        count = sock.recv_into(scratch, min(remaining, len(scratch)))
+        if not count:
+            raise ConnectionError("Connection closed before end of body")
+        remaining -= count
+    return status_code, headers, length, buffer
+
+
+def run_load(port, host_header, pick, settings):
+    """Sends a workload to a target and measures the responses.
+
+    Args:
+        port: Port number of the target on localhost
+        host_header: Value of the Host header to send
+        pick: Function returning the (path, header fields) of request i
+        settings: Dictionary of settings
+
+    Returns:
+        Dictionary of results
+    """
+    concurrency = settings["CONCURRENCY"]
+    rate = settings["RATE"]
+    total = settings["REQUESTS"]
+    duration = settings["DURATION"]
+    counter = itertools.count()
+    lock = threading.Lock()
+    latencies = []
+    statuses = Counter()
+    totals = {"bytes": 0, "errors": 0, "hits": 0}
+    start = time.monotonic()
+    deadline = start + duration
+
+    def run():
+        sock = None
+        buffer = b""
+        samples = []
+        try:
+            while True:
+                with lock:
+                    i = next(counter)
+                if total and i >= total:
+                    return
+                scheduled = start + i / rate if rate else time.monotonic()
+                if not total and scheduled >= deadline:
+                    return
+                if rate:
+                    delay = scheduled - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                path, fields = pick(i)
+                request = (
+                    f"GET {path} HTTP/1.1\r\nHost: {host_header}\r\n"
+                    + "".join(f"{name}: {value}\r\n"
+                              for name, value in fields.items())
+                    + "\r\n"
+                ).encode()
+                try:
+                    if sock is None:
+                        sock = socket.create_connection(("localhost", port))
+                        buffer = b""
+                    status_code, headers, length, buffer = send_request(
+                        sock, buffer, request)
+                except OSError:
+                    if sock is not None:
+                        sock.close()
+                    sock = None
+                    with lock:
+                        totals["errors"] += 1
+                    continue
+                samples.append(time.monotonic() - scheduled)
+                if headers.get("connection", "").lower() == "close":
+                    sock.close()
+                    sock = None
+                with lock:
+                    statuses[status_code] += 1
+                    totals["bytes"] += length
+                    totals["hits"] += headers.get("x-cache") == "HIT"
+        finally:
+            if sock is not None:
+                sock.close()
+            with lock:
+                latencies.extend(samples)
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.monotonic() - start, 1e-9)
+
+    latencies.sort()
+    responses = len(latencies)
+    results = {
+        "requests": responses + totals["errors"],
+        "responses": responses,
+        "errors": totals["errors"],
+        "status_codes": {
+            str(code): count for code, count in sorted(statuses.items())},
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(responses / elapsed, 1),
+        "bytes_per_second": round(totals["bytes"] / elapsed),
+        "latency_ms": {
+            name: round(latencies[min(responses - 1, int(q * responses))]
+                        * 1000, 3) if responses else None
+            for name, q in PERCENTILES.items()
+        }
+    }
+    results["latency_ms"]["mean"] = round(
+        sum(latencies) / responses * 1000, 3) if responses else None
+    results["latency_ms"]["max"] = round(
+        latencies[-1] * 1000, 3) if responses else None
+    results["cache_hit_ratio"] = round(
+        totals["hits"] / responses, 4) if responses else None
+    return results
+
+
+def get_build():
+    """Returns the commit the repository is at, to label the results.
+
+    Returns:
+        Abbreviated commit hash (with "-dirty" if there are uncommitted
+        changes), or None if it cannot be found
+    """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=ROOT,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(settings):
+    """Main function of the script.
+
+    Args:
+        settings: Dictionary of settings, see DEFAULT_SETTINGS
+
+    Returns:
+        Dictionary of results, keyed by target
+    """
+    targets = [name for name in settings["TARGETS"].split(',') if name]
+    for name in targets:
+        if name not in TARGETS:
+            raise ValueError(f"unknown target: {name}")
+    rng = random.Random(settings["SEED"])
+    processes = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        log = open(os.path.join(directory, "processes.log"), "wb")
+        try:
+            # Servers share one files/ directory, a copy of the repository's
+            # unless the workload brings its own files
+            server_root = os.path.join(directory, "server")
+            server_files = os.path.join(server_root, "files")
+            if settings["WORKLOAD"] == "zipf":
+                shutil.copytree(os.path.join(SERVER_DIR, "files", "errors"),
+                                os.path.join(server_files, "errors"))
+            else:
+                shutil.copytree(os.path.join(SERVER_DIR, "files"),
+                                server_files)
+            pick, workload = make_workload(settings, server_files, rng)
+
+            server_ports = []
+            for _ in range(settings["SERVERS"]):
+                port = get_free_port()
+                processes.append(start_process(
+                    [sys.executable, os.path.join(SERVER_DIR, "main.py"),
+                     f"PORT={port}"],
+                    server_root, port, log))
+                server_ports.append(port)
+            ports = {"server": server_ports[0]}
+
+            if "cache" in targets:
+                cache_root = os.path.join(directory, "cache")
+                shutil.copytree(os.path.join(CACHE_DIR, "files", "errors"),
+                                os.path.join(cache_root, "files", "errors"))
+                ports["cache"] = get_free_port()
+                processes.append(start_process(
+                    [sys.executable, "-c", BOOTSTRAP, CACHE_DIR,
+                     str(ports["cache"])],
+                    cache_root, ports["cache"], log))
+
+            if "balancer" in targets:
+                config_file = os.path.join(directory, "config.json")
+                with open(config_file, "w") as f:
+                    json.dump({
+                        "mode": "proxy",
+                        "strategy": settings["STRATEGY"],
+                        "servers": [
+                            {"id": i, "host": "localhost", "port": port}
+                            for i, port in enumerate(server_ports)
+                        ]
+                    }, f)
+                ports["balancer"] = get_free_port()
+                processes.append(start_process(
+                    [sys.executable, "-c", BOOTSTRAP, BALANCER_DIR,
+                     str(ports["balancer"]), config_file],
+                    BALANCER_DIR, ports["balancer"], log))
+
+            results = {}
+            for name in targets:
+                # The cache and the load balancer are asked for files on the
+                # first server
+                results[name] = run_load(
+                    ports[name], f"localhost:{server_ports[0]}", pick,
+                    settings)
+                if name != "cache":
+                    del results[name]["cache_hit_ratio"]
+        finally:
+            for process in reversed(processes):
+                stop_process(process)
+            log.close()
+
+    return {
+        "build": get_build(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "workload": workload,
+        "settings": {
+            name.lower(): value for name, value in settings.items()
+            if name != "OUTPUT"
+        },
+        "results": results
+    }
+
+
+if __name__ == '__main__':
+    try:
+        settings = dict(DEFAULT_SETTINGS)
+        for arg in sys.argv[1:]:
+            name, _, value = arg.partition('=')
+            if name not in settings:
+                raise ValueError(f'incorrect argument: {name}')
+            default = DEFAULT_SETTINGS[name]
+            settings[name] = value if default is None else type(default)(value)
+        if settings["CONCURRENCY"] < 1:
+            raise ValueError('concurrency must be at least 1.')
+        if settings["SERVERS"] < 1:
+            raise ValueError('number of servers must be at least 1.')
+        if not settings["REQUESTS"] and settings["DURATION"] <= 0:
+            raise ValueError('either REQUESTS or DURATION must be set.')
+        report = main(settings)
+        output = json.dumps(report, indent=2)
+        if settings["OUTPUT"]:
+            with open(settings["OUTPUT"], "w") as f:
+                f.write(output + "\n")
+        print(output)
+    except ValueError as err:
+        print('ValueError:', err)
@@ -0,0 +1,132 @@
+"""Sendfile Benchmark
+
+This script compares the throughput of sending a file with the original
+chunked `read`/`send` loop against the zero-copy `socket.sendfile` path, and
+can be executed by the following:
+    `python3 benchmarks/sendfile.py [file] [iterations]`
+
+The file defaults to `server/files/sunset.jpg`. Both methods send the file over
+a TCP connection on the loopback interface to a receiver that discards the
+data.
+
+This script requires python3 to be installed.
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+BUFFER_SIZE = 1024
+RECV_BUFFER_SIZE = 65536
+DEFAULT_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "server", "files",
+    "sunset.jpg"
+)
+DEFAULT_ITERATIONS = 50
+
+
+def send_chunked(sock, file):
+    """Sends a file using the original BUFFER_SIZE read/send loop.
+
+    Args:
+        sock: Connected socket instance
+        file: Path to file
+
+    Returns:
+        None
+    """
+    with open(file, "rb") as f:
+        data = f.read(BUFFER_SIZE)
+        while data:
+            sock.send(data)
+            data = f.read(BUFFER_SIZE)
+
+
+def send_zero_copy(sock, file):
+    """Sends a file using `socket.sendfile`.
+
+    Args:
+        sock: Connected socket instance
+        file: Path to file
+
+    Returns:
+        None
+    """
+    with open(file, "rb") as f:
+        sock.sendfile(f)
+
+
+def drain(sock, total, done):
+    """Receives and discards `total` bytes from a socket.
+
+    Args:
+        sock: Connected socket instance
+        total: Number of bytes to receive
+        done: Event set once all bytes have been received
+
+    Returns:
+        None
+    """
+    received = 0
+    while received < total:
+        data = sock.recv(RECV_BUFFER_SIZE)
+        if not data:
+            break
+        received += len(data)
+    done.set()
+
+
+def run(method, file, iterations):
+    """Times `iterations` transfers of a file using the given send method.
+
+    Args:
+        method: Function taking (socket, file) that sends the file
+        file: Path to file
+        iterations: Number of times the file is sent
+
+    Returns:
+        Throughput in MB/s
+    """
+    size = os.stat(file).st_size
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("localhost", 0))
+    listener.listen(1)
+    sender = socket.create_connection(listener.getsockname())
+    receiver, _ = listener.accept()
+    listener.close()
+
+    done = threading.Event()
+    threading.Thread(
+        target=drain,
+        args=(receiver, size * iterations, done),
+        daemon=True
+    ).start()
+
+    t_start = time.perf_counter()
+    for _ in range(iterations):
+        method(sender, file)
+    done.wait()
+    elapsed = time.perf_counter() - t_start
+
+    sender.close()
+    receiver.close()
+    return size * iterations / elapsed / 1e6
+
+
+def main(file, iterations):
+    size = os.stat(file).st_size
+    print(f"Sending {file} ({size} bytes) {iterations} times...\n")
+    chunked = run(send_chunked, file, iterations)
+    print(f"chunked send:  {chunked:10.1f} MB/s")
+    zero_copy = run(send_zero_copy, file, iterations)
+    print(f"sendfile:      {zero_copy:10.1f} MB/s")
+    print(f"\nspeedup:       {zero_copy / chunked:10.2f}x")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    file = args[0] if len(args) > 0 else DEFAULT_FILE
+    iterations = int(args[1]) if len(args) > 1 else DEFAULT_ITERATIONS
+    main(file, iterations)
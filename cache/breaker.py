@@ -0,0 +1,133 @@
+"""Circuit Breaker
+
+Per-origin circuit breaking for the cache proxy. Once an origin server has
+failed several requests in a row, requests for it fail straight away for a
+while (so clients are answered from stale copies or with an error at once,
+rather than each waiting for the origin to time out), and the origin is
+given time to recover. After that, a single trial request is let through:
+if it succeeds the origin is used again, otherwise it is left alone for
+another while.
+
+"""
+
+import threading
+import time
+
+DEFAULT_FAILURE_THRESHOLD = 5  # failures in a row before the circuit opens
+DEFAULT_RESET_TIMEOUT = 10.0  # seconds before a trial request is let through
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of contacting an origin whose circuit is open.
+
+    Attributes:
+        retry_after: Seconds until a trial request will be let through
+    """
+
+    def __init__(self, origin, retry_after):
+        super().__init__(f"Circuit open for {origin[0]}:{origin[1]}")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Keeps track of which origins are failing.
+
+    Each origin's circuit is closed (requests go through), open (requests
+    fail at once) or half-open (one trial request goes through, and decides
+    whether the circuit closes or opens again).
+
+    Attributes:
+        failure_threshold: Failures in a row that open a circuit
+        reset_timeout: Seconds a circuit stays open before a trial request
+        rejected: Number of requests failed because their circuit was open
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """
+        Args:
+            failure_threshold: Failures in a row that open a circuit
+            reset_timeout: Seconds a circuit stays open before a trial
+                request is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.rejected = 0
+        self._failures = {}  # (host, port) -> failures in a row
+        self._opened_at = {}  # (host, port) -> time the circuit (re)opened
+        self._lock = threading.Lock()
+
+    def check(self, origin):
+        """Checks whether a request may be sent to an origin.
+
+        Once the reset timeout of an open circuit has passed, only the first
+        caller is let through (as the trial request), and the circuit counts
+        as just reopened for everyone else until the trial reports back.
+
+        Args:
+            origin: (host, port) of the origin
+
+        Returns:
+            None
+
+        Raises:
+            CircuitOpenError: If the origin's circuit is open.
+        """
+        with self._lock:
+            opened_at = self._opened_at.get(origin)
+            if opened_at is None:
+                return
+            now = time.monotonic()
+            retry_after = opened_at + self.reset_timeout - now
+            if retry_after <= 0:
+                # Let this request through as the trial. If it never
+                # reports back, another trial follows after reset_timeout.
+                self._opened_at[origin] = now
+                return
+            self.rejected += 1
+        raise CircuitOpenError(origin, retry_after)
+
+    def record_success(self, origin):
+        """Records that an origin answered, closing its circuit.
+
+        Args:
+            origin: (host, port) of the origin
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._failures.pop(origin, None)
+            if self._opened_at.pop(origin, None) is not None:
+                print(f"Origin {origin[0]}:{origin[1]} is back, circuit "
+                      "closed")
+
+    def record_failure(self, origin):
+        """Records that a request to an origin failed.
+
+        Opens the origin's circuit once failure_threshold requests in a row
+        have failed, or again if the trial request failed.
+
+        Args:
+            origin: (host, port) of the origin
+
+        Returns:
+            None
+        """
+        with self._lock:
+            failures = self._failures.get(origin, 0) + 1
+            self._failures[origin] = failures
+            if failures >= self.failure_threshold:
+                if origin not in self._opened_at:
+                    print(f"Origin {origin[0]}:{origin[1]} is failing, "
+                          f"circuit opened for {self.reset_timeout:g}s")
+                self._opened_at[origin] = time.monotonic()
+
+    def open_circuits(self):
+        """Returns the number of origins whose circuit is open.
+
+        Returns:
+            Number of open (or half-open) circuits
+        """
+        with self._lock:
+            return len(self._opened_at)
@@ -0,0 +1,160 @@
+"""Freshness
+
+Freshness model of the cache proxy. Works out how long a response may be
+served from cache without contacting the server, from its `Cache-Control` and
+`Expires` headers, and how long it may still be served once stale.
+
+"""
+
+from collections import namedtuple
+
+from common.validators import parse_date
+
+Freshness = namedtuple(
+    "Freshness",
+    ["stored_at", "ttl", "stale_while_revalidate", "stale_if_error"]
+)
+
+
+def parse_cache_control(value):
+    """Parses a Cache-Control header value.
+
+    Args:
+        value: Cache-Control header value, e.g. "max-age=60, must-revalidate"
+
+    Returns:
+        Dictionary of lowercase directive names to values (None for
+        directives without a value)
+    """
+    directives = {}
+    for directive in value.split(','):
+        name, _, argument = directive.partition('=')
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"') or None
+    return directives
+
+
+def get_seconds(directives, name, default):
+    """Returns the value of a delta-seconds directive.
+
+    Args:
+        directives: Parsed Cache-Control directives
+        name: Directive name
+        default: Value returned if the directive is missing or invalid
+
+    Returns:
+        Number of seconds
+    """
+    try:
+        return max(0, int(directives[name]))
+    except (KeyError, TypeError, ValueError):
+        return default
+
+
+def get_freshness(response_headers, now, default_ttl=0,
+                  stale_while_revalidate=0, stale_if_error=0):
+    """Works out the freshness of a response received from the server.
+
+    The freshness lifetime is taken from (in order of precedence) the
+    `s-maxage` or `max-age` Cache-Control directives, or the `Expires` header
+    relative to the `Date` header. If the server sends none of them,
+    default_ttl is used. `no-cache` and `no-store` make the response stale
+    straight away, and `no-cache` and `must-revalidate`/`proxy-revalidate`
+    forbid serving it once stale (`no-store` responses are not stored at
+    all, see is_storable()). A response that has already spent time in
+    another cache (its `Age` header) counts as stored that long ago.
+
+    Args:
+        response_headers: Header fields of the response (lowercase names)
+        now: Time the response was received (seconds since the epoch)
+        default_ttl: Freshness lifetime (seconds) if the server gives none
+        stale_while_revalidate: Seconds a stale response may still be served
+            while it is revalidated in the background, unless the server
+            sends its own `stale-while-revalidate` directive
+        stale_if_error: Seconds a stale response may still be served if the
+            server cannot be reached or returns an error, unless the server
+            sends its own `stale-if-error` directive
+
+    Returns:
+        Freshness
+    """
+    directives = parse_cache_control(response_headers.get("cache-control", ""))
+    if "no-cache" in directives or "no-store" in directives:
+        ttl = 0
+    elif "s-maxage" in directives:
+        ttl = get_seconds(directives, "s-maxage", 0)
+    elif "max-age" in directives:
+        ttl = get_seconds(directives, "max-age", 0)
+    elif "expires" in response_headers:
+        # An invalid Expires date means the response is already stale
+        expires = parse_date(response_headers["expires"])
+        date = parse_date(response_headers.get("date")) or now
+        ttl = max(0, expires - date) if expires is not None else 0
+    else:
+        ttl = default_ttl
+
+    if directives.keys() & {
+            "no-cache", "no-store", "must-revalidate", "proxy-revalidate"}:
+        stale_while_revalidate = stale_if_error = 0
+    else:
+        stale_while_revalidate = get_seconds(
+            directives, "stale-while-revalidate", stale_while_revalidate)
+        stale_if_error = get_seconds(
+            directives, "stale-if-error", stale_if_error)
+    # Age is in delta-seconds, like the directives
+    age = get_seconds(response_headers, "age", 0)
+    return Freshness(now - age, ttl, stale_while_revalidate, stale_if_error)
+
+
+def is_storable(response_headers):
+    """Returns whether a response may be stored at all.
+
+    Args:
+        response_headers: Header fields of the response (lowercase names)
+
+    Returns:
+        False if the response has the `no-store` Cache-Control directive
+    """
+    return "no-store" not in parse_cache_control(
+        response_headers.get("cache-control", ""))
+
+
+def is_fresh(freshness, now):
+    """Returns whether a cached response may be served without revalidation.
+
+    Args:
+        freshness: Freshness of the cached response
+        now: Current time (seconds since the epoch)
+
+    Returns:
+        True if the response is fresh
+    """
+    return now - freshness.stored_at < freshness.ttl
+
+
+def can_serve_while_revalidating(freshness, now):
+    """Returns whether a stale response may be served while it is revalidated.
+
+    Args:
+        freshness: Freshness of the cached response
+        now: Current time (seconds since the epoch)
+
+    Returns:
+        True if the response is within its stale-while-revalidate window
+    """
+    age = now - freshness.stored_at
+    return age < freshness.ttl + freshness.stale_while_revalidate
+
+
+def can_serve_on_error(freshness, now):
+    """Returns whether a stale response may be served if the server fails.
+
+    Args:
+        freshness: Freshness of the cached response
+        now: Current time (seconds since the epoch)
+
+    Returns:
+        True if the response is within its stale-if-error window
+    """
+    return now - freshness.stored_at < freshness.ttl + freshness.stale_if_error
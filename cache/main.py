@@ -6,213 +6,1718 @@ following:
 
 """
 
+import functools
+import math
 import os
-import sys
 import socket
+import sys
+import threading
 import time
-from datetime import datetime
+
+# Make the shared modules in common/ importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import breaker  # noqa: E402
+import freshness  # noqa: E402
+import memory  # noqa: E402
+import refresh  # noqa: E402
+import storage  # noqa: E402
+import vary  # noqa: E402
+from common import accesslog, admission, http, metrics, mime, pool, \
+    ranges, validators  # noqa: E402
 
 HOST = "localhost"
 PORT = 9000
-FILE_EXPIRE_TIME = 86400  # seconds in 24hrs
-BUFFER_SIZE = 1024
+DEFAULT_TTL = 60  # seconds, for responses without Cache-Control or Expires
+DEFAULT_STALE_WHILE_REVALIDATE = 0  # seconds
+DEFAULT_STALE_IF_ERROR = 86400  # seconds in 24hrs
+KEEP_ALIVE_TIMEOUT = 15.0  # seconds
+DEFAULT_MEMORY_SIZE = 64 * 1024 * 1024  # bytes
+DEFAULT_DISK_SIZE = 1024 * 1024 * 1024  # bytes
+DEFAULT_POOL_SIZE = 8  # idle connections per origin
+POOL_IDLE_TIMEOUT = 10.0  # seconds, shorter than the server's keep-alive
+MAX_RESUMES = 3  # times an interrupted download is resumed with a Range
+METRICS_PORT = 9001  # port the metrics are served on (`/metrics`), 0 for none
+ORIGIN_TIMEOUT = 10.0  # seconds to connect to, or wait on, an origin server
+FETCH_WAIT_TIMEOUT = 30.0  # seconds to wait for another request's fetch
+DEFAULT_BACKLOG = socket.SOMAXCONN
 
+# Disk tier, stored in the files/ directory, created by main()
+disk_storage = None
+# In-memory tier in front of the disk tier, created by main()
+memory_cache = None
+# Persistent connections to origin servers, created by main()
+connection_pool = None
+# Origins that keep failing, created by main()
+origin_breaker = None
+# Cap on the client connections served at once, created by main()
+connection_limit = None
+# Sibling caches asked for files that are not cached, as (host, port), set
+# by main()
+siblings = []
+# Request counts per cache key and the pace of refreshes, created by main()
+popularity = None
+refresh_limiter = None
+# Freshness applied to responses unless the server says otherwise, set by
+# main()
+default_ttl = DEFAULT_TTL
+stale_while_revalidate = DEFAULT_STALE_WHILE_REVALIDATE
+stale_if_error = DEFAULT_STALE_IF_ERROR
+# Files currently being fetched from the server, keyed by
+# "<host>_<port>/<path>", see begin_fetch()
+in_flight = {}
+in_flight_lock = threading.Lock()
+# Names of the request header fields that responses vary on, keyed by
+# "<host>_<port>/<path>", see get_cache_key()
+vary_fields = {}
+# Log of every request answered, opened by main() if enabled
+access_log = None
+# Response sent to the client on the current thread, see note_response()
+exchange = threading.local()
 
-def get_content_type(file_ext):
-    """Returns the content type of a file.
+requests_total = metrics.counter(
+    "cache_requests_total",
+    "Requests answered, by status code and cache result (hit, miss or error)",
+    ["code", "cache"])
+request_duration = metrics.histogram(
+    "cache_request_duration_seconds", "Time taken to answer a request",
+    ["cache"])
+response_bytes = metrics.counter(
+    "cache_response_bytes_total", "Bytes of response bodies sent")
+active_connections = metrics.gauge(
+    "cache_connections_active", "Client connections currently open")
+metrics.counter(
+    "cache_memory_hits_total", "Lookups that found the object in memory",
+    function=lambda: memory_cache.stats()["hits"])
+metrics.counter(
+    "cache_memory_misses_total", "Lookups that did not find it in memory",
+    function=lambda: memory_cache.stats()["misses"])
+metrics.counter(
+    "cache_memory_evictions_total", "Objects evicted from the memory tier",
+    function=lambda: memory_cache.stats()["evictions"])
+metrics.gauge(
+    "cache_memory_bytes", "Bytes held by the memory tier",
+    function=lambda: memory_cache.stats()["size"])
+metrics.counter(
+    "cache_disk_evictions_total", "Objects evicted from the disk tier",
+    function=lambda: disk_storage.stats()["evictions"])
+metrics.gauge(
+    "cache_disk_objects", "Objects stored in the disk tier",
+    function=lambda: disk_storage.stats()["objects"])
+metrics.gauge(
+    "cache_disk_bytes", "Bytes stored in the disk tier",
+    function=lambda: disk_storage.stats()["size"])
+metrics.counter(
+    "cache_origin_connections_created_total",
+    "Connections opened to origin servers",
+    function=lambda: connection_pool.stats()["created"])
+metrics.counter(
+    "cache_origin_connections_reused_total",
+    "Requests sent on a pooled connection to an origin server",
+    function=lambda: connection_pool.stats()["reused"])
+metrics.gauge(
+    "cache_origin_circuits_open",
+    "Origin servers currently not contacted as they keep failing",
+    function=lambda: origin_breaker.open_circuits())
+metrics.counter(
+    "cache_origin_circuit_rejections_total",
+    "Requests not sent to an origin server as its circuit was open",
+    function=lambda: origin_breaker.rejected)
+sibling_hits = metrics.counter(
+    "cache_sibling_hits_total",
+    "Files not cached that were fetched from a sibling cache, not the server")
+refreshes_total = metrics.counter(
+    "cache_refreshes_total",
+    "Objects fetched ahead of requests, by reason (warm or refresh)",
+    ["reason"])
+metrics.counter(
+    "cache_connections_rejected_total",
+    "Connections answered with 503 as too many were open",
+    function=lambda: connection_limit.rejected)
+
+
+def build_header(status, fields):
+    """Builds an HTTP/1.1 response header.
 
     Args:
-        file_ext: File extension
+        status: Status code and reason phrase, e.g. "200 OK"
+        fields: Dictionary of header field names to values
 
     Returns:
-        Content type associated with file extension. Default is "text/html".
+        Response header (str), terminated by an empty line
     """
-    if file_ext in ["jpg", "jpeg"]:
-        return "image/jpeg"
-    elif file_ext == "gif":
-        return "image/gif"
-    else:
-        return "text/html"
+    header = f"HTTP/1.1 {status}\r\n"
+    for name, value in fields.items():
+        header += f"{name}: {value}\r\n"
+    return header + "\r\n"
+
+
+def get_stored_headers(filename, response_headers):
+    """Returns the header fields kept with a cached object.
+
+    Args:
+        filename: Cached file name
+        response_headers: Header fields of the server's response (lowercase
+            names)
+
+    Returns:
+        Dictionary of header field names to values
+    """
+    stored_headers = {
+        "Content-Type": response_headers.get(
+            "content-type", mime.get_content_type(filename))
+    }
+    for name in ["Content-Encoding", "Last-Modified", "ETag", "Vary"]:
+        if name.lower() in response_headers:
+            stored_headers[name] = response_headers[name.lower()]
+    return stored_headers
+
+
+def get_cache_key(file, request_headers):
+    """Returns the key a request's response is cached under.
+
+    If the server's last response for the file carried a Vary header, the
+    key of the variant matching the request is returned.
+
+    Args:
+        file: Cached file key ("<host>_<port>/<path>")
+        request_headers: Request header fields (lowercase names)
+
+    Returns:
+        Cache key
+    """
+    names = vary_fields.get(file)
+    if names is None:
+        return file
+    return vary.get_variant_key(file, names, request_headers)
 
 
-def get_status_code(response_header):
-    """Returns the status code found in response header.
+def store_vary(file, response_headers, request_headers):
+    """Records the Vary header of a response and returns its cache key.
 
     Args:
-        response_header: Valid HTTP/1.1 response header
+        file: Cached file key ("<host>_<port>/<path>")
+        response_headers: Header fields of the server's response (lowercase
+            names)
+        request_headers: Header fields of the request it answers (lowercase
+            names)
 
     Returns:
-        HTTP status code (int)
+        Cache key to store the response under, or None if it varies on
+        something other than request headers (`Vary: *`) and cannot be
+        cached
     """
-    status_line = response_header.split('\n')[0]
-    return int(status_line.split(' ')[1])
+    names = vary.parse_vary(response_headers.get("vary"))
+    if names is None:
+        vary_fields.pop(file, None)
+        return file
+    if "*" in names:
+        return None
+    vary_fields[file] = names
+    return vary.get_variant_key(file, names, request_headers)
 
 
-def cache(filepath, filename, server_socket):
+def cache(file, server_socket, buffer, length, response_headers,
+          client_socket=None, resume=None, on_stored=None):
     """Reads in data from server socket and saves file to cache
 
+    The file is always written to the disk tier. If it is small enough it is
+    also kept in the memory tier, otherwise any older copy is dropped from
+    memory. A `no-store` response is not stored at all (it is only streamed
+    to the client, if any) and any older copy is dropped from both tiers.
+
+    The body only replaces the cached file once it has been fully received, so
+    a partially downloaded file is never served. If client_socket is given,
+    the 200 response (marked `X-Cache: MISS`) is streamed to the client while
+    it is being saved. The body is then downloaded on a thread of its own at
+    the server's pace, and the client is sent what has been written to disk
+    so far, so a slow client holds up neither the download nor the requests
+    waiting for it. If the client goes away, or falls too far behind (see
+    admission.DeadlineSocket), the file is still saved, and the error is
+    raised afterwards. A `no-store` response is sent on as it arrives.
+
+    If the server connection drops mid-transfer and resume is given, the rest
+    of the body is requested with a Range header (up to MAX_RESUMES times), so
+    that neither the download nor the response to the client starts over.
+    server_socket is closed in that case and must not be reused.
+
     Args:
-        filepath: Cached file path
-        filename: Cached file name
+        file: Cache key of the file, see get_cache_key()
         server_socket: Server socket instance
+        buffer: Body bytes already received with the response header
+        length: Length of the body in bytes, or None if the body runs until
+            the server closes the connection
+        response_headers: Header fields of the server's response (lowercase
+            names)
+        client_socket: Client socket instance to stream the response to, if
+            any
+        resume: Function called with (offset, validator) to request the
+            body from offset on, see resume_fetch()
+        on_stored: Function called (without arguments) as soon as the file
+            has been stored or could not be, e.g. to wake up requests waiting
+            for it
+
+    Returns:
+        CachedObject held in memory, or None if the file is only on disk (or
+        was not stored)
+    """
+    stored_headers = get_stored_headers(
+        vary.get_base_key(file).rsplit('/', 1)[-1], response_headers)
+    client_error = None
+    if client_socket is not None:
+        fields = dict(stored_headers, **{"X-Cache": "MISS"})
+        if length is None:
+            # The body can only be delimited by closing the connection
+            fields["Connection"] = "close"
+        else:
+            fields = {"Content-Length": length, **fields}
+        try:
+            client_socket.send(http.encode(build_header("200 OK", fields)))
+        except OSError as err:
+            client_error = err
+        note_response(200, length, "miss")
+
+    storable = freshness.is_storable(response_headers)
+    if not storable and on_stored is not None:
+        # Nothing will be stored for waiting requests to use
+        on_stored()
+        on_stored = None
+    writer = disk_storage.begin_write(file) if storable else None
+    body = bytearray() if storable and memory_cache.admits(length) else None
+    # Streamed from the disk tier's temporary file, rather than as received
+    from_disk = client_socket is not None and writer is not None
+    progress = threading.Condition()
+    received = 0
+    finished = False
+    validator = response_headers.get("etag")
+    if validator is None or validator.startswith("W/"):
+        validator = response_headers.get("last-modified")
+
+    def write(data):
+        nonlocal client_error, received
+        if writer is not None:
+            writer.write(data)
+        if body is not None:
+            body.extend(data)
+        if (client_socket is not None and not from_disk
+                and client_error is None):
+            try:
+                client_socket.sendall(data)
+            except OSError as err:
+                client_error = err
+        with progress:
+            received += len(data)
+            progress.notify_all()
+
+    def download():
+        nonlocal server_socket, buffer, finished
+        try:
+            resumes = 0
+            try:
+                while True:
+                    try:
+                        http.recv_body(
+                            server_socket, buffer,
+                            None if length is None else length - received,
+                            write)
+                        break
+                    except ConnectionError:
+                        if (resume is None or length is None
+                                or validator is None
+                                or resumes == MAX_RESUMES):
+                            raise
+                    resumes += 1
+                    server_socket.close()
+                    server_socket, buffer = resume(received, validator)
+            except BaseException:
+                if writer is not None:
+                    writer.abort()
+                raise
+            finally:
+                if resumes:
+                    server_socket.close()
+            if writer is None:
+                remove_cached(file)
+                return None
+            entry = writer.commit(
+                stored_headers, get_response_freshness(response_headers))
+            if body is None:
+                memory_cache.remove(file)
+                return None
+            cached = memory.CachedObject(
+                stored_headers, bytes(body), entry.freshness.stored_at)
+            memory_cache.put(file, *cached)
+            return cached
+        finally:
+            with progress:
+                finished = True
+                progress.notify_all()
+            if on_stored is not None:
+                on_stored()
+
+    def send_stored(reader):
+        # Sends the body to the client as it is written to disk, returns the
+        # error that ended the transfer early, if any
+        sent = 0
+        while True:
+            with progress:
+                while sent == received and not finished:
+                    progress.wait()
+                available, done = received, finished
+            if sent < available:
+                try:
+                    sent += client_socket.sendfile(
+                        reader, sent, available - sent)
+                except OSError as err:
+                    return err
+            elif done:
+                return None
+
+    if not from_disk:
+        cached = download()
+    else:
+        outcome = {}
+
+        def run():
+            try:
+                outcome["cached"] = download()
+            except BaseException as err:
+                outcome["error"] = err
+        thread = threading.Thread(target=run, daemon=True)
+        with writer.open() as reader:
+            thread.start()
+            if client_error is None:
+                client_error = send_stored(reader)
+        thread.join()
+        if "error" in outcome:
+            raise outcome["error"]
+        cached = outcome["cached"]
+    if client_error is not None:
+        raise client_error
+    return cached
+
+
+def get_response_freshness(response_headers):
+    """Returns the freshness of a response that was just received.
+
+    Args:
+        response_headers: Header fields of the server's response (lowercase
+            names)
+
+    Returns:
+        Freshness
+    """
+    return freshness.get_freshness(
+        response_headers,
+        time.time(),
+        default_ttl,
+        stale_while_revalidate,
+        stale_if_error
+    )
+
+
+def remove_cached(file):
+    """Removes a file from every cache tier.
+
+    Args:
+        file: Cache key of the file, see get_cache_key()
 
     Returns:
         None
     """
-    if os.path.isfile("./files/" + filepath + '/' + filename):
-        os.remove("./files/" + filepath + '/' + filename)
-    os.makedirs("./files/" + filepath, exist_ok=True)
-    with open("./files/" + filepath + "/" + filename, "wb") as f:
-        while data := server_socket.recv(BUFFER_SIZE):
-            f.write(data)
+    memory_cache.remove(file)
+    disk_storage.remove(file)
+
+
+def build_conditional_get(requested_file, server_host, server_port,
+                          stored_headers, fields=None):
+    """Builds a conditional GET for a cached file.
+
+    The validators of the cached copy are sent back as they were received:
+    its ETag in If-None-Match and its Last-Modified date in
+    If-Modified-Since, so that the server can answer 304 if it is unchanged.
+
+    Args:
+        requested_file: Requested path
+        server_host: Hostname of server
+        server_port: Port number of server
+        stored_headers: Header fields stored with the cached copy, or None
+            for a plain GET of a file that is not cached
+        fields: Extra header fields to send, e.g. the fields the cached
+            response varies on
+
+    Returns:
+        Request (str), including the terminating empty line
+    """
+    fields = dict(fields or {})
+    if stored_headers is not None:
+        conditions = {}
+        if "ETag" in stored_headers:
+            conditions["If-None-Match"] = stored_headers["ETag"]
+        if "Last-Modified" in stored_headers:
+            conditions["If-Modified-Since"] = stored_headers["Last-Modified"]
+        fields = {**conditions, **fields}
+    extra = "".join(
+        f"{name}: {value}\r\n" for name, value in fields.items())
+    return f"""GET {requested_file} HTTP/1.1\r
+Host: {server_host}:{server_port}\r
+{extra}\r
+"""
+
 
+def send_file(client_socket, file):
+    """Sends the contents of a file over a socket.
 
-def send_200_response(header, filepath, filename, client_socket):
-    """Sends 200 response to client with an HTTP/1.1 header and file as body.
+    Uses `socket.sendfile`, which lets the kernel copy the file straight into
+    the socket (zero-copy) where `os.sendfile` is available, and falls back to
+    buffered sends otherwise.
 
     Args:
-        header: HTTP header
-        filepath: Path to file
-        filename: File name
         client_socket: Client socket instance
+        file: Path to file
 
     Returns:
-        None
+        Number of bytes sent
     """
-    client_socket.send(header.encode())
-    with open("./files/" + filepath + "/" + filename, "rb") as f:
-        while data := f.read(BUFFER_SIZE):
-            client_socket.send(data)
+    with open(file, "rb") as f:
+        return client_socket.sendfile(f)
 
 
-def main():
-    # Bind proxy to socket and listen for requests from client
-    proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    proxy_socket.bind((HOST, PORT))
-    proxy_socket.listen(1)
-    print(f"""Proxy listening on port {PORT}...""")
+def send_cached_response(file, client_socket, entry, cached=None,
+                         request_headers=None):
+    """Sends a cached file to the client.
 
+    The whole file is sent with 200, unless the request has a Range header
+    the file can satisfy, in which case only the requested byte ranges are
+    sent with 206 (see `ranges`), and a conditional request the cached copy
+    satisfies (If-None-Match or If-Modified-Since, see `validators`) is
+    answered with 304. Responses are marked `X-Cache: HIT`, so that
+    clients can tell them from responses fetched from the server, and carry
+    the Age of the cached copy. Sibling caches (see `fetch_from_siblings`)
+    are also sent its freshness, so that they keep their copy fresh for as
+    long as this one. The body is sent from memory if the object is held
+    there. Otherwise it is sent from disk, and promoted to the memory tier if
+    it is small enough.
+
+    The body on disk is opened before anything is sent, and stays readable
+    until it has been sent even if the file is replaced or evicted in the
+    meantime. If it was replaced or evicted since entry was looked up,
+    nothing is sent.
+
+    Args:
+        file: Cache key of the file, see get_cache_key()
+        client_socket: Client socket instance
+        entry: Entry of the file in the disk tier
+        cached: CachedObject from the memory tier, if any
+        request_headers: Header fields of the client request (lowercase
+            names)
+
+    Returns:
+        True if the response was sent, False if the body is no longer stored
+    """
+    if cached is not None:
+        return send_stored_response(
+            client_socket, entry, cached, None, request_headers)
+    f = disk_storage.open(entry)
+    if f is None:
+        return False
+    with f:
+        if memory_cache.admits(entry.size):
+            cached = memory.CachedObject(
+                entry.headers, f.read(), entry.freshness.stored_at)
+            memory_cache.put(file, *cached)
+        return send_stored_response(
+            client_socket, entry, cached, f, request_headers)
+
+
+def send_stored_response(client_socket, entry, cached, f, request_headers):
+    """Sends a cached file from memory or from its open body on disk.
+
+    See send_cached_response().
+
+    Args:
+        client_socket: Client socket instance
+        entry: Entry of the file in the disk tier
+        cached: CachedObject holding the body, or None to send it from f
+        f: File object holding the body, if cached is None
+        request_headers: Header fields of the client request (lowercase
+            names), or None
+
+    Returns:
+        True
+    """
+    size = entry.size if cached is None else len(cached.body)
+    stored = entry.freshness
+    fields = {
+        "Content-Length": size,
+        **(entry.headers if cached is None else cached.headers),
+        "Accept-Ranges": "bytes",
+        "Age": int(max(0, time.time() - stored.stored_at)),
+        "X-Cache": "HIT"
+    }
+    if is_only_if_cached(request_headers or {}):
+        fields["Cache-Control"] = (
+            f"max-age={int(stored.ttl)}, "
+            f"stale-while-revalidate={int(stored.stale_while_revalidate)}, "
+            f"stale-if-error={int(stored.stale_if_error)}")
+    if validators.is_not_modified(
+            request_headers or {}, entry.headers.get("ETag"),
+            validators.parse_date(entry.headers.get("Last-Modified"))):
+        # Content-Length still describes the file, but no body is sent
+        client_socket.sendall(
+            http.encode(build_header("304 Not Modified", fields)))
+        note_response(304, 0, "hit")
+        return True
+    status, parts = "200 OK", [(0, size)]
+    partial = ranges.get_partial_response(request_headers or {}, fields, size)
+    if partial is not None:
+        status, fields, parts = partial
+    header = http.encode(build_header(status, fields))
+    note_response(int(status[:3]), fields["Content-Length"], "hit")
+
+    if cached is not None:
+        body = memoryview(cached.body)
+        client_socket.sendall(header + b"".join(
+            part if isinstance(part, bytes)
+            else body[part[0]:part[0] + part[1]]
+            for part in parts
+        ))
+        return True
+    client_socket.sendall(header)
+    for part in parts:
+        if isinstance(part, bytes):
+            client_socket.sendall(part)
+        else:
+            client_socket.sendfile(f, *part)
+    return True
+
+
+def forward_response(response, server_socket, buffer, client_socket):
+    """Forwards a response from the server to the client unchanged.
+
+    Args:
+        response: http.Response read from the server
+        server_socket: Server socket instance
+        buffer: Body bytes already received with the response header
+        client_socket: Client socket instance
+
+    Returns:
+        True if the body was delimited by Content-Length, False if it ran until
+        the server closed the connection (in which case the client connection
+        must be closed as well).
+    """
+    length = http.get_body_length(
+        "GET", response.status_code, response.headers)
+    client_socket.send(response.header + b"\r\n\r\n")
+    note_response(response.status_code, length, "miss")
+    http.recv_body(server_socket, buffer, length, client_socket.sendall)
+    return length is not None
+
+
+def send_upstream(server_host, server_port, request):
+    """Sends a request to the server and reads the response header.
+
+    A pooled connection to the server is used if there is one. If the server
+    turns out to have closed it already, the request is sent again on a new
+    connection.
+
+    Failures to reach the server, and 503 responses, are recorded with
+    origin_breaker. While the server's circuit is open, no request is sent to
+    it at all.
+
+    Args:
+        server_host: Hostname of server
+        server_port: Port number of server
+        request: Request (str), including the terminating empty line
+
+    Returns:
+        Tuple of (server socket, http.Response, body bytes already received)
+
+    Raises:
+        OSError: If the server could not be reached or sent an invalid
+            response (breaker.CircuitOpenError if its circuit is open).
+    """
+    origin = (server_host, server_port)
+    origin_breaker.check(origin)
     while True:
-        # Make TCP connection with client
-        client_socket, client_address = proxy_socket.accept()
-
-        # Receive request from client
-        request = client_socket.recv(BUFFER_SIZE).decode()
-        split_request = request.split("\r\n")
-        request_info = split_request[0]
-        host_info = split_request[1]
-        _, host_info = host_info.split(' ')
-
-        requested_file = request_info.split(' ')[1]
-        server_host, server_port = host_info.split(':')
-        file = f"""{server_host}_{server_port}""" + requested_file
         try:
-            # Make TCP connection with server
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((server_host, int(server_port)))
-        except ConnectionRefusedError:
-            response_header = "HTTP/1.1 523 Origin Is Unreachable\r\n\r"
-            response_body = "files/errors/523.html"
-            client_socket.send(response_header.encode())
-            with open(response_body, "rb") as f:
-                while data := f.read(BUFFER_SIZE):
-                    client_socket.send(data)
-            client_socket.shutdown(socket.SHUT_WR)
-            sys.exit(1)
-        if os.path.isfile("files/" + file):
-            # File is cached, check if expired
-            current_t = time.time()
-            file_mt = os.path.getmtime("./files/" + file)
-            if current_t - file_mt > FILE_EXPIRE_TIME:
-                # File is expired, forward request to the server
-                server_socket.send(request.encode())
-
-                # Receive response
-                server_response_header = server_socket.recv(
-                    BUFFER_SIZE).decode()
-                status_code = get_status_code(server_response_header)
-                filepath, filename = file.rsplit('/', 1)
-                if status_code == 200:
-                    # Cache file and send response to client
-                    cache(filepath, filename, server_socket)
-                    send_200_response(
-                        server_response_header,
-                        filepath,
-                        filename,
-                        client_socket
-                    )
-                elif status_code == 404:
-                    # Remove file from cache, forward response to client
-                    os.remove("./files/" + file)
-                    if not os.listdir("./files/" + filepath):
-                        os.rmdir("./files/" + filepath)
-                    client_socket.send(server_response_header.encode())
-                    while data := server_socket.recv(BUFFER_SIZE):
-                        client_socket.send(data)
-                else:
-                    # Forward response to client
-                    client_socket.send(server_response_header.encode())
-                    while data := server_socket.recv(BUFFER_SIZE):
-                        client_socket.send(data)
-            else:
-                # File is not expired, send conditional GET
-                last_modified = datetime.strftime(
-                    datetime.fromtimestamp(file_mt),
-                    "%a, %w %b %Y %H:%M:%S"
-                )
-                conditional_get = f"""GET {requested_file} HTTP/1.1\r
-Host: {server_host}:{server_port}\r
-If-modified-since: {last_modified} GMT\r
-\r"""
-                server_socket.send(conditional_get.encode())
-
-                # Receive response
-                server_response_header = server_socket.recv(
-                    BUFFER_SIZE).decode()
-                status_code = get_status_code(server_response_header)
-                filepath, filename = file.rsplit('/', 1)
-                if status_code == 200:
-                    cache(filepath, filename, server_socket)
-
-                content_len = os.stat("./files/" + file).st_size
-                file_ext = file.rsplit('.', 1)
-                content_type = get_content_type(file_ext)
-                server_response_header = f"""HTTP/1.1 200 OK\r
-Content-Length: {content_len}\r
-Content-Type: {content_type}\r
-\r"""
-                send_200_response(
-                    server_response_header,
-                    filepath,
-                    filename,
-                    client_socket
-                )
-        else:
-            # File is not cached, forward request to the server
-            server_socket.send(request.encode())
-
-            # Receive response
-            server_response_header = server_socket.recv(BUFFER_SIZE).decode()
-            status_code = get_status_code(server_response_header)
-            if status_code == 200:
-                # Cache file and send response
-                filepath, filename = file.rsplit('/', 1)
-                cache(filepath, filename, server_socket)
-                send_200_response(
-                    server_response_header,
-                    filepath,
-                    filename,
-                    client_socket
-                )
+            server_socket, reused = connection_pool.acquire(
+                server_host, server_port)
+        except OSError:
+            origin_breaker.record_failure(origin)
+            raise
+        try:
+            server_socket.sendall(http.encode(request))
+            response, buffer = http.recv_response(server_socket)
+        except OSError:
+            server_socket.close()
+            if not reused:
+                origin_breaker.record_failure(origin)
+                raise
+            continue
+        except ValueError as err:
+            server_socket.close()
+            origin_breaker.record_failure(origin)
+            raise ConnectionError(f"Invalid response from server: {err}")
+        if response is not None:
+            if response.status_code == 503:
+                origin_breaker.record_failure(origin)
             else:
-                # Forward response to client
-                client_socket.send(server_response_header.encode())
-                while data := server_socket.recv(BUFFER_SIZE):
-                    client_socket.send(data)
+                origin_breaker.record_success(origin)
+            return server_socket, response, buffer
+        server_socket.close()
+        if not reused:
+            origin_breaker.record_failure(origin)
+            raise ConnectionError("Server closed the connection")
+
 
+def resume_fetch(server_host, server_port, requested_file, fields, offset,
+                 validator):
+    """Requests the rest of a file whose download was interrupted.
+
+    Args:
+        server_host: Hostname of server
+        server_port: Port number of server
+        requested_file: Requested path
+        fields: Header fields sent with the original request that the
+            response varies on
+        offset: Number of bytes already received
+        validator: ETag or Last-Modified of the original response, sent as
+            If-Range so that a changed file is not spliced onto the old one
+
+    Returns:
+        Tuple of (server socket, body bytes already received). The socket is
+        not pooled and must be closed by the caller.
+
+    Raises:
+        OSError: If the server could not be reached or did not send the
+            requested range.
+    """
+    fields = dict(fields, **{
+        "Range": f"bytes={offset}-",
+        "If-Range": validator
+    })
+    server_socket, response, buffer = send_upstream(
+        server_host, server_port,
+        build_conditional_get(
+            requested_file, server_host, server_port, None, fields))
+    if (response.status_code != 206 or not response.headers.get(
+            "content-range", "").startswith(f"bytes {offset}-")):
         server_socket.close()
-        client_socket.shutdown(socket.SHUT_WR)
+        raise ConnectionError("Server could not resume the download")
+    return server_socket, buffer
+
+
+def get_upstream_request(request):
+    """Returns a client request as it is forwarded to the server.
+
+    Args:
+        request: Request header (without the terminating empty line)
+
+    Returns:
+        Request (str), including the terminating empty line. The client's
+        Connection header only applies to its own connection, so it is left
+        out.
+    """
+    request_line, fields = http.split_header(request)
+    return f"{request_line}\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in fields
+        if name.lower() != "connection"
+    ) + "\r\n"
+
+
+def is_only_if_cached(request_headers):
+    """Returns whether a request may only be answered from the cache.
+
+    Sibling caches send `Cache-Control: only-if-cached`, so that they are
+    answered at once with `504 Gateway Timeout` if the file is not cached and
+    fresh, rather than have it fetched from the server.
+
+    Args:
+        request_headers: Header fields of the request (lowercase names)
+
+    Returns:
+        True if the request asks for only-if-cached
+    """
+    return "only-if-cached" in freshness.parse_cache_control(
+        request_headers.get("cache-control", ""))
+
+
+def send_not_cached(client_socket):
+    """Sends a 504 response to an only-if-cached request for a missing file.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    client_socket.send(http.encode(build_header(
+        "504 Gateway Timeout", {"Content-Length": 0})))
+    note_response(504, 0, "miss")
+
+
+def fetch_from_siblings(request):
+    """Asks the sibling caches for a file that is not cached.
+
+    The siblings are asked in turn, with `Cache-Control: only-if-cached` so
+    that a sibling without a fresh copy answers with 504 straight away
+    rather than fetching the file itself (which also means siblings never
+    ask each other in a loop). The client's conditions are not passed on,
+    as the body is needed for the cache. Siblings that keep failing are
+    skipped for a while, like origin servers (see `breaker`).
+
+    Args:
+        request: Request header (without the terminating empty line)
+
+    Returns:
+        Tuple of (sibling, server socket, http.Response, body bytes already
+        received) for the first sibling that sent the file, where sibling is
+        its (host, port), or None if none of them has it
+    """
+    request_line, fields = http.split_header(request)
+    sibling_request = f"{request_line}\r\n" + "".join(
+        f"{name}: {value}\r\n" for name, value in fields
+        if name.lower() not in (
+            "connection", "cache-control", "if-none-match",
+            "if-modified-since")
+    ) + "Cache-Control: only-if-cached\r\n\r\n"
+    for sibling in siblings:
+        try:
+            sibling_socket, response, buffer = send_upstream(
+                *sibling, sibling_request)
+        except OSError:
+            continue
+        if response.status_code == 200:
+            sibling_hits.inc()
+            return sibling, sibling_socket, response, buffer
+        length = http.get_body_length(
+            "GET", response.status_code, response.headers)
+        reusable = False
+        try:
+            http.recv_body(sibling_socket, buffer, length, lambda data: None)
+            reusable = length is not None and (
+                response.headers.get("connection", "").lower() != "close")
+        except OSError:
+            pass
+        finally:
+            connection_pool.release(*sibling, sibling_socket, reusable)
+    return None
+
+
+def send_unreachable(client_socket, err=None):
+    """Sends a 523 response, for when the server cannot be reached.
+
+    If the server was not contacted as its circuit is open, the response
+    tells the client when to try again (Retry-After).
+
+    Args:
+        client_socket: Client socket instance
+        err: Error raised by send_upstream(), if any
+
+    Returns:
+        None
+    """
+    response_body = "files/errors/523.html"
+    length = os.stat(response_body).st_size
+    fields = {
+        "Content-Length": length,
+        "Content-Type": "text/html",
+        "Connection": "close"
+    }
+    if isinstance(err, breaker.CircuitOpenError):
+        fields["Retry-After"] = math.ceil(err.retry_after)
+    client_socket.send(http.encode(build_header(
+        "523 Origin Is Unreachable", fields)))
+    note_response(523, length, "error")
+    send_file(client_socket, response_body)
+
+
+def send_bad_gateway(client_socket):
+    """Sends a 502 response, for a request that failed before its response.
+
+    Errors sending it are ignored, as the connection is closed anyway.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    note_response(502, 0, "error")
+    try:
+        client_socket.send(http.encode(build_header("502 Bad Gateway", {
+            "Content-Length": 0,
+            "Connection": "close"
+        })))
+    except OSError:
+        pass
+
+
+def send_unavailable(client_socket):
+    """Sends a 503 response, for when a cached file vanished mid-request.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        False, as the connection is closed
+    """
+    client_socket.send(http.encode(build_header("503 Service Unavailable", {
+        "Retry-After": admission.RETRY_AFTER,
+        "Content-Length": 0,
+        "Connection": "close"
+    })))
+    note_response(503, 0, "error")
+    return False
+
+
+def send_not_implemented(client_socket):
+    """Sends a 501 response, for requests with a method other than GET.
+
+    Any request body is not read, so the connection is closed rather than
+    read on for the next request.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        False, as the connection is closed
+    """
+    client_socket.send(http.encode(build_header("501 Not Implemented", {
+        "Content-Length": 0,
+        "Connection": "close"
+    })))
+    note_response(501, 0, "error")
+    return False
+
+
+def pass_through(client_socket, request, keep_alive, server_host,
+                 server_port):
+    """Forwards a request to the server and its response to the client.
+
+    Nothing is cached. Used for range requests for files that are not cached
+    yet, so that the client does not wait for the whole file, and for
+    requests that waited too long for another request's fetch of the file.
+
+    Args:
+        client_socket: Client socket instance
+        request: Request header (without the terminating empty line)
+        keep_alive: Whether the client asked to keep its connection open
+        server_host: Hostname of server
+        server_port: Port number of server
+
+    Returns:
+        True if the client connection may be kept open for another request,
+        False otherwise.
+    """
+    try:
+        server_socket, response, buffer = send_upstream(
+            server_host, server_port, get_upstream_request(request))
+    except OSError as err:
+        send_unreachable(client_socket, err)
+        return False
+    reusable = False
+    try:
+        delimited = forward_response(
+            response, server_socket, buffer, client_socket)
+        reusable = delimited and (
+            response.headers.get("connection", "").lower() != "close")
+    finally:
+        connection_pool.release(
+            server_host, server_port, server_socket, reusable)
+    return keep_alive and delimited
+
+
+def begin_fetch(file):
+    """Registers the caller as the one request fetching a file from the server.
+
+    Only one request per file goes to the server at a time. Other requests
+    for the same file wait for that fetch to finish and then use its result,
+    so a popular file that is missing or stale does not send a burst of
+    identical requests to the server.
+
+    Args:
+        file: Cache key of the file, see get_cache_key()
+
+    Returns:
+        Tuple of (fetch, is_fetching) where fetch is the threading.Event set
+        once the fetch is done. If is_fetching is True the caller is now
+        fetching the file and must call end_fetch() when done, otherwise it
+        should wait for fetch.
+    """
+    with in_flight_lock:
+        if file in in_flight:
+            return in_flight[file], False
+        fetch = in_flight[file] = threading.Event()
+        return fetch, True
+
+
+def end_fetch(file, fetch):
+    """Marks the fetch of a file as done and wakes up any waiting requests.
+
+    Calling it again for the same fetch has no effect.
+
+    Args:
+        file: Cache key of the file, see get_cache_key()
+        fetch: threading.Event returned by begin_fetch()
+
+    Returns:
+        None
+    """
+    with in_flight_lock:
+        if in_flight.get(file) is fetch:
+            del in_flight[file]
+    fetch.set()
+
+
+def revalidate(server_host, server_port, requested_file, file,
+               stored_headers, request_headers, fetch):
+    """Revalidates (or fetches) a cached file in the background.
+
+    Used to refresh a stale file that is being served under
+    stale-while-revalidate, and to fill the cache with the whole of a file
+    that was asked for in part (see `pass_through`). A 200 response replaces
+    the cached copy and a 304 response marks it as fresh again. Anything else
+    leaves it as it is. The caller must have registered the fetch with
+    begin_fetch().
+
+    Args:
+        server_host: Hostname of server
+        server_port: Port number of server
+        requested_file: Requested path
+        file: Cache key of the file
+        stored_headers: Header fields stored with the cached copy (with its
+            validators), or None if the file is not cached
+        request_headers: Header fields of the client request that found the
+            file stale or missing (lowercase names)
+        fetch: threading.Event returned by begin_fetch()
+
+    Returns:
+        None
+    """
+    base_file = vary.get_base_key(file)
+    fields = vary.get_request_fields(
+        vary_fields.get(base_file, []), request_headers)
+    try:
+        server_socket, response, buffer = send_upstream(
+            server_host,
+            server_port,
+            build_conditional_get(
+                requested_file, server_host, server_port, stored_headers,
+                fields)
+        )
+    except OSError:
+        end_fetch(file, fetch)
+        return
+
+    status_code, response_headers = response.status_code, response.headers
+    length = http.get_body_length("GET", status_code, response_headers)
+    reusable = False
+    try:
+        # Keyed on the fields that were actually sent
+        sent_headers = {name.lower(): value for name, value in fields.items()}
+        if status_code == 200 and (key := store_vary(
+                base_file, response_headers, sent_headers)) is not None:
+            cache(key, server_socket, buffer, length, response_headers,
+                  resume=functools.partial(
+                      resume_fetch, server_host, server_port,
+                      requested_file, fields))
+        else:
+            http.recv_body(server_socket, buffer, length, lambda data: None)
+            if status_code == 304:
+                disk_storage.update_freshness(
+                    file, get_response_freshness(response_headers))
+        reusable = (
+            length is not None
+            and server_socket.fileno() != -1
+            and response_headers.get("connection", "").lower() != "close"
+        )
+    except OSError:
+        pass
+    finally:
+        connection_pool.release(
+            server_host, server_port, server_socket, reusable)
+        end_fetch(file, fetch)
+
+
+def handle_request(client_socket, request):
+    """Answers a single client request, from cache or from the server.
+
+    A fresh cached file is sent without contacting the server. A stale one is
+    revalidated with a conditional GET first, unless it may be served while
+    being revalidated in the background (stale-while-revalidate). If the
+    server cannot be reached or returns a server error while revalidating, a
+    stale file may still be served (stale-if-error).
+
+    A range request for a file that is not cached is passed through to the
+    server, while the whole file is fetched into the cache in the background
+    so that later range requests are served from it.
+
+    Requests with `Cache-Control: only-if-cached` (e.g. from sibling caches)
+    are answered with 504 unless the file is cached and fresh.
+
+    Only GET requests are served, as the origin servers only implement GET.
+    Any other method is answered with 501 and the connection is closed,
+    without reading or forwarding a request body.
+
+    Args:
+        client_socket: Client socket instance
+        request: Request header (without the terminating empty line)
+
+    Returns:
+        True if the client connection may be kept open for another request,
+        False otherwise.
+
+    Raises:
+        ValueError: If the request is malformed or has no valid Host header.
+    """
+    method, requested_file, _, headers = http.parse_request(request)
+    if method != "GET":
+        return send_not_implemented(client_socket)
+    keep_alive = headers.get("connection", "").lower() != "close"
+    server_host, _, server_port = headers.get("host", "").partition(':')
+    server_port = int(server_port)
+    base_file = f"""{server_host}_{server_port}""" + requested_file
+    only_if_cached = is_only_if_cached(headers)
+    popularity.record(
+        get_cache_key(base_file, headers),
+        refresh.Target(server_host, server_port, requested_file, headers))
+
+    arrived_at = time.time()
+    while True:
+        # Looked up again every time, as the fetch waited for may have found
+        # that the file varies on request headers
+        file = get_cache_key(base_file, headers)
+        entry = disk_storage.lookup(file)
+        # Memory is looked up even if the file is not on disk, so that every
+        # lookup counts as a memory hit or miss
+        cached = memory_cache.get(file)
+        if entry is None:
+            # Only objects with an index entry are served from memory
+            cached = None
+        if only_if_cached and (entry is None or not freshness.is_fresh(
+                entry.freshness, time.time())):
+            send_not_cached(client_socket)
+            return keep_alive
+        if entry is not None:
+            # File is cached, check if it is still fresh
+            current_t = time.time()
+            stored = entry.freshness
+            if (freshness.is_fresh(stored, current_t)
+                    or stored.stored_at >= arrived_at):
+                # Fresh, or fetched from the server by another request since
+                # this one arrived
+                if send_cached_response(
+                        file, client_socket, entry, cached, headers):
+                    return keep_alive
+                # Replaced or evicted since it was looked up
+                continue
+            if freshness.can_serve_while_revalidating(stored, current_t):
+                fetch, is_fetching = begin_fetch(file)
+                if is_fetching:
+                    threading.Thread(
+                        target=revalidate,
+                        args=(server_host, server_port, requested_file, file,
+                              entry.headers, headers, fetch),
+                        daemon=True
+                    ).start()
+                if send_cached_response(
+                        file, client_socket, entry, cached, headers):
+                    return keep_alive
+                continue
+        elif "range" in headers:
+            fetch, is_fetching = begin_fetch(file)
+            if is_fetching:
+                threading.Thread(
+                    target=revalidate,
+                    args=(server_host, server_port, requested_file, file,
+                          None, headers, fetch),
+                    daemon=True
+                ).start()
+            return pass_through(
+                client_socket, request, keep_alive, server_host, server_port)
+        fetch, is_fetching = begin_fetch(file)
+        if is_fetching:
+            break
+        # Another request is already fetching this file from the server,
+        # wait for it and look the file up again
+        if not fetch.wait(FETCH_WAIT_TIMEOUT):
+            # Still not stored (e.g. a large file from a slow server), so
+            # the file is fetched for this client alone
+            return pass_through(
+                client_socket, request, keep_alive, server_host, server_port)
+
+    try:
+        return fetch_from_server(
+            client_socket, request, headers, keep_alive, server_host,
+            server_port, requested_file, file, entry, cached, fetch)
+    finally:
+        end_fetch(file, fetch)
+
+
+def fetch_from_server(client_socket, request, request_headers, keep_alive,
+                      server_host, server_port, requested_file, file, entry,
+                      cached, fetch):
+    """Answers a request for a file that is missing or stale in the cache.
+
+    The caller must have registered the fetch with begin_fetch(). Requests
+    waiting on it are woken up as soon as the cache has been updated, rather
+    than once the response has been sent to this client. A file that is not
+    cached at all is asked of the sibling caches before the server.
+
+    Args:
+        client_socket: Client socket instance
+        request: Request header (without the terminating empty line)
+        request_headers: Header fields of the request (lowercase names)
+        keep_alive: Whether the client asked to keep its connection open
+        server_host: Hostname of server
+        server_port: Port number of server
+        requested_file: Requested path
+        file: Cache key of the file
+        entry: Entry of the (stale) file in the disk tier, or None if the
+            file is not cached
+        cached: CachedObject from the memory tier, if any
+        fetch: threading.Event returned by begin_fetch()
+
+    Returns:
+        True if the client connection may be kept open for another request,
+        False otherwise.
+    """
+    base_file = vary.get_base_key(file)
+    is_cached = entry is not None
+    current_t = time.time()
+    if is_cached:
+        # File is stale, send conditional GET
+        stored = entry.freshness
+        upstream_request = build_conditional_get(
+            requested_file, server_host, server_port, entry.headers,
+            vary.get_request_fields(
+                vary_fields.get(base_file, []), request_headers))
+    else:
+        # File is not cached, forward request to the server
+        upstream_request = get_upstream_request(request)
+
+    found = None
+    if not is_cached and siblings:
+        found = fetch_from_siblings(request)
+    if found is not None:
+        upstream, server_socket, response, buffer = found
+    else:
+        upstream = (server_host, server_port)
+        try:
+            server_socket, response, buffer = send_upstream(
+                server_host, server_port, upstream_request)
+        except OSError as err:
+            if is_cached and freshness.can_serve_on_error(
+                    stored, current_t) and send_cached_response(
+                    file, client_socket, entry, cached, request_headers):
+                return keep_alive
+            send_unreachable(client_socket, err)
+            return False
+
+    # Receive response
+    status_code, response_headers = response.status_code, response.headers
+    length = http.get_body_length("GET", status_code, response_headers)
+    reusable = False
+    try:
+        if status_code == 200 and (key := store_vary(
+                base_file, response_headers, request_headers)) is not None:
+            # Cache file while streaming the response to the client
+            fields = vary.get_request_fields(
+                vary_fields.get(base_file, []), request_headers)
+            cache(
+                key,
+                server_socket,
+                buffer,
+                length,
+                response_headers,
+                client_socket,
+                functools.partial(resume_fetch, server_host, server_port,
+                                  requested_file, fields),
+                functools.partial(end_fetch, file, fetch)
+            )
+            keep_alive &= length is not None
+        elif is_cached and (
+            status_code == 304
+            or status_code >= 500
+            and freshness.can_serve_on_error(stored, current_t)
+        ):
+            # Cached copy is still valid (or may be served in place of a
+            # server error), discard the server's response body
+            http.recv_body(server_socket, buffer, length, lambda data: None)
+            if status_code == 304:
+                disk_storage.update_freshness(
+                    file, get_response_freshness(response_headers))
+            end_fetch(file, fetch)
+            if not send_cached_response(
+                    file, client_socket, entry, cached, request_headers):
+                # Evicted while it was being revalidated
+                keep_alive = send_unavailable(client_socket)
+        else:
+            if status_code == 404 and is_cached:
+                remove_cached(file)
+            # Forward response to client
+            keep_alive &= forward_response(
+                response,
+                server_socket,
+                buffer,
+                client_socket
+            )
+        # The whole response has been read, so the connection can carry
+        # another request unless the server is closing it
+        reusable = (
+            length is not None
+            and server_socket.fileno() != -1
+            and response_headers.get("connection", "").lower() != "close"
+        )
+    finally:
+        connection_pool.release(*upstream, server_socket, reusable)
+    return keep_alive
+
+
+def note_response(status_code, length, result):
+    """Notes the response being sent for the request of the current thread.
+
+    Called wherever a response header is sent to the client, so that
+    record_request() can account for it.
+
+    Args:
+        status_code: Status code of the response (int)
+        length: Length of the response body in bytes, or None if unknown
+        result: "hit" if the response was served from the cache, "miss" if
+            it came from the server, "error" if the server was unreachable or
+            the request was invalid
+
+    Returns:
+        None
+    """
+    exchange.status_code = status_code
+    exchange.length = length
+    exchange.result = result
+
+
+def record_request(client, request, started, error=None):
+    """Updates the metrics and the access log once a request is answered.
+
+    Args:
+        client: Address of the client ("<host>:<port>")
+        request: Request header (without the terminating empty line)
+        started: time.perf_counter() when the request was received
+        error: Error that cut the exchange short, if any, added to the
+            access log
+
+    Returns:
+        None
+    """
+    status_code = exchange.status_code
+    if status_code is None:
+        return
+    duration = time.perf_counter() - started
+    length = exchange.length or 0
+    if status_code == 304:
+        length = 0
+    requests_total.inc(labels=(str(status_code), exchange.result))
+    request_duration.observe(duration, labels=(exchange.result,))
+    response_bytes.inc(length)
+    if access_log is not None:
+        request_line, headers = http.parse_header(request)
+        method, path = (request_line.split(' ') + [None])[:2]
+        fields = {} if error is None else {"error": error}
+        access_log.log(
+            client=client,
+            method=method,
+            host=headers.get("host"),
+            path=path,
+            status=status_code,
+            bytes=length,
+            cache=exchange.result,
+            duration_ms=round(duration * 1000, 3),
+            **fields
+        )
+
+
+def handle_client(client_socket):
+    """Serves a single client connection.
+
+    Runs on its own thread. The connection is kept alive and requests are
+    answered in the order they arrive (so pipelined requests are supported)
+    until the client closes it, asks for `Connection: close`, stays idle
+    for longer than KEEP_ALIVE_TIMEOUT, or a request fails with an OSError
+    (e.g. the disk is full, or the client went away mid-response). Such a
+    request is answered with 502 if its response had not started yet, and
+    the error is written to the access log. Once the first byte of a
+    request has arrived, the whole request header must arrive within
+    admission.REQUEST_TIMEOUT, and the client must read each response in
+    the time admission.DeadlineSocket gives it. The connection's slot in
+    connection_limit is released when it is closed.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    with client_socket:
+        client_socket.settimeout(KEEP_ALIVE_TIMEOUT)
+        client_socket = admission.DeadlineSocket(client_socket)
+        buffer = b""
+        keep_alive = True
+        active_connections.inc()
+        try:
+            client = "%s:%d" % client_socket.getpeername()[:2]
+            while keep_alive:
+                # Receive request from client
+                request, buffer = http.recv_header(
+                    client_socket, buffer,
+                    timeout=admission.REQUEST_TIMEOUT)
+                if request is None:
+                    break
+                started = time.perf_counter()
+                client_socket.start_response()
+                exchange.status_code = None
+                try:
+                    keep_alive = handle_request(client_socket, request)
+                except ValueError:
+                    if exchange.status_code is not None:
+                        # The response had already started
+                        raise
+                    client_socket.send(http.encode(build_header(
+                        "400 Bad Request",
+                        {"Content-Length": 0, "Connection": "close"}
+                    )))
+                    note_response(400, 0, "error")
+                    keep_alive = False
+                except OSError as err:
+                    if exchange.status_code is None:
+                        send_bad_gateway(client_socket)
+                    record_request(client, request, started,
+                                   f"{type(err).__name__}: {err}")
+                    break
+                record_request(client, request, started)
+        except (OSError, ValueError):
+            # Includes timeouts and connections reset by the client
+            pass
+        finally:
+            active_connections.dec()
+            connection_limit.release()
+
+
+def reap_connections():
+    """Periodically closes pooled connections that have been idle too long.
+
+    Returns:
+        None
+    """
+    while True:
+        time.sleep(connection_pool.idle_timeout)
+        connection_pool.reap()
+
+
+def prefetch(target, file, reason):
+    """Fetches a file into the cache in the background, ahead of requests.
+
+    Nothing is done if the file is being fetched already. Otherwise, waits
+    for refresh_limiter before starting the fetch.
+
+    Args:
+        target: refresh.Target to request
+        file: Cache key of the file
+        reason: Why the file is fetched ("warm" or "refresh"), for the
+            metrics
+
+    Returns:
+        None
+    """
+    refresh_limiter.acquire()
+    entry = disk_storage.lookup(file)
+    fetch, is_fetching = begin_fetch(file)
+    if not is_fetching:
+        return
+    refreshes_total.inc(labels=(reason,))
+    threading.Thread(
+        target=revalidate,
+        args=(target.host, target.port, target.path, file,
+              entry.headers if entry is not None else None,
+              target.headers, fetch),
+        daemon=True
+    ).start()
+
+
+def warm(filename):
+    """Fetches the files of a warm list into the cache.
+
+    Files that are cached and fresh already are skipped. The files are
+    counted as requested as many times as they are listed, so that the most
+    popular of them are then kept fresh (see `refresh_popular`).
+
+    Args:
+        filename: Path to a warm list, see `refresh`
+
+    Returns:
+        None
+    """
+    try:
+        objects = refresh.read_warm_list(filename)
+    except OSError as err:
+        print(f"Cannot read warm list: {err}")
+        return
+    for (host, port, path), count in objects:
+        target = refresh.Target(host, port, path, {})
+        file = get_cache_key(f"{host}_{port}{path}", target.headers)
+        popularity.record(file, target, count)
+        entry = disk_storage.lookup(file)
+        if entry is None or not freshness.is_fresh(
+                entry.freshness, time.time()):
+            prefetch(target, file, "warm")
+    print(f"Warmed the cache with {len(objects)} objects from {filename}")
+
+
+def refresh_popular(top_k):
+    """Periodically refreshes the most popular files before they expire.
+
+    Files that are not cached (any more) are left to be fetched by the next
+    request for them.
+
+    Args:
+        top_k: Number of most popular files kept fresh
+
+    Returns:
+        None
+    """
+    while True:
+        time.sleep(refresh.REFRESH_INTERVAL)
+        for file, target in popularity.top(top_k):
+            entry = disk_storage.lookup(file)
+            if entry is not None and refresh.is_due(
+                    entry.freshness, time.time()):
+                prefetch(target, file, "refresh")
+
+
+def get_addresses(host):
+    """Returns the IP addresses a host name stands for.
+
+    Args:
+        host: Host name or IP address
+
+    Returns:
+        Set of IP addresses (str), or {host} if it could not be resolved
+    """
+    try:
+        return {info[4][0] for info in socket.getaddrinfo(
+            host, None, type=socket.SOCK_STREAM)}
+    except OSError:
+        return {host}
+
+
+def get_own_addresses():
+    """Returns the IP addresses the proxy can be reached at.
+
+    Returns:
+        Set of IP addresses (str) of HOST, or of the loopback interface and
+        this machine's host name if HOST stands for every interface
+    """
+    if HOST in ("", "0.0.0.0", "::"):
+        return get_addresses("localhost") | get_addresses(socket.gethostname())
+    return get_addresses(HOST)
+
+
+def main(memory_size=DEFAULT_MEMORY_SIZE, pool_size=DEFAULT_POOL_SIZE,
+         ttl=DEFAULT_TTL, swr=DEFAULT_STALE_WHILE_REVALIDATE,
+         sie=DEFAULT_STALE_IF_ERROR, disk_size=DEFAULT_DISK_SIZE,
+         metrics_port=None, access_log_path=None,
+         max_connections=admission.DEFAULT_MAX_CONNECTIONS,
+         backlog=DEFAULT_BACKLOG, warm_path=None,
+         refresh_top_k=refresh.DEFAULT_TOP_K,
+         refresh_rate=refresh.DEFAULT_REFRESH_RATE, sibling_caches=()):
+    """Main function of the script.
+
+    The metrics of the cache are served on a port of their own rather than
+    on a path of PORT, as every path of PORT is passed on to origin servers.
+
+    Up to max_connections client connections are served at once, and any
+    more are answered with `503 Service Unavailable` and Retry-After (see
+    `admission`). An origin server that fails
+    breaker.DEFAULT_FAILURE_THRESHOLD requests in a row is left alone for
+    breaker.DEFAULT_RESET_TIMEOUT seconds (see `breaker`), during which its
+    files are served stale if allowed, or answered with 523 at once.
+
+    The refresh_top_k most requested files are revalidated shortly before
+    they expire, and the files of warm_path are fetched at startup, both at
+    no more than refresh_rate fetches per second (see `refresh`).
+
+    Files that are not cached are asked of sibling_caches before the origin
+    server (see `fetch_from_siblings`), so that a group of proxies fetches
+    each file from the server about once. The proxy itself may be listed
+    (under any name or address of HOST), so that every proxy of a group can
+    be given the same list.
+
+    Args:
+        memory_size: Byte budget of the in-memory tier
+        pool_size: Maximum number of idle connections kept per origin
+        ttl: Freshness lifetime (seconds) of responses without Cache-Control
+            or Expires headers
+        swr: Default stale-while-revalidate window (seconds)
+        sie: Default stale-if-error window (seconds)
+        disk_size: Byte budget of the disk tier
+        metrics_port: Port to serve the metrics on (see `metrics`), 0 for
+            none, or None for METRICS_PORT
+        access_log_path: Path of the access log (see `accesslog`), "-" for
+            standard output, or None for no access log
+        max_connections: Maximum number of client connections served at once
+        backlog: Maximum number of connections waiting to be accepted
+        warm_path: Path of a list of files to fetch into the cache at
+            startup (see `refresh`), or None for none
+        refresh_top_k: Number of most popular files kept fresh, 0 for none
+        refresh_rate: Most files fetched ahead of requests per second
+        sibling_caches: (host, port) of every sibling cache
+
+    Returns:
+        None
+    """
+    global disk_storage, memory_cache, connection_pool, access_log
+    global origin_breaker, connection_limit, popularity, refresh_limiter
+    global siblings
+    global default_ttl, stale_while_revalidate, stale_if_error
+    default_ttl = ttl
+    stale_while_revalidate = swr
+    stale_if_error = sie
+    memory_cache = memory.MemoryCache(memory_size)
+    # Objects evicted from disk are dropped from memory too, so that the
+    # memory tier only holds objects with an index entry
+    disk_storage = storage.DiskStorage(
+        "./files", disk_size, on_evict=memory_cache.remove)
+    for entry in disk_storage.entries():
+        if "Vary" in entry.headers:
+            vary_fields[vary.get_base_key(entry.key)] = vary.parse_vary(
+                entry.headers["Vary"])
+    connection_pool = pool.ConnectionPool(
+        pool_size, POOL_IDLE_TIMEOUT, ORIGIN_TIMEOUT, ORIGIN_TIMEOUT)
+    origin_breaker = breaker.CircuitBreaker()
+    connection_limit = admission.ConnectionLimit(max_connections)
+    own_addresses = get_own_addresses()
+    siblings = [
+        (host, port) for host, port in sibling_caches
+        if port != PORT or not get_addresses(host) & own_addresses
+    ]
+    popularity = refresh.Popularity()
+    refresh_limiter = refresh.RateLimiter(refresh_rate)
+    if refresh_top_k:
+        threading.Thread(
+            target=refresh_popular, args=(refresh_top_k,), daemon=True
+        ).start()
+    if warm_path is not None:
+        threading.Thread(target=warm, args=(warm_path,), daemon=True).start()
+    threading.Thread(target=reap_connections, daemon=True).start()
+    if access_log_path is not None:
+        access_log = accesslog.AccessLog(access_log_path)
+    if metrics_port is None:
+        metrics_port = METRICS_PORT
+    if metrics_port:
+        metrics.start(HOST, metrics_port)
+        print(f"""Metrics served on port {metrics_port}...""")
+
+    # Bind proxy to socket and listen for requests from client
+    proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    proxy_socket.bind((HOST, PORT))
+    proxy_socket.listen(backlog)
+    print(f"""Proxy listening on port {PORT}...""")
+    if siblings:
+        print("Sibling caches:", ", ".join(
+            f"{host}:{port}" for host, port in siblings))
+
+    try:
+        while True:
+            # Make TCP connection with client
+            client_socket, client_address = proxy_socket.accept()
+            if not connection_limit.admit():
+                admission.reject(client_socket)
+                continue
+            try:
+                threading.Thread(
+                    target=handle_client,
+                    args=(client_socket,),
+                    daemon=True
+                ).start()
+            except RuntimeError:
+                # No more threads can be started
+                connection_limit.release()
+                admission.reject(client_socket)
+    except KeyboardInterrupt:
+        disk_storage.close()
+        print("Disk storage:", disk_storage.stats())
+        print("Memory cache:", memory_cache.stats())
+        print("Connection pool:", connection_pool.stats())
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        memory_size = DEFAULT_MEMORY_SIZE
+        pool_size = DEFAULT_POOL_SIZE
+        ttl = DEFAULT_TTL
+        swr = DEFAULT_STALE_WHILE_REVALIDATE
+        sie = DEFAULT_STALE_IF_ERROR
+        disk_size = DEFAULT_DISK_SIZE
+        metrics_port = METRICS_PORT
+        access_log_path = None
+        max_connections = admission.DEFAULT_MAX_CONNECTIONS
+        backlog = DEFAULT_BACKLOG
+        warm_path = None
+        refresh_top_k = refresh.DEFAULT_TOP_K
+        refresh_rate = refresh.DEFAULT_REFRESH_RATE
+        sibling_args = []
+        args = sys.argv[1:]
+        for arg in args:
+            split_arg = arg.split('=')
+            if split_arg[0] == 'HOST':
+                HOST = split_arg[1]
+            elif split_arg[0] == 'PORT':
+                PORT = int(split_arg[1])
+            elif split_arg[0] == 'MEMORY_SIZE':
+                memory_size = int(split_arg[1])
+            elif split_arg[0] == 'POOL_SIZE':
+                pool_size = int(split_arg[1])
+            elif split_arg[0] == 'TTL':
+                ttl = int(split_arg[1])
+            elif split_arg[0] == 'STALE_WHILE_REVALIDATE':
+                swr = int(split_arg[1])
+            elif split_arg[0] == 'STALE_IF_ERROR':
+                sie = int(split_arg[1])
+            elif split_arg[0] == 'DISK_SIZE':
+                disk_size = int(split_arg[1])
+            elif split_arg[0] == 'METRICS_PORT':
+                metrics_port = int(split_arg[1])
+            elif split_arg[0] == 'ACCESS_LOG':
+                access_log_path = split_arg[1]
+            elif split_arg[0] == 'MAX_CONNECTIONS':
+                max_connections = int(split_arg[1])
+                if max_connections < 1:
+                    raise ValueError('MAX_CONNECTIONS must be at least 1')
+            elif split_arg[0] == 'BACKLOG':
+                backlog = int(split_arg[1])
+            elif split_arg[0] == 'WARM':
+                warm_path = split_arg[1]
+            elif split_arg[0] == 'REFRESH_TOP_K':
+                refresh_top_k = int(split_arg[1])
+            elif split_arg[0] == 'SIBLINGS':
+                sibling_args = split_arg[1].split(',')
+            elif split_arg[0] == 'REFRESH_RATE':
+                refresh_rate = float(split_arg[1])
+                if refresh_rate <= 0:
+                    raise ValueError('REFRESH_RATE must be positive')
+            else:
+                raise ValueError(f'incorrect argument: {split_arg[0]}')
+        # Siblings without a port listen on the same port as this proxy,
+        # whatever order PORT and SIBLINGS were given in
+        sibling_caches = []
+        for sibling in sibling_args:
+            host, _, port = sibling.strip().partition(':')
+            if not host:
+                raise ValueError(f'invalid sibling: {sibling!r}')
+            sibling_caches.append((host, int(port or PORT)))
+        main(memory_size, pool_size, ttl, swr, sie, disk_size, metrics_port,
+             access_log_path, max_connections, backlog, warm_path,
+             refresh_top_k, refresh_rate, sibling_caches)
+    except ValueError as err:
+        print('ValueError:', err)
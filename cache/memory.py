@@ -0,0 +1,150 @@
+"""Memory Cache
+
+In-memory tier of the cache proxy. Holds the most recently used objects
+(response header fields plus body) so that hot objects can be served without
+touching the disk.
+
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+
+CachedObject = namedtuple("CachedObject", ["headers", "body", "stored_at"])
+
+
+def get_object_size(headers, body):
+    """Returns the number of bytes an object is charged against the budget.
+
+    Args:
+        headers: Dictionary of header field names to values
+        body: Response body (bytes)
+
+    Returns:
+        Size of the object in bytes
+    """
+    return len(body) + sum(
+        len(name) + len(str(value)) for name, value in headers.items())
+
+
+class MemoryCache:
+    """Least-recently-used object cache bounded by a total byte budget.
+
+    Objects evicted from memory are simply dropped: every object is also
+    written to the disk tier, so an evicted object is demoted to being served
+    from disk until it is requested again.
+
+    Attributes:
+        max_size: Byte budget shared by all objects
+        max_object_size: Largest object (in bytes) that will be held
+        size: Bytes currently held
+        hits: Number of lookups answered from memory
+        misses: Number of lookups not found in memory
+        evictions: Number of objects evicted to stay within the budget
+    """
+
+    def __init__(self, max_size, max_object_size=None):
+        """
+        Args:
+            max_size: Byte budget shared by all objects
+            max_object_size: Largest object (in bytes) that will be held.
+                Defaults to a quarter of max_size, so that a single large
+                object cannot flush the whole hot set.
+        """
+        self.max_size = max_size
+        if max_object_size is None:
+            max_object_size = max_size // 4
+        self.max_object_size = max_object_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._objects = OrderedDict()
+        self._lock = threading.Lock()
+
+    def admits(self, length):
+        """Returns whether an object with a body of `length` bytes may be held.
+
+        Args:
+            length: Length of the body in bytes, or None if unknown
+
+        Returns:
+            True if the object is small enough to be held in memory
+        """
+        return length is not None and length <= self.max_object_size
+
+    def get(self, key):
+        """Looks up an object and marks it as most recently used.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            CachedObject, or None if the object is not held in memory
+        """
+        with self._lock:
+            cached = self._objects.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._objects.move_to_end(key)
+            self.hits += 1
+            return cached
+
+    def put(self, key, headers, body, stored_at):
+        """Stores an object, evicting least recently used objects as needed.
+
+        Objects larger than max_object_size are not stored (and any older
+        copy is removed).
+
+        Args:
+            key: Cache key
+            headers: Dictionary of header field names to values
+            body: Response body (bytes)
+            stored_at: Time the object was stored (seconds since the epoch)
+
+        Returns:
+            None
+        """
+        size = get_object_size(headers, body)
+        with self._lock:
+            self._discard(key)
+            if len(body) > self.max_object_size or size > self.max_size:
+                return
+            while self.size + size > self.max_size:
+                _, evicted = self._objects.popitem(last=False)
+                self.size -= get_object_size(evicted.headers, evicted.body)
+                self.evictions += 1
+            self._objects[key] = CachedObject(headers, bytes(body), stored_at)
+            self.size += size
+
+    def remove(self, key):
+        """Removes an object if it is held in memory.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._discard(key)
+
+    def stats(self):
+        """Returns the cache counters.
+
+        Returns:
+            Dictionary of counter names to values
+        """
+        with self._lock:
+            return {
+                "objects": len(self._objects),
+                "size": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _discard(self, key):
+        cached = self._objects.pop(key, None)
+        if cached is not None:
+            self.size -= get_object_size(cached.headers, cached.body)
@@ -0,0 +1,222 @@
+"""Refresh
+
+Cache warming and predictive refresh for the cache proxy. Requests are
+counted per cache key, with counts that decay over time so that what is
+popular now outweighs what was popular an hour ago. A background refresher
+revalidates the most popular objects shortly before they expire, so that hot
+objects are never found stale on the request path, and a list of URLs (or an
+access log) can be fetched into the cache at startup. Both are paced by a
+shared rate limit so that they do not swamp the origin servers.
+
+Warm lists hold one object per line, either as a URL
+(`http://localhost:8000/index.html` or `localhost:8000/index.html`) or as a
+JSON object with `host` and `path` (so the proxy's own access log can be
+replayed). Objects listed more than once are warmed first.
+
+"""
+
+import heapq
+import json
+import threading
+import time
+from collections import Counter, namedtuple
+
+DEFAULT_TOP_K = 100  # most popular objects kept fresh, 0 for none
+DEFAULT_REFRESH_RATE = 10.0  # refreshes (and warm-up fetches) per second
+REFRESH_INTERVAL = 1.0  # seconds between looks at the most popular objects
+REFRESH_AHEAD = 0.1  # fraction of its lifetime before expiry an object is
+# refreshed
+MIN_REFRESH_AHEAD = 2.0  # seconds
+MIN_TTL = 5.0  # seconds, objects fresh for less are not refreshed ahead
+HALF_LIFE = 300.0  # seconds for a request to count half as much
+MAX_KEYS = 10000  # keys tracked before the least popular are forgotten
+
+# What to request from the origin to refresh a cache key: the origin, the
+# path and the header fields of a request for it (lowercase names)
+Target = namedtuple("Target", ["host", "port", "path", "headers"])
+
+
+class Popularity:
+    """Decaying request counts per cache key.
+
+    Each request adds a weight that doubles every half_life seconds, which
+    ranks keys exactly as if every count were halved every half_life
+    seconds, without having to touch them.
+
+    Attributes:
+        half_life: Seconds after which a request counts half as much
+        max_keys: Number of keys tracked before the least popular half is
+            forgotten
+    """
+
+    def __init__(self, half_life=HALF_LIFE, max_keys=MAX_KEYS):
+        """
+        Args:
+            half_life: Seconds after which a request counts half as much
+            max_keys: Number of keys tracked before the least popular half
+                is forgotten
+        """
+        self.half_life = half_life
+        self.max_keys = max_keys
+        self._scores = {}  # key -> [score, Target]
+        self._epoch = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, key, target, count=1):
+        """Counts requests for a cache key.
+
+        Args:
+            key: Cache key requested
+            target: Target to request to refresh the key
+            count: Number of requests
+
+        Returns:
+            None
+        """
+        with self._lock:
+            exponent = (time.monotonic() - self._epoch) / self.half_life
+            if exponent > 64:
+                # Rescale before the weights grow too large for a float
+                factor = 2 ** -exponent
+                for score in self._scores.values():
+                    score[0] *= factor
+                self._epoch = time.monotonic()
+                exponent = 0
+            score = self._scores.get(key)
+            if score is None:
+                if len(self._scores) >= self.max_keys:
+                    self._forget()
+                score = self._scores[key] = [0.0, target]
+            score[0] += count * 2 ** exponent
+            score[1] = target
+
+    def top(self, k):
+        """Returns the k most popular cache keys.
+
+        Args:
+            k: Number of keys
+
+        Returns:
+            List of (key, Target) tuples, most popular first
+        """
+        with self._lock:
+            top = heapq.nlargest(
+                k, self._scores.items(), key=lambda item: item[1][0])
+        return [(key, target) for key, (_, target) in top]
+
+    def _forget(self):
+        """Forgets the least popular half of the keys (lock held)."""
+        kept = heapq.nlargest(
+            self.max_keys // 2, self._scores.items(),
+            key=lambda item: item[1][0])
+        self._scores = dict(kept)
+
+
+class RateLimiter:
+    """Token bucket limiting how often something is done.
+
+    Attributes:
+        rate: Tokens added per second
+        burst: Most tokens held at once
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Most tokens held at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, waiting for one if there is none.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def is_due(freshness, now):
+    """Returns whether a cached object should be refreshed ahead of expiry.
+
+    Args:
+        freshness: freshness.Freshness of the cached object
+        now: Current time (seconds since the epoch)
+
+    Returns:
+        True if the object expires within REFRESH_AHEAD of its lifetime (or
+        has expired already), or MIN_REFRESH_AHEAD seconds if that is longer.
+        Objects fresh for less than MIN_TTL are never due, as they would be
+        refreshed all the time.
+    """
+    if freshness.ttl < MIN_TTL:
+        return False
+    ahead = max(MIN_REFRESH_AHEAD, REFRESH_AHEAD * freshness.ttl)
+    return now - freshness.stored_at >= freshness.ttl - ahead
+
+
+def parse_url(url):
+    """Splits a URL of a warm list into its origin and path.
+
+    Args:
+        url: URL, with or without the `http://` scheme
+
+    Returns:
+        Tuple of (host, port, path)
+
+    Raises:
+        ValueError: If the URL has no valid host and port.
+    """
+    if url.startswith("http://"):
+        url = url[len("http://"):]
+    authority, slash, path = url.partition("/")
+    host, _, port = authority.partition(":")
+    if not host:
+        raise ValueError(f"no host in {url!r}")
+    return host, int(port or 80), slash + path or "/"
+
+
+def read_warm_list(filename):
+    """Reads the objects to warm the cache with.
+
+    Args:
+        filename: Path to a warm list, see the module docstring
+
+    Returns:
+        List of ((host, port, path), count) tuples, most listed first
+
+    Raises:
+        OSError: If the file could not be read.
+    """
+    counts = Counter()
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if line.startswith("{"):
+                    record = json.loads(line)
+                    url = f"{record['host']}{record['path']}"
+                else:
+                    url = line
+                counts[parse_url(url)] += 1
+            except (ValueError, KeyError, TypeError):
+                # Not an object of an origin (e.g. a request without a
+                # Host header)
+                continue
+    return counts.most_common()
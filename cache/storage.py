@@ -0,0 +1,430 @@
+"""Storage
+
+Disk tier of the cache proxy. Bodies are stored as content-addressed blobs
+(named after the SHA-256 of their contents) in a sharded directory layout:
+
+    files/objects/<first 2 hex digits>/<remaining hex digits>
+
+An index maps each cache key to its blob, size, stored header fields,
+freshness and last access time. The index is kept as an append-only journal
+(`files/index.log`, one JSON record per line) which is replayed on startup,
+so the proxy never has to walk or stat the blob tree.
+
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, namedtuple
+
+import freshness
+
+Entry = namedtuple(
+    "Entry", ["key", "digest", "size", "headers", "freshness", "accessed_at"])
+
+
+class Storage(ABC):
+    """Interface of a cache storage engine.
+
+    Keys are strings of the form "<host>_<port>/<path>", followed by the
+    request header values for responses that vary on them (see `vary`).
+    """
+
+    @abstractmethod
+    def lookup(self, key):
+        """Looks up an entry and marks it as used.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            Entry, or None if nothing is stored under key
+        """
+
+    @abstractmethod
+    def entries(self):
+        """Returns every stored entry, without marking any as used.
+
+        Returns:
+            List of entries
+        """
+
+    @abstractmethod
+    def path(self, entry):
+        """Returns the path of the file holding an entry's body.
+
+        Args:
+            entry: Entry
+
+        Returns:
+            Path to file
+        """
+
+    @abstractmethod
+    def open(self, entry):
+        """Opens the file holding an entry's body for reading.
+
+        The file stays readable until it is closed, even if the entry is
+        replaced or evicted in the meantime.
+
+        Args:
+            entry: Entry, as returned by lookup()
+
+        Returns:
+            File object (binary), or None if the body is no longer stored
+        """
+
+    @abstractmethod
+    def begin_write(self, key):
+        """Starts storing a new body under key.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            BlobWriter
+        """
+
+    @abstractmethod
+    def update_freshness(self, key, new_freshness):
+        """Replaces the freshness of the entry stored under key, if any.
+
+        Args:
+            key: Cache key
+            new_freshness: Freshness
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def remove(self, key):
+        """Removes the entry stored under key, if any.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            None
+        """
+
+    @abstractmethod
+    def stats(self):
+        """Returns the storage counters.
+
+        Returns:
+            Dictionary of counter names to values, including "objects" (number
+            of entries), "size" (bytes stored) and "evictions"
+        """
+
+    @abstractmethod
+    def close(self):
+        """Saves any state that is only held in memory.
+
+        Returns:
+            None
+        """
+
+
+class BlobWriter:
+    """Writes one body to a temporary file while hashing it.
+
+    The body only becomes visible under its key once commit() is called.
+    abort() throws it away. Until then it can be read as it is written, see
+    open().
+    """
+
+    def __init__(self, storage, key):
+        self._storage = storage
+        self._key = key
+        self._hash = hashlib.sha256()
+        self._size = 0
+        fd, self._temp_file = tempfile.mkstemp(dir=storage.temp_dir)
+        self._file = open(fd, "wb")
+
+    def write(self, data):
+        """Appends data to the body.
+
+        Args:
+            data: Bytes to append
+
+        Returns:
+            None
+        """
+        self._file.write(data)
+        # Flushed so that readers see the data, see open()
+        self._file.flush()
+        self._hash.update(data)
+        self._size += len(data)
+
+    def open(self):
+        """Opens the body for reading while it is being written.
+
+        The file stays readable after commit() or abort(), until it is closed.
+
+        Returns:
+            File object, in binary mode
+        """
+        return open(self._temp_file, "rb")
+
+    def commit(self, headers, new_freshness):
+        """Stores the body under the writer's key.
+
+        Args:
+            headers: Dictionary of header field names to values
+            new_freshness: Freshness of the response
+
+        Returns:
+            Entry
+        """
+        self._file.close()
+        return self._storage.commit(
+            self._key,
+            self._temp_file,
+            self._hash.hexdigest(),
+            self._size,
+            headers,
+            new_freshness
+        )
+
+    def abort(self):
+        """Throws the body away.
+
+        Returns:
+            None
+        """
+        self._file.close()
+        os.remove(self._temp_file)
+
+
+class DiskStorage(Storage):
+    """Content-addressed blob store with a journaled index and a size cap.
+
+    When the total size of the stored blobs goes over max_size, the least
+    recently used entries are evicted. Identical bodies stored under several
+    keys share a single blob, which is only deleted once no key refers to it.
+
+    Attributes:
+        root: Directory holding the index and the blobs
+        max_size: Maximum total size (in bytes) of the stored blobs
+        size: Total size (in bytes) of the stored blobs
+        evictions: Number of entries evicted to stay within max_size
+        on_evict: Function called with the key of every evicted entry
+    """
+
+    def __init__(self, root, max_size, on_evict=None):
+        """
+        Args:
+            root: Directory holding the index and the blobs
+            max_size: Maximum total size (in bytes) of the stored blobs
+            on_evict: Function called with the key of every evicted entry
+        """
+        self.root = root
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.size = 0
+        self.evictions = 0
+        self.objects_dir = os.path.join(root, "objects")
+        self.temp_dir = os.path.join(root, "tmp")
+        self.index_file = os.path.join(root, "index.log")
+        self._entries = OrderedDict()  # least recently used first
+        self._references = {}  # digest -> number of entries using the blob
+        self._journal_records = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        # Bodies left behind by writes that never finished
+        for name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, name))
+        self._journal = None
+        self._load()
+        self._compact()
+        with self._lock:
+            self._evict()
+
+    def lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry = entry._replace(accessed_at=time.time())
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            return entry
+
+    def entries(self):
+        with self._lock:
+            return list(self._entries.values())
+
+    def path(self, entry):
+        return os.path.join(
+            self.objects_dir, entry.digest[:2], entry.digest[2:])
+
+    def open(self, entry):
+        # Opened under the lock, so that the blob cannot be deleted between
+        # the check and the open. Deleting it afterwards leaves it readable
+        # through the open file.
+        with self._lock:
+            if entry.digest not in self._references:
+                return None
+            try:
+                return open(self.path(entry), "rb")
+            except FileNotFoundError:
+                return None
+
+    def begin_write(self, key):
+        return BlobWriter(self, key)
+
+    def commit(self, key, temp_file, digest, size, headers, new_freshness):
+        """Moves a fully written body into place and indexes it under key.
+
+        Args:
+            key: Cache key
+            temp_file: Path of the temporary file holding the body
+            digest: SHA-256 hex digest of the body
+            size: Size of the body in bytes
+            headers: Dictionary of header field names to values
+            new_freshness: Freshness of the response
+
+        Returns:
+            Entry
+        """
+        entry = Entry(key, digest, size, headers, new_freshness, time.time())
+        blob = self.path(entry)
+        with self._lock:
+            self._discard(key)
+            if digest in self._references:
+                # Same body is already stored under another key
+                os.remove(temp_file)
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                # mkstemp creates the file readable by its owner only
+                os.chmod(temp_file, 0o644)
+                os.replace(temp_file, blob)
+            self._add(entry)
+            self._append(entry)
+            self._evict()
+        return entry
+
+    def update_freshness(self, key, new_freshness):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry = entry._replace(freshness=new_freshness)
+            self._entries[key] = entry
+            self._append(entry)
+
+    def remove(self, key):
+        with self._lock:
+            if self._discard(key):
+                self._write_record({"remove": key})
+                self._journal.flush()
+
+    def close(self):
+        with self._lock:
+            # Rewriting the index also saves the latest access times
+            self._compact()
+
+    def stats(self):
+        """Returns the storage counters.
+
+        Returns:
+            Dictionary of counter names to values
+        """
+        with self._lock:
+            return {
+                "objects": len(self._entries),
+                "blobs": len(self._references),
+                "size": self.size,
+                "evictions": self.evictions
+            }
+
+    def _add(self, entry):
+        self._entries[entry.key] = entry
+        if entry.digest not in self._references:
+            self._references[entry.digest] = 0
+            self.size += entry.size
+        self._references[entry.digest] += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._references[entry.digest] -= 1
+        if not self._references[entry.digest]:
+            del self._references[entry.digest]
+            self.size -= entry.size
+            try:
+                os.remove(self.path(entry))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def _evict(self):
+        while self.size > self.max_size and self._entries:
+            key = next(iter(self._entries))
+            self._discard(key)
+            self._write_record({"remove": key})
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key)
+        self._journal.flush()
+
+    def _append(self, entry):
+        self._write_record(self._to_record(entry))
+        self._journal.flush()
+
+    def _write_record(self, record):
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal_records += 1
+        # Rewrite the journal once it is mostly superseded records
+        if self._journal_records > max(1024, 4 * len(self._entries)):
+            self._compact()
+
+    def _load(self):
+        if not os.path.isfile(self.index_file):
+            return
+        entries = {}
+        with open(self.index_file) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last record was cut short by a crash
+                    break
+                if "remove" in record:
+                    entries.pop(record["remove"], None)
+                else:
+                    entries[record["key"]] = Entry(
+                        record["key"],
+                        record["digest"],
+                        record["size"],
+                        record["headers"],
+                        freshness.Freshness(*record["freshness"]),
+                        record["accessed_at"]
+                    )
+        for entry in sorted(entries.values(), key=lambda e: e.accessed_at):
+            self._add(entry)
+
+    def _compact(self):
+        if self._journal is not None:
+            self._journal.close()
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w") as f:
+            for entry in self._entries.values():
+                f.write(json.dumps(self._to_record(entry)) + "\n")
+        os.replace(temp_file, self.index_file)
+        self._journal = open(self.index_file, "a")
+        self._journal_records = len(self._entries)
+
+    @staticmethod
+    def _to_record(entry):
+        record = entry._asdict()
+        record["freshness"] = list(entry.freshness)
+        return record
@@ -0,0 +1,91 @@
+"""Vary
+
+Secondary cache keys for responses that carry a `Vary` header. Such a
+response is only valid for requests with the same values of the header
+fields it names, so each set of values is stored as a separate variant:
+
+    <host>_<port>/<path> <field>=<value>; <field>=<value>
+
+Values are normalised first, so that e.g. "gzip, br" and "br,gzip" share a
+variant.
+
+"""
+
+from common import mime
+
+
+def parse_vary(value):
+    """Parses a Vary header value.
+
+    Args:
+        value: Vary header value, e.g. "Accept-Encoding, Accept-Language"
+
+    Returns:
+        Sorted list of lowercase field names, or None if value is empty
+    """
+    if not value:
+        return None
+    names = sorted({name.strip().lower() for name in value.split(',')})
+    return [name for name in names if name] or None
+
+
+def normalize(name, value):
+    """Normalises a request header value for use in a cache key.
+
+    Args:
+        name: Lowercase field name
+        value: Field value
+
+    Returns:
+        Normalised value
+    """
+    if name == "accept-encoding":
+        weights = mime.parse_accept_encoding(value)
+        return ",".join(sorted(
+            coding for coding, weight in weights.items() if weight > 0))
+    return " ".join(value.split())
+
+
+def get_variant_key(key, names, request_headers):
+    """Returns the key of the variant of a response matching a request.
+
+    Args:
+        key: Cache key of the response ("<host>_<port>/<path>")
+        names: Lowercase names of the fields the response varies on
+        request_headers: Request header fields (lowercase names)
+
+    Returns:
+        Cache key of the variant
+    """
+    return key + " " + "; ".join(
+        f"{name}={normalize(name, request_headers.get(name, ''))}"
+        for name in names
+    )
+
+
+def get_base_key(key):
+    """Returns the key a variant key was derived from.
+
+    Args:
+        key: Cache key, of a variant or not
+
+    Returns:
+        Cache key ("<host>_<port>/<path>")
+    """
+    return key.split(' ', 1)[0]
+
+
+def get_request_fields(names, request_headers):
+    """Returns the request header fields a response varies on.
+
+    Args:
+        names: Lowercase names of the fields the response varies on
+        request_headers: Request header fields (lowercase names)
+
+    Returns:
+        Dictionary of field names to values, for the fields in the request
+    """
+    return {
+        name.title(): request_headers[name]
+        for name in names if name in request_headers
+    }
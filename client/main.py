@@ -5,6 +5,10 @@ This script allows the user to send a request to the 'server'.
 This script allows for a url to be passed in as argument in the form of:
     `python3 client/main.py <host>:<port>/<file>`
 
+Several urls may be passed in, in which case all files on the same server are
+requested over a single connection:
+    `python3 client/main.py <host>:<port>/<file> <host>:<port>/<file> ...`
+
 Otherwise, you may execute this script without any url argument and be prompted
 to enter the host, port and file.
 
@@ -12,112 +16,759 @@ For example, to send a request for `index.html` (located in `server_files/`)
 using localhost on port 12000:
     `python3 client/main.py localhost:12000/server/files/index.html`
 
+A download that is interrupted is left in `files/<file>.part` and resumed
+from where it stopped the next time the file is requested. A large file can
+also be downloaded over several connections at once, each fetching one
+segment of it:
+    `python3 client/main.py -segments 4 localhost:12000/sunset.jpg`
+
+In batch mode, a list of urls (given as arguments and/or read from a file
+with one url per line) is downloaded by several connections at once, and a
+throughput summary is printed at the end:
+    `python3 client/main.py -input urls.txt -concurrency 16`
+
 This script requires python3 to be installed.
 """
 
+import json
+import os
+import queue
 import socket
 import sys
+import threading
+import time
+from collections import Counter
 
-BUFFER_SIZE = 1024
+# Make the shared modules in common/ importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from common import http  # noqa: E402
 
+WRITE_BUFFER_SIZE = 1024 * 1024  # bytes buffered before writing to disk
+FILES_DIR = "./files"
+DEFAULT_CONCURRENCY = 8  # connections at once in batch mode
+MAX_REDIRECTS = 5
 
-def main(server_host, server_port, file, proxy_host=None, proxy_port=None):
-    """Main function of the script.
 
-    Creates TCP socket for server and connects to specified port on host. Sends
-    request for a specified file. If a 200 response was received, then the
-    client downloads the file to its current working directory. Otherwise,
-    the client prints out the contents of the error response. Regardless of the
-    response status code, the client will quit the connection thereafter.
+def parse_url(url):
+    """Splits a url into its host, port and file.
+
+    Args:
+        url: Url in the form `<host>:<port>/<file>`
+
+    Returns:
+        Tuple of (host, port, file)
+
+    Raises:
+        ValueError: If the url is not in that form.
+    """
+    host, _ = url.split(':', 1)
+    port, file = _.split('/', 1)
+    return host, port, file
+
+
+def build_request(file, server_host, server_port, fields=None):
+    """Builds a GET request for a file.
 
     Args:
-        server_host: Hostname of server
-        server_port: Port number for server
         file: Filename
-        proxy_host: Hostname of proxy
-        proxy_port: Port number for proxy
+        server_host: Hostname of server, sent in the Host header
+        server_port: Port number of server, sent in the Host header
+        fields: Extra header fields to send
+
+    Returns:
+        Request (str), including the terminating empty line
+    """
+    return (
+        f"GET /{file} HTTP/1.1\r\n"
+        f"Host: {server_host}:{server_port}\r\n"
+        + "".join(f"{name}: {value}\r\n"
+                  for name, value in (fields or {}).items())
+        + "\r\n"
+    )
+
+
+def get_validator(headers):
+    """Returns the value to send as If-Range to resume a download.
+
+    Args:
+        headers: Response header fields (lowercase names)
+
+    Returns:
+        The strong ETag of the response if it has one, otherwise its
+        Last-Modified date, or None if it has neither
+    """
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+
+def get_path(file):
+    """Returns where a file is saved.
+
+    Args:
+        file: Filename
+
+    Returns:
+        Path to the file in the client's files/ directory
+    """
+    return os.path.join(FILES_DIR, file.rsplit('/', 1)[-1])
+
+
+def load_partial(path):
+    """Looks for an interrupted download of a file.
+
+    Args:
+        path: Path the file is saved to
+
+    Returns:
+        Tuple of (bytes downloaded so far, validator of the response they
+        came from), or None if there is nothing to resume
+    """
+    try:
+        with open(path + ".part.json") as f:
+            validator = json.load(f)["validator"]
+        return os.path.getsize(path + ".part"), validator
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_resume_fields(partial):
+    """Returns the header fields asking for the rest of a download.
+
+    Args:
+        partial: Result of load_partial()
+
+    Returns:
+        Dictionary of header field names to values, empty if there is
+        nothing to resume
+    """
+    if partial is None:
+        return {}
+    size, validator = partial
+    return {"Range": f"bytes={size}-", "If-Range": validator}
+
+
+def parse_content_range(value):
+    """Parses a Content-Range header value.
+
+    Args:
+        value: Content-Range header value, e.g. "bytes 0-499/1234" or
+            "bytes */1234"
+
+    Returns:
+        Tuple of (first byte or None, size or None)
+    """
+    _, _, value = value.partition(' ')
+    span, _, size = value.partition('/')
+    first = span.split('-', 1)[0]
+    return (int(first) if first.isdigit() else None,
+            int(size) if size.isdigit() else None)
+
+
+def finish_download(path):
+    """Moves a completed download into place.
+
+    Args:
+        path: Path the file is saved to
+
+    Returns:
+        None
+    """
+    os.replace(path + ".part", path)
+    try:
+        os.remove(path + ".part.json")
+    except FileNotFoundError:
+        pass
+
+
+def discard_download(path):
+    """Removes an interrupted download, so the file is fetched again in full.
+
+    Args:
+        path: Path the file is saved to
+
+    Returns:
+        None
+    """
+    for part in (path + ".part", path + ".part.json"):
+        try:
+            os.remove(part)
+        except FileNotFoundError:
+            pass
+
+
+def save_body(server_socket, buffer, length, status_code, headers, path,
+              partial):
+    """Saves a 200, 206 or 416 response body to a file.
+
+    The body is written to `<path>.part`, next to a `<path>.part.json` file
+    holding the response's validator, and only moved to path once it has
+    been fully received. If the connection drops, the partial file is kept
+    and the download is resumed the next time the file is requested.
+
+    Args:
+        server_socket: Server socket instance
+        buffer: Body bytes already received with the response header
+        length: Length of the body in bytes, or None if the body runs until
+            the server closes the connection
+        status_code: HTTP status code of the response
+        headers: Response header fields (lowercase names)
+        path: Path the file is saved to
+        partial: Result of load_partial() for the request's file
+
+    Returns:
+        Bytes received past the end of the body
+
+    Raises:
+        ConnectionError: If the connection dropped before the whole body was
+            received, or a 206 response was not the rest of the partial
+            download (in which case the partial download is discarded, so
+            that the file is requested in full next time).
+    """
+    part_path = path + ".part"
+    if status_code == 416:
+        buffer = http.recv_body(
+            server_socket, buffer, length, lambda data: None)
+        _, size = parse_content_range(headers.get("content-range", ""))
+        if partial is not None and partial[0] == size:
+            # Everything had been downloaded already
+            finish_download(path)
+        return buffer
+    if status_code == 206:
+        content_range = headers.get("content-range", "")
+        offset, _ = parse_content_range(content_range)
+        if offset is None or offset > partial[0]:
+            # Would leave a gap (or has no place) in the partial download
+            buffer = http.recv_body(
+                server_socket, buffer, length, lambda data: None)
+            discard_download(path)
+            raise ConnectionError(
+                f"Invalid Content-Range {content_range!r}, download restarted")
+        f = open(part_path, "r+b", buffering=WRITE_BUFFER_SIZE)
+        f.seek(offset)
+        f.truncate()
+    else:
+        validator = get_validator(headers)
+        if validator is not None and length is not None:
+            with open(part_path + ".json", "w") as info:
+                json.dump({"validator": validator}, info)
+        f = open(part_path, "wb", buffering=WRITE_BUFFER_SIZE)
+    with f:
+        buffer = http.recv_body(server_socket, buffer, length, f.write)
+    finish_download(path)
+    return buffer
+
+
+def fetch(connect_host, connect_port, server_host, server_port, files):
+    """Requests a list of files over a single persistent connection.
+
+    All requests are sent up front (pipelined) and the responses are then read
+    in order. If a 200 response was received, the file is downloaded to the
+    client's `files/` directory. Files that were partly downloaded before are
+    asked for from where they stopped, and completed from a 206 response (see
+    `save_body`). Otherwise, the contents of the response are printed out.
+
+    Args:
+        connect_host: Hostname to connect to (server, proxy or balancer)
+        connect_port: Port number to connect to
+        server_host: Hostname of server, sent in the Host header
+        server_port: Port number of server, sent in the Host header
+        files: List of filenames
+
+    Returns:
+        Tuple of (redirects, unanswered) where redirects is a list of
+        (host, port, file) for every 301 response received, and unanswered is
+        the list of files the server closed the connection without answering
+        (or before sending the whole file).
+    """
+    redirects = []
+    partials = [load_partial(get_path(file)) for file in files]
+    with socket.create_connection((connect_host, int(connect_port))) \
+            as server_socket:
+        # Send requests
+        request = "".join(
+            build_request(file, server_host, server_port,
+                          get_resume_fields(partial))
+            for file, partial in zip(files, partials)
+        )
+        server_socket.sendall(request.encode())
+
+        buffer = b""
+        for i, file in enumerate(files):
+            header, buffer = http.recv_header(server_socket, buffer)
+            if header is None:
+                return redirects, files[i:]
+            print(http.decode(header) + "\n")
+            status_code, headers = http.parse_response(header)
+            length = http.get_body_length("GET", status_code, headers)
+
+            if status_code == 200 or (
+                    status_code in (206, 416) and partials[i] is not None):
+                try:
+                    buffer = save_body(
+                        server_socket, buffer, length, status_code, headers,
+                        get_path(file), partials[i])
+                except ConnectionError as err:
+                    print(f"Error: {file}: {err}")
+                    return redirects, files[i:]
+            else:
+                body = bytearray()
+                buffer = http.recv_body(
+                    server_socket, buffer, length, body.extend)
+                print(body.decode(errors="replace"))
+                if status_code == 301:
+                    location_host, location_port, _ = parse_url(
+                        headers["location"])
+                    redirects.append((location_host, location_port, file))
+
+            connection = headers.get("connection", "").lower()
+            if length is None or connection == "close":
+                return redirects, files[i + 1:]
+    return redirects, []
+
+
+def fetch_segment(connect_host, connect_port, server_host, server_port,
+                  file, validator, first, last, fd):
+    """Downloads one byte range of a file into an open file.
+
+    Args:
+        connect_host: Hostname to connect to (server or proxy)
+        connect_port: Port number to connect to
+        server_host: Hostname of server, sent in the Host header
+        server_port: Port number of server, sent in the Host header
+        file: Filename
+        validator: ETag or Last-Modified of the file, sent as If-Range so
+            that every segment comes from the same version of the file
+        first: First byte of the range (inclusive)
+        last: Last byte of the range (inclusive)
+        fd: File descriptor to write the range to, at its offset in the file
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If the range could not be downloaded.
+    """
+    fields = {"Range": f"bytes={first}-{last}", "Connection": "close"}
+    if validator is not None:
+        fields["If-Range"] = validator
+    with socket.create_connection((connect_host, int(connect_port))) \
+            as server_socket:
+        server_socket.sendall(
+            build_request(file, server_host, server_port, fields).encode())
+        header, buffer = http.recv_header(server_socket, b"")
+        if header is None:
+            raise ConnectionError("Server closed the connection")
+        status_code, headers = http.parse_response(header)
+        offset, _ = parse_content_range(headers.get("content-range", ""))
+        if status_code != 206 or offset != first:
+            raise ConnectionError(f"Range {first}-{last} was not sent")
+        position = first
+
+        def write(data):
+            nonlocal position
+            os.pwrite(fd, data, position)
+            position += len(data)
+        http.recv_body(server_socket, buffer, last - first + 1, write)
+
+
+def fetch_segments(connect_host, connect_port, server_host, server_port,
+                   file, segments, via_proxy=False, redirects=MAX_REDIRECTS):
+    """Downloads a file over several connections at once.
+
+    A request for its first byte finds out the size of the file, which is
+    then split into segments that are each downloaded on their own
+    connection and written straight to their place in `<file>.part`. If the
+    server does not support ranges, the file is downloaded in one piece, and
+    an empty file (which has no first byte to ask for) is saved as is.
+
+    Args:
+        connect_host: Hostname to connect to (server, proxy or balancer)
+        connect_port: Port number to connect to
+        server_host: Hostname of server, sent in the Host header
+        server_port: Port number of server, sent in the Host header
+        file: Filename
+        segments: Number of connections to use
+        via_proxy: Whether connect_host is a proxy, which redirected
+            requests must still go through
+        redirects: Number of redirects that may still be followed
 
     Returns:
         None
     """
+    path = get_path(file)
+    with socket.create_connection((connect_host, int(connect_port))) \
+            as server_socket:
+        server_socket.sendall(build_request(
+            file, server_host, server_port,
+            {"Range": "bytes=0-0", "Connection": "close"}).encode())
+        header, buffer = http.recv_header(server_socket, b"")
+        if header is None:
+            print("Error: Server closed the connection")
+            return
+        print(http.decode(header) + "\n")
+        status_code, headers = http.parse_response(header)
+        length = http.get_body_length("GET", status_code, headers)
+        if status_code == 200:
+            save_body(server_socket, buffer, length, status_code, headers,
+                      path, None)
+            return
+        body = bytearray()
+        http.recv_body(server_socket, buffer, length, body.extend)
+    if status_code == 301:
+        if not redirects:
+            print("Error: Too many redirects")
+            return
+        location_host, location_port, _ = parse_url(headers["location"])
+        if via_proxy:
+            fetch_segments(connect_host, connect_port, location_host,
+                           location_port, file, segments, via_proxy,
+                           redirects - 1)
+        else:
+            fetch_segments(location_host, location_port, location_host,
+                           location_port, file, segments,
+                           redirects=redirects - 1)
+        return
+    _, size = parse_content_range(headers.get("content-range", ""))
+    if status_code in (206, 416) and size == 0:
+        # Nothing to split, so the file is saved straight away
+        open(path, "wb").close()
+        discard_download(path)
+        print("Downloaded 0 bytes")
+        return
+    if status_code != 206 or size is None:
+        print(body.decode(errors="replace"))
+        return
+
+    validator = get_validator(headers)
+    step = -(-size // segments)
+    errors = []
+
+    def run(first):
+        try:
+            fetch_segment(connect_host, connect_port, server_host,
+                          server_port, file, validator, first,
+                          min(first + step, size) - 1, fd)
+        except OSError as err:
+            errors.append(err)
+    fd = os.open(path + ".part", os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
     try:
-        # Make TCP connection with server
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        if proxy_host and proxy_port:
-            server_socket.connect((proxy_host, int(proxy_port)))
+        os.ftruncate(fd, size)
+        threads = [threading.Thread(target=run, args=(first,))
+                   for first in range(0, size, step)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        os.close(fd)
+    if errors:
+        # The segments that did arrive cannot be resumed one by one
+        os.remove(path + ".part")
+        print(f"Error: {errors[0]}")
+        return
+    finish_download(path)
+    print(f"Downloaded {size} bytes in {len(threads)} segments")
+
+
+def request_file(connections, connect_host, connect_port, server_host,
+                 server_port, file, save=True):
+    """Requests a file over a kept-alive connection and saves it.
+
+    The connection to connect_host is taken from connections if there is
+    one, and put back there afterwards unless the server is closing it. If a
+    reused connection turns out to have been closed by the server, the
+    request is sent again on a new connection.
+
+    Args:
+        connections: Dictionary of (host, port) to (socket, buffered bytes)
+            for the open connections of the calling thread
+        connect_host: Hostname to connect to (server, proxy or balancer)
+        connect_port: Port number to connect to
+        server_host: Hostname of server, sent in the Host header
+        server_port: Port number of server, sent in the Host header
+        file: Filename
+        save: Whether to save the file, rather than discard its body
+
+    Returns:
+        Tuple of (status code, body bytes received, Location header or None)
+
+    Raises:
+        OSError: If the server could not be reached or closed the connection
+            before the whole response was received.
+    """
+    key = (connect_host, str(connect_port))
+    path = get_path(file)
+    partial = load_partial(path) if save else None
+    request = build_request(file, server_host, server_port,
+                            get_resume_fields(partial)).encode()
+    while True:
+        reused = key in connections
+        if reused:
+            server_socket, buffer = connections.pop(key)
         else:
-            server_socket.connect((server_host, int(server_port)))
-    except ConnectionRefusedError:
-        print("Error: Could not connect to server")
-        sys.exit(1)
-
-    # Send request
-    request = f"""GET /{file} HTTP/1.1\r
-Host: {server_host}:{server_port}\r
-\r"""
-    server_socket.send(request.encode())
-
-    isDone = False
-    while not isDone:
-        response = server_socket.recv(BUFFER_SIZE).decode()
-        split_response = response.split('\n')
-        status_line = split_response[0]
-        status_code = int(status_line.split(' ')[1])
-        if status_code == 301:
-            location = split_response[1]
-            new_port = int(location.split(' ')[1].split(':')[1].split('/')[0])
-            print(response)
-            data = server_socket.recv(BUFFER_SIZE)
-            while data:
-                print(data.decode())
-                data = server_socket.recv(BUFFER_SIZE)
-            request = f"""GET /{file} HTTP/1.1\r
-Host: {server_host}:{new_port}\r
-\r"""
-            # Close connection with load balancer
+            server_socket = socket.create_connection(
+                (connect_host, int(connect_port)))
+            buffer = b""
+        try:
+            server_socket.sendall(request)
+            header, buffer = http.recv_header(server_socket, buffer)
+        except OSError:
             server_socket.close()
-            # Open connection with server
-            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            server_socket.connect((server_host, new_port))
-            # Send request
-            server_socket.send(request.encode())
-        elif status_code == 200:
-            print(response)
-            filename = file.rsplit('/', 1)[-1]
-            with open("./files/" + filename, "wb") as new_file:
-                data = server_socket.recv(BUFFER_SIZE)
-                while data:
-                    new_file.write(data)
-                    data = server_socket.recv(BUFFER_SIZE)
-            isDone = True
+            if not reused:
+                raise
+            continue
+        if header is not None:
+            break
+        server_socket.close()
+        if not reused:
+            raise ConnectionError("Server closed the connection")
+
+    status_code, headers = http.parse_response(header)
+    length = http.get_body_length("GET", status_code, headers)
+    try:
+        if save and (status_code == 200 or (
+                status_code in (206, 416) and partial is not None)):
+            buffer = save_body(server_socket, buffer, length, status_code,
+                               headers, path, partial)
+            if length is None:
+                length = os.path.getsize(path)
         else:
-            print(response)
-            data = server_socket.recv(BUFFER_SIZE)
-            while data:
-                print(data.decode())
-                data = server_socket.recv(BUFFER_SIZE)
-            isDone = True
+            # Error pages are not saved or printed in batch mode
+            received = 0
+
+            def discard(data):
+                nonlocal received
+                received += len(data)
+            buffer = http.recv_body(server_socket, buffer, length, discard)
+            length = received
+    except BaseException:
+        server_socket.close()
+        raise
+    if (length is not None and "content-length" in headers
+            and headers.get("connection", "").lower() != "close"):
+        connections[key] = (server_socket, buffer)
+    else:
+        server_socket.close()
+    return status_code, length or 0, headers.get("location")
+
+
+def fetch_batch(urls, concurrency=DEFAULT_CONCURRENCY, proxy_host=None,
+                proxy_port=None):
+    """Downloads a list of urls over several connections at once.
+
+    Up to concurrency threads take urls from a shared queue. Each thread
+    keeps its connections open and reuses them for later urls on the same
+    host, including the servers a load balancer redirects to. Once every url
+    has been handled, a summary of the status codes and throughput is
+    printed. If a file is listed more than once, only one download of it at a
+    time is saved, and the bodies of the others are discarded.
+
+    Args:
+        urls: List of urls in the form `<host>:<port>/<file>`
+        concurrency: Number of urls downloaded at once
+        proxy_host: Hostname of proxy
+        proxy_port: Port number for proxy
+
+    Returns:
+        Dictionary of summary names to values
+    """
+    pending = queue.SimpleQueue()
+    for url in urls:
+        pending.put(url)
+    statuses = Counter()
+    totals = {"bytes": 0, "errors": 0}
+    saving = set()
+    lock = threading.Lock()
+
+    def download(connections, url):
+        host, port, file = parse_url(url)
+        path = get_path(file)
+        with lock:
+            save = path not in saving
+            saving.add(path)
+        try:
+            download_file(connections, host, port, file, save)
+        finally:
+            if save:
+                with lock:
+                    saving.discard(path)
+
+    def download_file(connections, host, port, file, save):
+        for _ in range(MAX_REDIRECTS + 1):
+            if proxy_host and proxy_port:
+                connect_host, connect_port = proxy_host, proxy_port
+            else:
+                connect_host, connect_port = host, port
+            status_code, size, location = request_file(
+                connections, connect_host, connect_port, host, port, file,
+                save)
+            with lock:
+                statuses[status_code] += 1
+                totals["bytes"] += size
+            if status_code != 301 or location is None:
+                return
+            host, port, _ = parse_url(location)
+        raise ConnectionError("Too many redirects")
+
+    def run():
+        connections = {}
+        try:
+            while True:
+                try:
+                    url = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    download(connections, url)
+                except (OSError, ValueError) as err:
+                    print(f"Error: {url}: {err}")
+                    with lock:
+                        totals["errors"] += 1
+        finally:
+            for server_socket, _ in connections.values():
+                server_socket.close()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=run)
+               for _ in range(max(1, min(concurrency, len(urls))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.monotonic() - start, 1e-9)
+
+    summary = {
+        "urls": len(urls),
+        "errors": totals["errors"],
+        "responses": sum(statuses.values()),
+        "status_codes": dict(sorted(statuses.items())),
+        "bytes": totals["bytes"],
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(sum(statuses.values()) / elapsed, 1),
+        "megabytes_per_second": round(totals["bytes"] / elapsed / 1e6, 2)
+    }
+    print(f"Fetched {len(urls)} urls ({totals['errors']} failed) in "
+          f"{elapsed:.3f} s with {len(threads)} connections")
+    print("Status codes: " + ", ".join(
+        f"{code}: {count}" for code, count in summary["status_codes"].items()))
+    print(f"Throughput: {summary['requests_per_second']} requests/s, "
+          f"{summary['megabytes_per_second']} MB/s "
+          f"({totals['bytes']} bytes)")
+    return summary
+
+
+def read_urls(filename):
+    """Reads a list of urls from a file.
+
+    Args:
+        filename: Path to a file with one url per line, or "-" for standard
+            input. Blank lines and lines starting with "#" are skipped.
+
+    Returns:
+        List of urls
+    """
+    f = sys.stdin if filename == "-" else open(filename)
+    with f:
+        return [line.strip() for line in f
+                if line.strip() and not line.lstrip().startswith("#")]
 
-    server_socket.close()
+
+def main(server_host, server_port, files, proxy_host=None, proxy_port=None,
+         segments=1):
+    """Main function of the script.
+
+    Creates TCP socket for server and connects to specified port on host. Sends
+    requests for the specified files over that one connection (see `fetch`).
+    If the load balancer redirects a file to another server, it is requested
+    from that server, again sharing one connection between every file
+    redirected to the same server. Requests that were not answered before the
+    server closed the connection are retried on a new connection.
+
+    With segments greater than 1, each file is instead downloaded over that
+    many connections at once (see `fetch_segments`).
+
+    Args:
+        server_host: Hostname of server
+        server_port: Port number for server
+        files: List of filenames
+        proxy_host: Hostname of proxy
+        proxy_port: Port number for proxy
+        segments: Number of connections to download each file over
+
+    Returns:
+        None
+    """
+    if segments > 1:
+        for file in files:
+            try:
+                if proxy_host and proxy_port:
+                    fetch_segments(proxy_host, proxy_port, server_host,
+                                   server_port, file, segments, True)
+                else:
+                    fetch_segments(server_host, server_port, server_host,
+                                   server_port, file, segments)
+            except ConnectionRefusedError:
+                print("Error: Could not connect to server")
+                sys.exit(1)
+        return
+    # Files still to be requested, grouped by the server that holds them
+    pending = {(server_host, str(server_port)): list(files)}
+    while pending:
+        (host, port), files = pending.popitem()
+        try:
+            # Make TCP connection with server
+            if proxy_host and proxy_port:
+                redirects, unanswered = fetch(
+                    proxy_host, proxy_port, host, port, files)
+            else:
+                redirects, unanswered = fetch(host, port, host, port, files)
+        except ConnectionRefusedError:
+            print("Error: Could not connect to server")
+            sys.exit(1)
+        if len(unanswered) == len(files):
+            print("Error: Server closed the connection")
+            sys.exit(1)
+        if unanswered:
+            pending.setdefault((host, port), []).extend(unanswered)
+        for host, port, file in redirects:
+            pending.setdefault((host, port), []).append(file)
 
 
 if __name__ == '__main__':
     proxy_host, proxy_port = None, None
+    segments = 1
+    concurrency = None
+    urls = []
     # Extract request info from command
-    if "-proxy" in sys.argv:
-        url = sys.argv[3]
-        server_host, _ = url.split(':')
-        server_port, file = _.split('/', 1)
-        proxy_url = sys.argv[2]
-        proxy_host, proxy_port = proxy_url.split(':')
-        main(server_host, server_port, file, proxy_host, proxy_port)
-    elif "-balancer" in sys.argv:
-        url = sys.argv[2]
-        server_host, _ = url.split(':')
-        server_port, file = _.split('/', 1)
-        main(server_host, server_port, file)
-    else:
-        url = sys.argv[1]
-        server_host, _ = url.split(':')
-        server_port, file = _.split('/', 1)
-        main(server_host, server_port, file)
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg == "-proxy":
+            proxy_host, proxy_port = next(args).split(':')
+        elif arg == "-segments":
+            segments = int(next(args))
+        elif arg == "-balancer":
+            continue
+        elif arg == "-batch":
+            concurrency = concurrency or DEFAULT_CONCURRENCY
+        elif arg == "-concurrency":
+            concurrency = int(next(args))
+        elif arg == "-input":
+            urls.extend(read_urls(next(args)))
+            concurrency = concurrency or DEFAULT_CONCURRENCY
+        else:
+            urls.append(arg)
+    if concurrency is not None:
+        fetch_batch(urls, concurrency, proxy_host, proxy_port)
+        sys.exit(0)
+    # Group files by server so each server is sent all of its files over a
+    # single connection
+    requests = {}
+    for url in urls:
+        server_host, server_port, file = parse_url(url)
+        requests.setdefault((server_host, server_port), []).append(file)
+    for (server_host, server_port), files in requests.items():
+        main(server_host, server_port, files, proxy_host, proxy_port,
+             segments)
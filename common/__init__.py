@@ -0,0 +1,7 @@
+"""Common
+
+Modules shared by the server, client, cache and load balancer. Each program
+adds the repository root to `sys.path` so that it can import this package
+when run from its own directory.
+
+"""
@@ -0,0 +1,62 @@
+"""Access Log
+
+Structured access log written by the server, the cache proxy and the load
+balancer: one JSON object per line and per request, e.g.
+
+    {"time": "2021-03-07T16:52:05.123Z", "client": "127.0.0.1:53116",
+     "method": "GET", "path": "/index.html", "status": 200, "bytes": 146,
+     "duration_ms": 0.412}
+
+Components add fields of their own (e.g. whether the cache was hit, or the
+server a request was sent to).
+
+"""
+
+import json
+import sys
+import threading
+import time
+
+
+class AccessLog:
+    """Access log written to a file or to standard output.
+
+    Attributes:
+        path: Path of the log file, or "-" for standard output
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path: Path of the log file (appended to), or "-" for standard
+                output
+
+        Raises:
+            OSError: If the file could not be opened.
+        """
+        self.path = path
+        if path == "-":
+            self._file = sys.stdout
+        else:
+            self._file = open(path, "a", buffering=1)
+        self._lock = threading.Lock()
+
+    def log(self, **fields):
+        """Writes a line to the log.
+
+        Args:
+            **fields: Fields of the line, in the order they are written
+
+        Returns:
+            None
+        """
+        now = time.time()
+        line = json.dumps({
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now))
+            + f".{int(now % 1 * 1000):03d}Z",
+            **fields
+        })
+        with self._lock:
+            self._file.write(line + "\n")
+            if self._file is sys.stdout:
+                self._file.flush()
@@ -0,0 +1,216 @@
+"""Admission Control
+
+Caps the number of client connections the server and the cache proxy serve
+at the same time. Connections are accepted as fast as they arrive; those
+past the cap are answered straight away with `503 Service Unavailable` and a
+Retry-After header, instead of waiting in the accept queue (or for a
+thread) while their clients time out. The accept queue itself is bounded by
+the listen backlog.
+
+Slow clients are cut off as well: a request header must arrive within
+REQUEST_TIMEOUT (see `http.recv_header`), and the sends of a response must
+be done in a time that grows with its size (see `DeadlineSocket`).
+
+    client_socket, _ = server_socket.accept()
+    if not connection_limit.admit():
+        admission.reject(client_socket)
+        continue
+    ...  # serve, then call connection_limit.release()
+
+"""
+
+import contextlib
+import socket
+import threading
+import time
+
+DEFAULT_MAX_CONNECTIONS = 1024
+RETRY_AFTER = 1  # seconds, sent with 503 responses
+REQUEST_TIMEOUT = 10.0  # seconds a request header may take to arrive
+RESPONSE_TIMEOUT = 30.0  # seconds the sends of a response may take, plus
+# the time its size takes at MIN_SEND_RATE
+MIN_SEND_RATE = 64 * 1024  # bytes per second a client must read on average
+SEND_CHUNK_SIZE = 64 * 1024  # bytes sent at a time against the deadline
+
+
+class ConnectionLimit:
+    """Counts the connections being served against a maximum.
+
+    Attributes:
+        max_connections: Maximum number of connections served at once
+        rejected: Number of connections turned away so far
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS):
+        """
+        Args:
+            max_connections: Maximum number of connections served at once
+        """
+        self.max_connections = max_connections
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(max_connections)
+
+    def admit(self):
+        """Takes a slot for a new connection, if there is one free.
+
+        Never blocks.
+
+        Returns:
+            True if the connection may be served, in which case release()
+            must be called once it is closed
+        """
+        if self._slots.acquire(blocking=False):
+            return True
+        self.rejected += 1
+        return False
+
+    def release(self):
+        """Frees the slot of a connection that has been closed.
+
+        Returns:
+            None
+        """
+        self._slots.release()
+
+
+def reject(client_socket, retry_after=RETRY_AFTER):
+    """Answers a connection that is not admitted with 503 and closes it.
+
+    Runs on the accepting thread, so it never blocks: whatever the client has
+    already sent is read (so that closing the connection does not reset it
+    before the client has read the response), and the response is small
+    enough to fit in the socket's send buffer.
+
+    Args:
+        client_socket: Client socket instance
+        retry_after: Seconds after which the client may try again
+
+    Returns:
+        None
+    """
+    with client_socket:
+        try:
+            client_socket.setblocking(False)
+            try:
+                client_socket.recv(65536)
+            except BlockingIOError:
+                pass
+            client_socket.send((
+                "HTTP/1.1 503 Service Unavailable\r\n"
+                f"Retry-After: {retry_after}\r\n"
+                "Content-Length: 0\r\n"
+                "Connection: close\r\n\r\n"
+            ).encode())
+            client_socket.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+
+class DeadlineSocket:
+    """Client socket whose responses must each be sent in time.
+
+    The timeout of a socket only limits each send, so a client that reads
+    just often enough never trips it, and holds on to its connection (and
+    anything waiting on the response) for as long as it likes. Here the
+    sends of a whole response may only take RESPONSE_TIMEOUT, plus one
+    second for every MIN_SEND_RATE bytes of it. Only time spent waiting on
+    the client counts, so a response streamed from a slow origin server is
+    not cut off. Data is sent SEND_CHUNK_SIZE bytes at a time, each with
+    whatever time is left (rather than the timeout of the socket, as a
+    client draining a large send buffer slowly may leave the socket
+    unwritable for a while), so socket.timeout is raised once the client
+    falls behind. Every other method is passed on to the socket.
+
+        client_socket = admission.DeadlineSocket(client_socket)
+        ...  # read a request
+        client_socket.start_response()
+        client_socket.sendall(response)
+    """
+
+    def __init__(self, sock, timeout=RESPONSE_TIMEOUT,
+                 min_rate=MIN_SEND_RATE):
+        """
+        Args:
+            sock: Socket instance
+            timeout: Seconds the sends of a response may take, on top of the
+                time its size takes at min_rate
+            min_rate: Bytes per second the client must read on average
+        """
+        self._sock = sock
+        self._timeout = timeout
+        self._min_rate = min_rate
+        self._time_left = timeout
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def start_response(self):
+        """Gives the next response the whole of its time again.
+
+        Returns:
+            None
+        """
+        self._time_left = self._timeout
+
+    def send(self, data, flags=0):
+        """Sends data, in the time left. See socket.send().
+
+        Returns:
+            Number of bytes sent
+        """
+        data = memoryview(data)[:SEND_CHUNK_SIZE]
+        with self._limit(len(data)):
+            return self._sock.send(data, flags)
+
+    def sendall(self, data, flags=0):
+        """Sends all of data, in the time left. See socket.sendall().
+
+        Returns:
+            None
+
+        Raises:
+            socket.timeout: If the time ran out.
+        """
+        data = memoryview(data)
+        for start in range(0, len(data), SEND_CHUNK_SIZE):
+            chunk = data[start:start + SEND_CHUNK_SIZE]
+            with self._limit(len(chunk)):
+                self._sock.sendall(chunk, flags)
+
+    def sendfile(self, file, offset=0, count=None):
+        """Sends part of a file, in the time left. See socket.sendfile().
+
+        Returns:
+            Number of bytes sent
+
+        Raises:
+            socket.timeout: If the time ran out.
+        """
+        total = 0
+        while count is None or total < count:
+            size = SEND_CHUNK_SIZE if count is None else min(
+                SEND_CHUNK_SIZE, count - total)
+            with self._limit(size):
+                sent = self._sock.sendfile(file, offset + total, size)
+            total += sent
+            if sent < size:
+                # End of file
+                break
+        return total
+
+    @contextlib.contextmanager
+    def _limit(self, size):
+        # Gives a send of size bytes whatever time is left, in place of the
+        # timeout of the socket (which is kept for reads), and takes the time
+        # it took
+        self._time_left += size / self._min_rate
+        if self._time_left <= 0:
+            raise socket.timeout("response not sent in time")
+        timeout = self._sock.gettimeout()
+        self._sock.settimeout(self._time_left)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._time_left -= time.monotonic() - started
+            self._sock.settimeout(timeout)
@@ -0,0 +1,375 @@
+"""HTTP Messages
+
+Reading and parsing of HTTP/1.1 request and response headers and bodies,
+shared by the server, the cache proxy, the load balancer and the client.
+
+Headers are read incrementally: every read only searches the bytes it
+added (plus the three before them, in case the terminator was split
+across reads), so a header that arrives in many small segments is not
+scanned over and over. Whatever arrives past the end of the header (the
+start of the body, or the next pipelined request) is handed back untouched,
+and bodies are passed on as the bytes they arrived as, never decoded.
+
+Headers are decoded as UTF-8, with any bytes that are not valid UTF-8 kept
+as lone surrogates, so decoding never fails and encode() gives back exactly
+the bytes that were received. Header fields are looked up by lowercase name:
+
+    header, buffer = http.recv_header(sock, buffer)
+    method, target, protocol, headers = http.parse_request(header)
+    headers.get("connection")
+
+Lines may end with CRLF or a bare LF.
+
+"""
+
+import socket
+import time
+from collections import namedtuple
+
+BUFFER_SIZE = 64 * 1024
+MAX_HEADER_SIZE = 8192
+ENCODING = "utf-8"
+ERRORS = "surrogateescape"  # undecodable bytes survive a decode and encode
+
+# Response header read by recv_response(). header is the header as received
+# (bytes, without the terminating empty line), headers its fields keyed by
+# lowercase name.
+Response = namedtuple("Response", ["status_code", "headers", "header"])
+
+
+def decode(data):
+    """Decodes header bytes.
+
+    Args:
+        data: Bytes received
+
+    Returns:
+        Text (str), see encode()
+    """
+    return data.decode(ENCODING, ERRORS)
+
+
+def encode(text):
+    """Encodes a header, keeping any bytes that decode() could not decode.
+
+    Args:
+        text: Header text (str)
+
+    Returns:
+        Bytes to send
+    """
+    return text.encode(ENCODING, ERRORS)
+
+
+def find_header_end(buffer, start=0):
+    """Finds the empty line that ends a header.
+
+    Args:
+        buffer: Bytes received so far (bytes or bytearray)
+        start: Offset before which the buffer is known not to contain the
+            end of the header
+
+    Returns:
+        Tuple of (length of the header without the empty line, offset of the
+        first byte after it), or None if the header is incomplete
+    """
+    start = max(0, start - 3)
+    end = buffer.find(b"\n\r\n", start)
+    bare_end = buffer.find(b"\n\n", start, None if end == -1 else end + 1)
+    if bare_end != -1:
+        return bare_end, bare_end + 2
+    if end != -1:
+        return end - (buffer[end - 1:end] == b"\r"), end + 3
+    return None
+
+
+def recv_header(sock, buffer=b"", max_size=MAX_HEADER_SIZE, timeout=None):
+    """Reads the next request or response header from a connection.
+
+    Any bytes received past the end of the header (e.g. the start of the body
+    or the next pipelined request) are kept in the returned buffer. A header
+    already in the buffer is returned without reading from the connection.
+
+    Waiting for the first byte of the header is only limited by the timeout
+    of the socket (e.g. the keep-alive timeout between requests). With a
+    timeout, the rest of the header must then arrive within that many
+    seconds, so that a peer trickling in a byte at a time (slowloris) cannot
+    hold on to the connection.
+
+    Args:
+        sock: Socket instance
+        buffer: Bytes already received but not yet handled
+        max_size: Largest header accepted, in bytes
+        timeout: Seconds the whole header may take once its first byte has
+            been received, or None for no limit
+
+    Returns:
+        Tuple of (header without the terminating empty line (bytes),
+        remaining buffer (bytes)). The header is None if the peer closed the
+        connection or sent a header larger than max_size.
+
+    Raises:
+        socket.timeout: If the header did not arrive in time.
+    """
+    # Empty lines before a request are ignored (RFC 7230, section 3.5)
+    buffer = bytes(buffer).lstrip(b"\r\n")
+    found = find_header_end(buffer)
+    if found is None:
+        received = bytearray(buffer)
+        read_timeout = sock.gettimeout()
+        deadline = None
+        try:
+            while found is None:
+                if len(received) > max_size:
+                    return None, b""
+                if timeout is not None and received:
+                    if deadline is None:
+                        deadline = time.monotonic() + timeout
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout("header not received in time")
+                    sock.settimeout(remaining if read_timeout is None
+                                    else min(remaining, read_timeout))
+                data = sock.recv(BUFFER_SIZE)
+                if not data:
+                    return None, b""
+                searched = len(received)
+                received += data
+                if not searched:
+                    del received[
+                        :len(received) - len(received.lstrip(b"\r\n"))]
+                found = find_header_end(received, searched)
+        finally:
+            if deadline is not None:
+                sock.settimeout(read_timeout)
+        buffer = bytes(received)
+    end, body_start = found
+    if end > max_size:
+        return None, b""
+    return buffer[:end], buffer[body_start:]
+
+
+def split_header(header):
+    """Splits a header into its first line and its fields.
+
+    Field lines folded onto the next line (obsolete, but still sent by some
+    peers) are unfolded, and lines that are not fields are ignored.
+
+    Args:
+        header: Request or response header without the terminating empty
+            line (bytes or str)
+
+    Returns:
+        Tuple of (request or status line, fields) where fields is a list of
+        (name, value) tuples in the order received, names as sent
+    """
+    if not isinstance(header, str):
+        header = decode(header)
+    start_line, *lines = header.split("\n")
+    fields = []
+    for line in lines:
+        if line[:1] in (" ", "\t"):
+            if fields:
+                name, value = fields[-1]
+                fields[-1] = (name, f"{value} {line.strip()}")
+            continue
+        name, sep, value = line.partition(":")
+        name = name.strip()
+        if sep and name:
+            fields.append((name, value.strip()))
+    return start_line.rstrip("\r"), fields
+
+
+def get_headers(fields):
+    """Returns header fields keyed by lowercase name.
+
+    Args:
+        fields: List of (name, value) tuples, see split_header()
+
+    Returns:
+        Dictionary of lowercase field names to values. Values of fields that
+        appear more than once are joined with commas.
+    """
+    headers = {}
+    for name, value in fields:
+        name = name.lower()
+        if name in headers:
+            headers[name] += ", " + value
+        else:
+            headers[name] = value
+    return headers
+
+
+def parse_header(header):
+    """Splits a header into its first line and header fields.
+
+    Args:
+        header: Request or response header without the terminating empty
+            line (bytes or str)
+
+    Returns:
+        Tuple of (request or status line, headers) where headers is a
+        dictionary keyed by lowercase field name
+    """
+    start_line, fields = split_header(header)
+    return start_line, get_headers(fields)
+
+
+def parse_request_line(request_line):
+    """Splits a request line into its method, target and protocol.
+
+    Args:
+        request_line: Request line, e.g. "GET /index.html HTTP/1.1"
+
+    Returns:
+        Tuple of (method, target, protocol)
+
+    Raises:
+        ValueError: If the request line is malformed.
+    """
+    method, target, protocol = request_line.split(" ")
+    if not method or not target or not protocol.startswith("HTTP/"):
+        raise ValueError(f"invalid request line: {request_line!r}")
+    return method, target, protocol
+
+
+def parse_request(header):
+    """Parses a request header.
+
+    Args:
+        header: Request header without the terminating empty line (bytes or
+            str)
+
+    Returns:
+        Tuple of (method, target, protocol, headers) where headers is a
+        dictionary keyed by lowercase field name
+
+    Raises:
+        ValueError: If the request line is malformed.
+    """
+    request_line, headers = parse_header(header)
+    return (*parse_request_line(request_line), headers)
+
+
+def get_status_code(status_line):
+    """Returns the status code of a status line.
+
+    Args:
+        status_line: Status line, e.g. "HTTP/1.1 200 OK"
+
+    Returns:
+        Status code (int)
+
+    Raises:
+        ValueError: If the status line is malformed.
+    """
+    protocol, _, rest = status_line.partition(" ")
+    status_code = rest[:3]
+    if not protocol.startswith("HTTP/") or not status_code.isdigit() \
+            or rest[3:4] not in ("", " "):
+        raise ValueError(f"invalid status line: {status_line!r}")
+    return int(status_code)
+
+
+def parse_response(header):
+    """Parses a response header.
+
+    Args:
+        header: Response header without the terminating empty line (bytes or
+            str)
+
+    Returns:
+        Tuple of (status code, headers) where headers is a dictionary keyed
+        by lowercase field name
+
+    Raises:
+        ValueError: If the status line is malformed.
+    """
+    status_line, headers = parse_header(header)
+    return get_status_code(status_line), headers
+
+
+def recv_response(sock, buffer=b""):
+    """Reads and parses the next response header from a connection.
+
+    Args:
+        sock: Socket instance
+        buffer: Bytes already received but not yet handled
+
+    Returns:
+        Tuple of (Response, remaining buffer). The Response is None if the
+        server closed the connection or sent a header larger than
+        MAX_HEADER_SIZE.
+
+    Raises:
+        ValueError: If the status line or the Content-Length header is
+            malformed.
+    """
+    header, buffer = recv_header(sock, buffer)
+    if header is None:
+        return None, b""
+    status_code, headers = parse_response(header)
+    get_body_length("GET", status_code, headers)
+    return Response(status_code, headers, header), buffer
+
+
+def get_body_length(method, status_code, headers):
+    """Returns the length of a response body.
+
+    Args:
+        method: Method of the request the response answers
+        status_code: Status code of the response
+        headers: Response header fields (lowercase names)
+
+    Returns:
+        Length of the body in bytes, or None if the body runs until the server
+        closes the connection
+
+    Raises:
+        ValueError: If the Content-Length header is invalid.
+    """
+    if method == "HEAD" or status_code in (204, 304) or status_code < 200:
+        return 0
+    elif "content-length" in headers:
+        length = int(headers["content-length"])
+        if length < 0:
+            raise ValueError(f"invalid Content-Length: {length}")
+        return length
+    else:
+        return None
+
+
+def recv_body(sock, buffer, length, write):
+    """Reads a message body and passes it on chunk by chunk.
+
+    Args:
+        sock: Socket instance
+        buffer: Bytes already received but not yet handled
+        length: Length of the body in bytes, or None to read until the peer
+            closes the connection
+        write: Function called with each chunk of the body
+
+    Returns:
+        Bytes received past the end of the body
+
+    Raises:
+        ConnectionError: If the peer closed the connection before the end of
+            the body.
+    """
+    if length is None:
+        if buffer:
+            write(buffer)
+        while data := sock.recv(BUFFER_SIZE):
+            write(data)
+        return b""
+    body, buffer = buffer[:length], buffer[length:]
+    if body:
+        write(body)
+    remaining = length - len(body)
+    while remaining > 0:
+        data = sock.recv(min(BUFFER_SIZE, remaining))
+        if not data:
+            raise ConnectionError("Connection closed before end of body")
+        write(data)
+        remaining -= len(data)
+    return buffer
@@ -0,0 +1,414 @@
+"""Metrics
+
+Counters, gauges and histograms kept by the server, the cache proxy and the
+load balancer, and rendered in the Prometheus text exposition format. Each
+process has a single registry that every module adds its metrics to:
+
+    requests_total = metrics.counter(
+        "server_requests_total", "Requests answered", ["code"])
+    requests_total.inc(labels=("200",))
+
+Updating a metric takes a lock and a dictionary update, so it is cheap
+enough to do for every request. Values that are already counted elsewhere
+(e.g. the evictions of the memory cache) can be read when the metrics are
+rendered instead, by passing a function.
+
+"""
+
+import bisect
+import socket
+import threading
+
+from common import http
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Upper bounds (in seconds) of the buckets of latency histograms
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SCRAPE_TIMEOUT = 5.0  # seconds a scrape request may take to arrive
+
+
+def format_labels(names, values, extra=""):
+    """Formats the labels of a sample.
+
+    Args:
+        names: Label names
+        values: Label values, in the same order
+        extra: Already formatted label to add, e.g. 'le="0.5"'
+
+    Returns:
+        Labels in braces, e.g. '{code="200"}', or "" if there are none
+    """
+    labels = [
+        f'{name}="{escape(str(value))}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape(value):
+    """Escapes a label value.
+
+    Args:
+        value: Label value (str)
+
+    Returns:
+        Value with backslashes, double quotes and newlines escaped
+    """
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+
+
+def format_value(value):
+    """Formats a sample value.
+
+    Args:
+        value: Number
+
+    Returns:
+        Value as Prometheus expects it, e.g. "3", "0.25" or "+Inf"
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    """Base class of the metric types.
+
+    Attributes:
+        name: Metric name
+        description: Description of the metric
+        label_names: Names of the labels every sample has
+    """
+
+    type = "untyped"
+
+    def __init__(self, name, description, label_names=(), function=None):
+        """
+        Args:
+            name: Metric name
+            description: Description of the metric
+            label_names: Names of the labels every sample has
+            function: Function returning the value of the metric when it is
+                rendered, for a metric without labels that is not updated
+                directly
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Returns the current samples of the metric.
+
+        Returns:
+            List of (name suffix, label values, extra label, value) tuples
+        """
+        if self._function is not None:
+            return [("", (), "", self._function())]
+        with self._lock:
+            return [("", labels, "", value)
+                    for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        """Renders the metric in the Prometheus text format.
+
+        Returns:
+            Lines of text (str), each terminated by a newline
+        """
+        lines = [f"# HELP {self.name} {self.description}\n",
+                 f"# TYPE {self.name} {self.type}\n"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}"
+                f"{format_labels(self.label_names, labels, extra)} "
+                f"{format_value(value)}\n"
+            )
+        return "".join(lines)
+
+
+class Counter(Metric):
+    """Value that only goes up, e.g. the number of requests answered."""
+
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        """Adds to the counter.
+
+        Args:
+            amount: Amount to add (not negative)
+            labels: Label values, in the order of label_names
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, e.g. the number of open connections."""
+
+    type = "gauge"
+
+    def inc(self, amount=1, labels=()):
+        """Adds to the gauge.
+
+        Args:
+            amount: Amount to add (negative to subtract)
+            labels: Label values, in the order of label_names
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        """Subtracts from the gauge.
+
+        Args:
+            amount: Amount to subtract
+            labels: Label values, in the order of label_names
+
+        Returns:
+            None
+        """
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        """Sets the gauge.
+
+        Args:
+            value: New value
+            labels: Label values, in the order of label_names
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values, e.g. request latencies.
+
+    Attributes:
+        buckets: Sorted upper bounds of the buckets
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        """
+        Args:
+            name: Metric name
+            description: Description of the metric
+            label_names: Names of the labels every sample has
+            buckets: Upper bounds of the buckets
+        """
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """Records an observed value.
+
+        Args:
+            value: Observed value, e.g. seconds taken
+            labels: Label values, in the order of label_names
+
+        Returns:
+            None
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(labels, list(counts))
+                      for labels, counts in sorted(self._values.items())]
+        samples = []
+        for labels, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                samples.append(
+                    ("_bucket", labels, f'le="{format_value(bound)}"', total))
+            samples.append(("_sum", labels, "", counts[-1]))
+            samples.append(("_count", labels, "", total))
+        return samples
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Adds a metric, or returns the one already added with its name.
+
+        Args:
+            metric: Metric
+
+        Returns:
+            The registered Metric
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Renders every metric in the Prometheus text format.
+
+        Returns:
+            Text (str)
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+# Metrics of this process
+registry = Registry()
+
+
+def counter(name, description, label_names=(), function=None):
+    """Adds a counter to the registry.
+
+    Args:
+        name: Metric name, ending in "_total"
+        description: Description of the metric
+        label_names: Names of the labels every sample has
+        function: Function returning the value, if it is counted elsewhere
+
+    Returns:
+        Counter
+    """
+    return registry.register(Counter(name, description, label_names, function))
+
+
+def gauge(name, description, label_names=(), function=None):
+    """Adds a gauge to the registry.
+
+    Args:
+        name: Metric name
+        description: Description of the metric
+        label_names: Names of the labels every sample has
+        function: Function returning the value, if it is kept elsewhere
+
+    Returns:
+        Gauge
+    """
+    return registry.register(Gauge(name, description, label_names, function))
+
+
+def histogram(name, description, label_names=(),
+              buckets=DEFAULT_BUCKETS):
+    """Adds a histogram to the registry.
+
+    Args:
+        name: Metric name
+        description: Description of the metric
+        label_names: Names of the labels every sample has
+        buckets: Upper bounds of the buckets
+
+    Returns:
+        Histogram
+    """
+    return registry.register(
+        Histogram(name, description, label_names, buckets))
+
+
+def render():
+    """Renders the registry in the Prometheus text format.
+
+    Returns:
+        Text (bytes)
+    """
+    return registry.render().encode()
+
+
+def handle_scrape(client_socket):
+    """Answers a single request on the metrics port.
+
+    The request header is read with the same size limit and deadline as on
+    the other ports (see `http.recv_header`), so that a slow or oversized
+    request cannot hold up the scrapes queued behind it.
+
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    with client_socket:
+        client_socket.settimeout(SCRAPE_TIMEOUT)
+        try:
+            header, _ = http.recv_header(
+                client_socket, timeout=SCRAPE_TIMEOUT)
+            if header is None:
+                return
+            _, target, _, _ = http.parse_request(header)
+            if target.split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", render()
+            else:
+                status, body = "404 Not Found", b""
+            client_socket.sendall(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+        except (OSError, ValueError):
+            pass
+
+
+def serve(metrics_socket):
+    """Answers scrapes one at a time, forever.
+
+    Args:
+        metrics_socket: Listening socket instance
+
+    Returns:
+        None
+    """
+    while True:
+        client_socket, _ = metrics_socket.accept()
+        handle_scrape(client_socket)
+
+
+def start(host, port):
+    """Serves the registry at `/metrics` on a port of its own.
+
+    Scrapes are answered on a background thread.
+
+    Args:
+        host: Hostname to bind to
+        port: Port number to bind to
+
+    Returns:
+        None
+
+    Raises:
+        OSError: If the port could not be bound.
+    """
+    metrics_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    metrics_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    metrics_socket.bind((host, port))
+    metrics_socket.listen()
+    threading.Thread(target=serve, args=(metrics_socket,), daemon=True
+                     ).start()
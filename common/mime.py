@@ -0,0 +1,115 @@
+"""MIME Types
+
+Content types of the files served by the server, looked up by file
+extension, which of them are worth compressing, and parsing of the
+Accept-Encoding header clients use to ask for compressed content.
+
+"""
+
+import mimetypes
+
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+CONTENT_TYPES = {
+    "html": "text/html; charset=utf-8",
+    "htm": "text/html; charset=utf-8",
+    "css": "text/css; charset=utf-8",
+    "scss": "text/x-scss; charset=utf-8",
+    "js": "text/javascript; charset=utf-8",
+    "mjs": "text/javascript; charset=utf-8",
+    "json": "application/json",
+    "map": "application/json",
+    "xml": "application/xml",
+    "txt": "text/plain; charset=utf-8",
+    "md": "text/markdown; charset=utf-8",
+    "csv": "text/csv; charset=utf-8",
+    "svg": "image/svg+xml",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "png": "image/png",
+    "webp": "image/webp",
+    "avif": "image/avif",
+    "ico": "image/x-icon",
+    "woff": "font/woff",
+    "woff2": "font/woff2",
+    "ttf": "font/ttf",
+    "otf": "font/otf",
+    "pdf": "application/pdf",
+    "zip": "application/zip",
+    "gz": "application/gzip",
+    "br": "application/x-brotli",
+    "mp4": "video/mp4",
+    "webm": "video/webm",
+    "mp3": "audio/mpeg",
+    "wasm": "application/wasm"
+}
+# Content types that compress well, other than text/*
+COMPRESSIBLE_TYPES = {
+    "application/json",
+    "application/xml",
+    "application/javascript",
+    "application/wasm",
+    "image/svg+xml",
+    "image/x-icon",
+    "font/ttf",
+    "font/otf"
+}
+
+
+def get_content_type(filename):
+    """Returns the content type of a file.
+
+    Args:
+        filename: File name or path
+
+    Returns:
+        Content type associated with the file extension. Default is
+        "application/octet-stream".
+    """
+    name = filename.rsplit('/', 1)[-1]
+    if '.' in name:
+        content_type = CONTENT_TYPES.get(name.rsplit('.', 1)[-1].lower())
+        if content_type is not None:
+            return content_type
+    content_type, _ = mimetypes.guess_type(name, strict=False)
+    return content_type or DEFAULT_CONTENT_TYPE
+
+
+def is_compressible(content_type):
+    """Returns whether content of a type is worth compressing.
+
+    Args:
+        content_type: Content type, e.g. "text/css; charset=utf-8"
+
+    Returns:
+        True if the content is text-like
+    """
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def parse_accept_encoding(value):
+    """Parses an Accept-Encoding header value.
+
+    Args:
+        value: Accept-Encoding header value, e.g. "gzip, br;q=0.5"
+
+    Returns:
+        Dictionary of lowercase content codings to their weights
+    """
+    weights = {}
+    for item in value.split(','):
+        coding, *parameters = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        weight = 1.0
+        for parameter in parameters:
+            name, _, argument = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    weight = float(argument)
+                except ValueError:
+                    weight = 0.0
+        weights[coding] = weight
+    return weights
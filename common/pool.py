@@ -0,0 +1,164 @@
+"""Connection Pool
+
+Pool of persistent connections to origin servers, keyed by the `host:port` of
+the origin. Used by the cache proxy and the load balancer.
+
+"""
+
+import socket
+import threading
+import time
+
+
+def is_alive(sock):
+    """Checks that an idle connection has not been closed by the server.
+
+    An idle connection should have nothing to read. If the server has closed
+    it, a read returns end of file (or an error) straight away.
+
+    Args:
+        sock: Socket instance
+
+    Returns:
+        True if the connection can still be used
+    """
+    timeout = sock.gettimeout()
+    try:
+        sock.setblocking(False)
+        if sock.recv(1, socket.MSG_PEEK) == b"":
+            # Closed by the server
+            return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.settimeout(timeout)
+    # Holding data the server sent unasked, so the next response would be
+    # read out of step
+    return False
+
+
+class ConnectionPool:
+    """Per-origin pool of idle keep-alive connections.
+
+    Connections are handed out most recently released first, so the warmest
+    connection is reused and the rest age out. Every idle connection is checked
+    before being handed out, and connections idle for longer than
+    idle_timeout are closed (this should be shorter than the server's own
+    keep-alive timeout).
+
+    Attributes:
+        max_size: Maximum number of idle connections kept per origin
+        idle_timeout: Seconds an idle connection is kept before being closed
+        connect_timeout: Seconds to wait for a new connection to be made, or
+            None to wait as long as the operating system allows
+        io_timeout: Seconds each read from or write to a connection may
+            take, or None for no limit
+        created: Number of new connections opened
+        reused: Number of times an idle connection was handed out again
+    """
+
+    def __init__(self, max_size=8, idle_timeout=10.0, connect_timeout=None,
+                 io_timeout=None):
+        """
+        Args:
+            max_size: Maximum number of idle connections kept per origin
+            idle_timeout: Seconds an idle connection is kept before being
+                closed
+            connect_timeout: Seconds to wait for a new connection to be made
+            io_timeout: Seconds each read from or write to a connection may
+                take
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.io_timeout = io_timeout
+        self.created = 0
+        self.reused = 0
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, port):
+        """Returns a connection to an origin, reusing an idle one if possible.
+
+        Args:
+            host: Hostname of origin
+            port: Port number of origin
+
+        Returns:
+            Tuple of (socket, reused) where reused is True if the connection
+            was taken from the pool.
+
+        Raises:
+            OSError: If a new connection could not be made.
+        """
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.get((host, port), [])
+            while idle:
+                sock, released_at = idle.pop()
+                if now - released_at < self.idle_timeout and is_alive(sock):
+                    self.reused += 1
+                    return sock, True
+                sock.close()
+        sock = socket.create_connection((host, port), self.connect_timeout)
+        sock.settimeout(self.io_timeout)
+        with self._lock:
+            self.created += 1
+        return sock, False
+
+    def release(self, host, port, sock, reusable=True):
+        """Returns a connection to the pool once a response has been read.
+
+        Args:
+            host: Hostname of origin
+            port: Port number of origin
+            sock: Socket instance
+            reusable: False if the connection cannot carry another request
+                (e.g. the response was not fully read or the server asked for
+                `Connection: close`), in which case it is closed.
+
+        Returns:
+            None
+        """
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault((host, port), [])
+                if len(idle) < self.max_size:
+                    idle.append((sock, time.monotonic()))
+                    return
+        sock.close()
+
+    def reap(self):
+        """Closes every idle connection that has passed idle_timeout.
+
+        Returns:
+            None
+        """
+        now = time.monotonic()
+        with self._lock:
+            for origin, idle in list(self._idle.items()):
+                kept = []
+                for sock, released_at in idle:
+                    if now - released_at < self.idle_timeout:
+                        kept.append((sock, released_at))
+                    else:
+                        sock.close()
+                if kept:
+                    self._idle[origin] = kept
+                else:
+                    del self._idle[origin]
+
+    def stats(self):
+        """Returns the pool counters.
+
+        Returns:
+            Dictionary of counter names to values
+        """
+        with self._lock:
+            return {
+                "idle": sum(len(idle) for idle in self._idle.values()),
+                "created": self.created,
+                "reused": self.reused
+            }
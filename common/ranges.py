@@ -0,0 +1,158 @@
+"""Byte Ranges
+
+Support for the `Range` and `If-Range` request headers: working out which
+parts of a representation to send, and the header fields and body parts of
+the resulting `206 Partial Content` (or `416 Range Not Satisfiable`)
+response.
+
+A response body is described as a list of parts, each either bytes to send
+as they are or an (offset, count) tuple selecting bytes of the
+representation.
+
+"""
+
+import secrets
+
+MAX_RANGES = 16  # more ranges than this and the whole file is sent
+
+
+def parse_range(value, size):
+    """Parses a Range header value against a representation of a given size.
+
+    Overlapping and adjacent ranges are merged.
+
+    Args:
+        value: Range header value, e.g. "bytes=0-499, -100"
+        size: Size of the representation in bytes
+
+    Returns:
+        Sorted list of (first byte, last byte) tuples, both inclusive. The
+        list is empty if none of the ranges can be satisfied. None if the
+        header is invalid (or asks for too many ranges) and must be ignored.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not sep:
+            return None
+        try:
+            if first.strip():
+                start = int(first)
+                if last.strip():
+                    end = int(last)
+                    if end < start:
+                        return None
+                else:
+                    end = size - 1
+            else:
+                # Suffix range, the last N bytes
+                start = max(0, size - int(last))
+                end = size - 1
+        except ValueError:
+            return None
+        if start < size and start <= end:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(value, etag, last_modified):
+    """Evaluates an If-Range header.
+
+    Args:
+        value: If-Range header value, an entity tag or a date
+        etag: ETag of the representation, if any
+        last_modified: Last-Modified of the representation, if any
+
+    Returns:
+        True if the representation is unchanged, so that the range may be
+        sent
+    """
+    value = value.strip()
+    if value.startswith('"') or value.startswith("W/"):
+        # Weak entity tags never match
+        return etag is not None and not etag.startswith("W/") \
+            and value == etag
+    return last_modified is not None and value == last_modified
+
+
+def get_content_range(start, end, size):
+    """Returns a Content-Range header value.
+
+    Args:
+        start: First byte (inclusive)
+        end: Last byte (inclusive)
+        size: Size of the representation in bytes
+
+    Returns:
+        Content-Range header value, e.g. "bytes 0-499/1234"
+    """
+    return f"bytes {start}-{end}/{size}"
+
+
+def get_partial_response(request_headers, fields, size):
+    """Works out the partial response to a request, if it asks for one.
+
+    Args:
+        request_headers: Request header fields (lowercase names)
+        fields: Header fields of the full 200 response, including
+            Content-Type and any ETag and Last-Modified
+        size: Size of the representation in bytes
+
+    Returns:
+        Tuple of (status, header fields, body parts), or None if the whole
+        representation should be sent with 200
+    """
+    value = request_headers.get("range")
+    if value is None:
+        return None
+    if_range = request_headers.get("if-range")
+    if if_range is not None and not if_range_matches(
+            if_range, fields.get("ETag"), fields.get("Last-Modified")):
+        return None
+    ranges = parse_range(value, size)
+    if ranges is None:
+        return None
+    if not ranges:
+        return "416 Range Not Satisfiable", {
+            "Content-Length": 0,
+            "Content-Range": f"bytes */{size}"
+        }, []
+
+    fields = dict(fields)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        fields["Content-Length"] = end - start + 1
+        fields["Content-Range"] = get_content_range(start, end, size)
+        return "206 Partial Content", fields, [(start, end - start + 1)]
+
+    boundary = secrets.token_hex(16)
+    parts = []
+    for i, (start, end) in enumerate(ranges):
+        parts.append((
+            ("\r\n" if i else "")
+            + f"--{boundary}\r\n"
+            + f"Content-Type: {fields['Content-Type']}\r\n"
+            + f"Content-Range: {get_content_range(start, end, size)}\r\n"
+            + "\r\n"
+        ).encode())
+        parts.append((start, end - start + 1))
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    fields["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    fields["Content-Length"] = sum(
+        len(part) if isinstance(part, bytes) else part[1] for part in parts)
+    return "206 Partial Content", fields, parts
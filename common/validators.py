@@ -0,0 +1,108 @@
+"""Validators
+
+Support for the `ETag` and `Last-Modified` validators and the conditional
+request headers that use them (`If-None-Match` and `If-Modified-Since`, see
+RFC 7232), shared by the server and the cache proxy.
+
+Dates are sent in the preferred format of RFC 7231 (IMF-fixdate, e.g.
+"Sun, 06 Nov 1994 08:49:37 GMT"), and read in any of its three formats.
+
+"""
+
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+
+
+def format_date(timestamp):
+    """Formats a time as an HTTP date.
+
+    Args:
+        timestamp: Seconds since the epoch
+
+    Returns:
+        HTTP date (IMF-fixdate), e.g. "Sun, 06 Nov 1994 08:49:37 GMT"
+    """
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_date(value):
+    """Parses an HTTP date.
+
+    Args:
+        value: HTTP date, in IMF-fixdate, RFC 850 or asctime format
+
+    Returns:
+        Seconds since the epoch, or None if value is not a valid date
+    """
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is None:
+        # asctime dates carry no zone, but HTTP dates are always in GMT
+        date = date.replace(tzinfo=timezone.utc)
+    return date.timestamp()
+
+
+def parse_etags(value):
+    """Splits an If-None-Match (or If-Match) header value into entity tags.
+
+    Args:
+        value: Header value, e.g. '"abc", W/"def"' or "*"
+
+    Returns:
+        List of entity tags, each as sent (with quotes and any W/ prefix)
+    """
+    etags = []
+    for etag in value.split(","):
+        etag = etag.strip()
+        if etag:
+            etags.append(etag)
+    return etags
+
+
+def etag_matches(value, etag):
+    """Evaluates an If-None-Match header value against an entity tag.
+
+    Entity tags are compared weakly, i.e. ignoring any W/ prefix, as RFC 7232
+    requires for If-None-Match.
+
+    Args:
+        value: If-None-Match header value
+        etag: ETag of the representation, if any
+
+    Returns:
+        True if one of the entity tags matches the representation
+    """
+    etags = parse_etags(value)
+    if "*" in etags:
+        return etag is not None
+    if etag is None:
+        return False
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    return any(
+        (e[2:] if e.startswith("W/") else e) == opaque for e in etags)
+
+
+def is_not_modified(request_headers, etag, last_modified):
+    """Evaluates the conditional headers of a GET (or HEAD) request.
+
+    If-None-Match takes precedence: If-Modified-Since is only evaluated if
+    the request has no If-None-Match header.
+
+    Args:
+        request_headers: Request header fields (lowercase names)
+        etag: ETag of the representation, if any
+        last_modified: Last modification time of the representation
+            (seconds since the epoch), if known
+
+    Returns:
+        True if the client's copy is up to date, so 304 should be sent
+    """
+    if "if-none-match" in request_headers:
+        return etag_matches(request_headers["if-none-match"], etag)
+    if "if-modified-since" not in request_headers or last_modified is None:
+        return False
+    since = parse_date(request_headers["if-modified-since"])
+    # Not a date, so the condition is ignored
+    return since is not None and int(last_modified) <= since
@@ -0,0 +1,137 @@
+"""Entity Tags
+
+Index of the hashes of the contents of the files served by the server, from
+which their strong entity tags (ETag) are derived. Each digest is kept with
+the size and modification time of the file it was computed from, so a file
+is only hashed again once it has changed.
+
+Hashing a large file takes a while, so it is never done while answering a
+request. The file index, which is refreshed on a background thread, hashes
+files as it finds them. Without an index, every file is hashed once when the
+server starts (see `HashIndex.hash_all`). A file that was not hashed then
+(added or changed since) gets no digest, and is tagged by its size and
+modification time instead (see `static.get_etag`). It keeps that tag until
+it changes again, as a tag that changed while the contents did not would
+make caches fetch the file again and fail their If-Range requests.
+
+"""
+
+import hashlib
+import os
+import threading
+
+CHUNK_SIZE = 1024 * 1024  # bytes read at a time while hashing
+DIGEST_SIZE = 16  # bytes, sent as 32 hex digits
+
+
+def hash_file(path):
+    """Hashes the contents of a file.
+
+    Args:
+        path: Path to the file
+
+    Returns:
+        Hex digest (str)
+
+    Raises:
+        OSError: If the file could not be read.
+    """
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashIndex:
+    """Digests of file contents, keyed by path, size and modification time.
+
+    Attributes:
+        hashed: Number of files hashed so far
+    """
+
+    def __init__(self):
+        self.hashed = 0
+        self._digests = {}  # path -> (size, mtime_ns, digest)
+        self._lock = threading.Lock()
+
+    def get(self, path, stat, wait=False):
+        """Returns the digest of a file.
+
+        Args:
+            path: Path to the file
+            stat: Result of os.stat(path)
+            wait: Whether to hash the file now if its digest is not known
+
+        Returns:
+            Hex digest of the file as it was when stat was taken, or None if
+            it is not known
+
+        Raises:
+            OSError: If the file had to be hashed now and could not be read.
+        """
+        with self._lock:
+            known = self._digests.get(path)
+        if known is not None and known[:2] == (stat.st_size,
+                                               stat.st_mtime_ns):
+            return known[2]
+        if wait:
+            return self._hash(path, stat)
+        return None
+
+    def hash_all(self, root):
+        """Hashes every file under a directory.
+
+        Args:
+            root: Directory holding the files
+
+        Returns:
+            None
+        """
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    self._hash(path, os.stat(path))
+                except OSError:
+                    # Removed (or unreadable) since it was listed
+                    continue
+
+    def retain(self, paths):
+        """Forgets the digests of every file not in paths.
+
+        Args:
+            paths: Paths of the files that still exist (a collection
+                supporting `in`)
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._digests = {
+                path: known for path, known in self._digests.items()
+                if path in paths
+            }
+
+    def _hash(self, path, stat):
+        """Hashes a file and keeps its digest.
+
+        Args:
+            path: Path to the file
+            stat: Result of os.stat(path) before hashing
+
+        Returns:
+            Hex digest, or None if the file changed while being hashed
+
+        Raises:
+            OSError: If the file could not be read.
+        """
+        digest = hash_file(path)
+        after = os.stat(path)
+        version = (stat.st_size, stat.st_mtime_ns)
+        if (after.st_size, after.st_mtime_ns) != version:
+            return None
+        with self._lock:
+            self._digests[path] = (*version, digest)
+            self.hashed += 1
+        return digest
@@ -9,49 +9,159 @@ This script requires python3 to be installed.
 
 import socket
 import os
+import signal
 import sys
-from datetime import datetime
+import threading
+import time
+import traceback
 
-BUFFER_SIZE = 1024
+# Make the shared modules in common/ importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import etags  # noqa: E402
+import static  # noqa: E402
+from common import accesslog, admission, http, metrics, ranges, \
+    validators  # noqa: E402
 
+KEEP_ALIVE_TIMEOUT = 15.0  # seconds
+DEFAULT_BACKLOG = socket.SOMAXCONN
+HEALTH_PATH = "/health"  # answered without touching the disk
+METRICS_PATH = "/metrics"  # Prometheus metrics of the process
+DRAIN_TIMEOUT = 10.0  # seconds given to open requests on shutdown
+RESTART_DELAY = 1.0  # seconds, before restarting a worker that died at once
+FILES_DIR = "./files"
 
-def get_content_length(file):
-    """Returns the size (in bytes) of a file.
+# Index of the files under FILES_DIR, created by main() unless disabled
+file_index = None
+# Log of every request answered, opened by main() if enabled
+access_log = None
+# Cap on the connections served at once, created by main()
+connection_limit = None
+# Digests of the files for their ETags when there is no file_index, created
+# by main()
+content_hashes = None
+
+# Open client connections, mapped to whether a request is being answered on
+# them (False while waiting for the next request), see drain()
+connections = {}
+connections_lock = threading.Lock()
+# Set once the server has stopped accepting connections
+draining = threading.Event()
+
+requests_total = metrics.counter(
+    "server_requests_total", "Requests answered, by status code", ["code"])
+request_duration = metrics.histogram(
+    "server_request_duration_seconds", "Time taken to answer a request")
+response_bytes = metrics.counter(
+    "server_response_bytes_total", "Bytes of response bodies sent")
+active_connections = metrics.gauge(
+    "server_connections_active", "Client connections currently open")
+metrics.counter(
+    "server_connections_rejected_total",
+    "Connections answered with 503 as too many were open",
+    function=lambda: connection_limit.rejected)
+metrics.gauge(
+    "server_file_index_memory_bytes",
+    "Bytes of file contents held in memory by the file index",
+    function=lambda: file_index.size if file_index is not None else 0)
+
+
+def get_static_file(requested_file):
+    """Looks up a file, in the index if there is one.
 
     Args:
-        file: Filename (relative to server/)
+        requested_file: Requested path, e.g. "/styles/main.css"
 
     Returns:
-        Size (in bytes) of file.
+        StaticFile, or None if there is no such file
     """
-    return os.stat(file).st_size
+    if file_index is not None:
+        return file_index.get(requested_file)
+    return static.find_file(FILES_DIR, requested_file, content_hashes)
 
 
-def get_content_type(file_ext):
-    """Returns the content type of a file.
+def send_response(client_socket, header, static_file, parts=None):
+    """Sends a response header and the contents of a file.
+
+    Parts of a file held in memory are sent in the same call as the header.
+    Otherwise the file is sent with `socket.sendfile`, which lets the kernel
+    copy the file straight into the socket (zero-copy) where `os.sendfile` is
+    available, and falls back to buffered sends otherwise.
 
     Args:
-        file_ext: File extension
+        client_socket: Client socket instance
+        header: Response header (bytes)
+        static_file: StaticFile to send as body, or None for no body
+        parts: Body parts (see `ranges`) to send instead of the whole file
 
     Returns:
-        Content type associated with file extension. Default is "text/html".
+        None
+
+    Raises:
+        ConnectionError: If the file shrank since it was indexed, in which
+            case the response is cut short and the connection must be closed.
     """
-    if file_ext in ["jpg", "jpeg"]:
-        return "image/jpeg"
-    elif file_ext == "gif":
-        return "image/gif"
-    else:
-        return "text/html"
+    if parts is None:
+        parts = [(0, static_file.size)] if static_file is not None else []
+    pending = [header]
+    f = None
+    try:
+        for part in parts:
+            if isinstance(part, bytes):
+                pending.append(part)
+                continue
+            offset, count = part
+            if static_file.body is not None:
+                pending.append(
+                    memoryview(static_file.body)[offset:offset + count])
+                continue
+            client_socket.sendall(b"".join(pending))
+            pending = []
+            if f is None:
+                f = open(static_file.path, "rb")
+            # Never send more than asked for, even if the file grew
+            sent = client_socket.sendfile(f, offset, count)
+            if sent < count:
+                raise ConnectionError("File changed while being sent")
+        if pending:
+            client_socket.sendall(b"".join(pending))
+    finally:
+        if f is not None:
+            f.close()
 
 
-def main(host, port):
-    """Main function of the script.
+def is_not_modified(static_file, headers):
+    """Evaluates the If-None-Match and If-Modified-Since headers of a request.
 
-    TCP socket will be created and bound to the specified port number on host.
-    The server will listen to for incoming TCP requests. When a valid request
-    for a file is received, a response will be sent back to the client with the
-    file as payload. If the request is not valid, or requested file does not
-    exist then an appropriate error code will be sent back as response.
+    Args:
+        static_file: StaticFile requested
+        headers: Request header fields (lowercase names)
+
+    Returns:
+        True if the client's copy is up to date, so 304 should be sent
+    """
+    return validators.is_not_modified(
+        headers, static_file.fields["ETag"], static_file.last_modified)
+
+
+def build_header(status, fields):
+    """Builds an HTTP/1.1 response header.
+
+    Args:
+        status: Status code and reason phrase, e.g. "200 OK"
+        fields: Dictionary of header field names to values
+
+    Returns:
+        Response header (str), terminated by an empty line
+    """
+    header = f"HTTP/1.1 {status}\r\n"
+    for name, value in fields.items():
+        header += f"{name}: {value}\r\n"
+    return header + "\r\n"
+
+
+def handle_request(method, requested_file, protocol, headers):
+    """Builds the response for a single request.
 
     If a client uses a version other than HTTP/1.1 in their request, a 505
     error will be sent as a response.
@@ -59,96 +169,440 @@ def main(host, port):
     sent as a response.
     If a client requests a file that does not exist, a 404 error will be sent
     as a response.
-    Otherwise, the requested file will be sent back, along with 202 status code.
+    A GET of HEALTH_PATH is answered with an empty 200 response, so that the
+    load balancer can check the server cheaply, and a GET of METRICS_PATH
+    with the metrics of the process (see `metrics`).
+    Otherwise, the requested file will be sent back, along with 200 status
+    code. Text files are sent compressed if the client accepts it (see
+    `static.choose_variant`). If the request has a Range header, only the
+    requested parts are sent, with 206 status code (see `ranges`).
+
+    Every response carries a Content-Length so that the connection can be
+    kept open for further requests.
+
+    Args:
+        method: Request method
+        requested_file: Requested path
+        protocol: Request protocol version
+        headers: Request header fields (lowercase names)
+
+    Returns:
+        Tuple of (status, header fields, StaticFile to send as body or None,
+        body parts or None to send the whole file). The header fields may be
+        shared with other responses and must not be changed.
+    """
+    # Prepare response
+    if protocol != "HTTP/1.1":
+        status = "505 Version Not Supported"
+        error_page = "/errors/505.html"
+    elif method != "GET":
+        status = "501 Method Not Implemented"
+        error_page = "/errors/501.html"
+    elif requested_file == HEALTH_PATH:
+        return "200 OK", {"Content-Length": 0}, None, None
+    elif requested_file == METRICS_PATH:
+        body = metrics.render()
+        return "200 OK", {
+            "Content-Length": len(body),
+            "Content-Type": metrics.CONTENT_TYPE
+        }, None, [body]
+    elif (static_file := get_static_file(requested_file)) is not None:
+        static_file = static.choose_variant(
+            static_file, headers.get("accept-encoding"))
+        if is_not_modified(static_file, headers):
+            # Content-Length still describes the file, but no body is sent
+            return "304 Not Modified", static_file.fields, None, None
+        partial = ranges.get_partial_response(
+            headers, static_file.fields, static_file.size)
+        if partial is not None:
+            status, fields, parts = partial
+            return status, fields, static_file, parts
+        return "200 OK", static_file.fields, static_file, None
+    else:
+        status = "404 Not Found"
+        error_page = "/errors/404.html"
+    error_file = get_static_file(error_page)
+    fields = {
+        "Content-Length": error_file.size,
+        "Content-Type": "text/html"
+    }
+    return status, fields, error_file, None
+
+
+def record_request(client, method, requested_file, status, length,
+                   started):
+    """Updates the metrics and the access log once a request is answered.
+
+    Args:
+        client: Address of the client ("<host>:<port>")
+        method: Request method, or None if the request could not be parsed
+        requested_file: Requested path, or None
+        status: Status code and reason phrase, e.g. "200 OK"
+        length: Bytes of response body sent
+        started: time.perf_counter() when the request was received
 
     Returns:
         None
     """
-    # Bind server to socket and listen for requests
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((host, port))
-    server_socket.listen(1)
-    print(f"Server listening on port {port}...")
+    duration = time.perf_counter() - started
+    code = status.split(' ', 1)[0]
+    requests_total.inc(labels=(code,))
+    request_duration.observe(duration)
+    response_bytes.inc(length)
+    if access_log is not None:
+        access_log.log(
+            client=client,
+            method=method,
+            path=requested_file,
+            status=int(code),
+            bytes=length,
+            duration_ms=round(duration * 1000, 3)
+        )
+
+
+def handle_client(client_socket):
+    """Serves a single client connection.
+
+    Runs on its own thread so that a slow client does not hold up any other
+    connection. The connection is kept alive and requests are answered in the
+    order they arrive (so pipelined requests are supported) until the client
+    closes it, asks for `Connection: close`, or stays idle for longer than
+    KEEP_ALIVE_TIMEOUT. Once the first byte of a request has arrived, the
+    whole request header must arrive within admission.REQUEST_TIMEOUT, and
+    the client must read each response in the time admission.DeadlineSocket
+    gives it. Once the server is draining, the connection is closed after
+    the response being sent. The connection's slot in connection_limit is
+    released when it is closed.
 
-    while True:
-        # Make TCP connection with client
-        client_socket, client_address = server_socket.accept()
-
-        # Receive request from client
-        request = client_socket.recv(BUFFER_SIZE).decode()
-        if not request:
-            continue
-        split_request = request.split('\n')
-
-        request_line = split_request[0]
-        method, requested_file, protocol = request_line.split(' ')
-        file = "./files" + requested_file
-        file_ext = file.rsplit('.', 1)[-1]
-
-        # Prepare response
-        if protocol.strip('\r') != "HTTP/1.1":
-            response_header = "HTTP/1.1 505 Version Not Supported\r\n\r"
-            response_body = "files/errors/505.html"
-        elif method != "GET":
-            response_header = "HTTP/1.1 501 Method Not Implemented\r\n\r"
-            response_body = "files/errors/501.html"
-        elif os.path.isfile(file):
-            server_last_modified_str = datetime.strftime(
-                datetime.fromtimestamp(os.path.getmtime(file)),
-                "%a, %w %b %Y %H:%M:%S"
-            )
-            if len(split_request) == 4:
-                # Conditional GET
-                # Get datetime for last modification
-                server_last_modified_dt = datetime.strptime(
-                    server_last_modified_str,
-                    "%a, %w %b %Y %H:%M:%S"
+    Args:
+        client_socket: Client socket instance
+
+    Returns:
+        None
+    """
+    with client_socket:
+        client_socket.settimeout(KEEP_ALIVE_TIMEOUT)
+        # Responses are sent through it, so that slow readers are cut off
+        response_socket = admission.DeadlineSocket(client_socket)
+        buffer = b""
+        keep_alive = True
+        active_connections.inc()
+        try:
+            client = "%s:%d" % client_socket.getpeername()[:2]
+            while keep_alive:
+                with connections_lock:
+                    connections[client_socket] = False
+                if draining.is_set():
+                    break
+                # Receive request from client
+                request, buffer = http.recv_header(
+                    client_socket, buffer,
+                    timeout=admission.REQUEST_TIMEOUT)
+                if request is None:
+                    break
+                started = time.perf_counter()
+                response_socket.start_response()
+                with connections_lock:
+                    connections[client_socket] = True
+                try:
+                    method, requested_file, protocol, headers = \
+                        http.parse_request(request)
+                except ValueError:
+                    response_socket.send(build_header(
+                        "400 Bad Request",
+                        {"Content-Length": 0, "Connection": "close"}
+                    ).encode())
+                    record_request(client, None, None, "400 Bad Request", 0,
+                                   started)
+                    break
+                status, fields, response_body, parts = handle_request(
+                    method, requested_file, protocol, headers)
+
+                # Any request body is not read, so only GET requests can be
+                # followed by another request on the same connection
+                keep_alive = (
+                    method == "GET"
+                    and protocol == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                    and not draining.is_set()
                 )
-                # Retrieve date from request string
-                if_modified_date = split_request[2].split(' ', 1)[1]
-                if_modified_date = if_modified_date.rsplit(' ', 1)[0]
-                client_last_modified_dt = datetime.strptime(
-                    if_modified_date,
-                    "%a, %w %b %Y %H:%M:%S"
+                if not keep_alive:
+                    fields = dict(fields, Connection="close")
+
+                # Send response
+                send_response(
+                    response_socket,
+                    build_header(status, fields).encode(),
+                    response_body,
+                    parts
                 )
-                if client_last_modified_dt < server_last_modified_dt:
-                    response_header = f"""HTTP/1.1 200 OK\r
-Last-Modified: {server_last_modified_str}\r
-\r"""
-                    response_body = file
-                else:
-                    response_header = f"""HTTP/1.1 304 Not Modified\r
-Last-Modified: {server_last_modified_str}\r
-\r"""
-                    response_body = None
-            else:
-                content_length = get_content_length(file)
-                content_type = get_content_type(file_ext)
-                response_header = f"""HTTP/1.1 200 OK\r
-Content-Length: {content_length}\r
-Content-Type: {content_type}\r
-\r"""
-                response_body = file
-        else:
-            response_header = "HTTP/1.1 404 Not Found\r\n\r"
-            response_body = "files/errors/404.html"
-
-        # Send response
-        client_socket.send(response_header.encode())
-        if response_body:
-            with open(response_body, "rb") as file:
-                data = file.read(BUFFER_SIZE)
-                while data:
-                    client_socket.send(data)
-                    data = file.read(BUFFER_SIZE)
-        if response_header:
-            client_socket.shutdown(socket.SHUT_WR)
+                length = fields["Content-Length"]
+                if status.startswith("304"):
+                    length = 0
+                record_request(client, method, requested_file, status,
+                               length, started)
+        except OSError:
+            # Includes timeouts and connections reset by the client
+            pass
+        finally:
+            active_connections.dec()
+            connection_limit.release()
+            with connections_lock:
+                connections.pop(client_socket, None)
+
+
+def drain(server_socket):
+    """Stops accepting connections and waits for open requests to finish.
+
+    Connections waiting for their next request are closed straight away.
+    Connections in the middle of a response are closed once it has been sent,
+    or when DRAIN_TIMEOUT runs out.
+
+    Args:
+        server_socket: Listening socket instance
+
+    Returns:
+        None
+    """
+    draining.set()
+    server_socket.close()
+    with connections_lock:
+        for client_socket, busy in connections.items():
+            if not busy:
+                try:
+                    client_socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline:
+        with connections_lock:
+            if not connections:
+                return
+        time.sleep(0.1)
+
+
+def create_socket(host, port, backlog, reuse_port=False):
+    """Creates a listening socket.
+
+    Args:
+        host: Hostname to bind to
+        port: Port number to bind to
+        backlog: Maximum number of pending connections in the listen queue
+        reuse_port: Whether other sockets may listen on the same port (with
+            SO_REUSEPORT), in which case the kernel spreads incoming
+            connections between them
+
+    Returns:
+        Socket instance
+    """
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(backlog)
+    return server_socket
+
+
+def serve(server_socket):
+    """Accepts connections until interrupted, then drains.
+
+    Each accepted connection is handed off to its own thread (see
+    `handle_client`), unless connection_limit is reached, in which case it is
+    answered with 503 straight away. SIGTERM is handled like Ctrl-C (SIGINT).
+
+    Args:
+        server_socket: Listening socket instance
+
+    Returns:
+        None
+    """
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    if file_index is not None:
+        file_index.start()
+    try:
+        while True:
+            # Make TCP connection with client
+            client_socket, client_address = server_socket.accept()
+            if not connection_limit.admit():
+                admission.reject(client_socket)
+                continue
+            try:
+                threading.Thread(
+                    target=handle_client,
+                    args=(client_socket,),
+                    daemon=True
+                ).start()
+            except RuntimeError:
+                # No more threads can be started
+                connection_limit.release()
+                admission.reject(client_socket)
+    except KeyboardInterrupt:
+        drain(server_socket)
+
+
+def start_worker(host, port, backlog, server_socket=None):
+    """Forks a worker process which serves connections until interrupted.
+
+    Args:
+        host: Hostname to bind to
+        port: Port number to bind to
+        backlog: Maximum number of pending connections in the listen queue
+        server_socket: Listening socket shared by all workers, or None for the
+            worker to listen on its own socket with SO_REUSEPORT
+
+    Returns:
+        Process ID of the worker
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        if server_socket is None:
+            server_socket = create_socket(host, port, backlog, True)
+        serve(server_socket)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def supervise(host, port, backlog, workers):
+    """Runs worker processes sharing a port, restarting any that exit.
+
+    Where SO_REUSEPORT is available, every worker listens on its own socket
+    and the kernel spreads connections between them. Otherwise the socket is
+    created before forking and shared by all workers.
+
+    On Ctrl-C (SIGINT) or SIGTERM, every worker is asked to drain and the
+    supervisor waits for them to exit.
+
+    Args:
+        host: Hostname to bind to
+        port: Port number to bind to
+        backlog: Maximum number of pending connections in the listen queue
+        workers: Number of worker processes
+
+    Returns:
+        None
+    """
+    server_socket = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        server_socket = create_socket(host, port, backlog)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    children = {}  # process ID -> time started
+    try:
+        for _ in range(workers):
+            pid = start_worker(host, port, backlog, server_socket)
+            children[pid] = time.monotonic()
+        print(f"Server listening on port {port} with {workers} workers...")
+        while True:
+            pid, status = os.wait()
+            started = children.pop(pid, None)
+            if started is None:
+                continue
+            print(f"Worker {pid} exited with status "
+                  f"{os.waitstatus_to_exitcode(status)}, restarting...")
+            # Do not spin if workers die straight away (e.g. cannot bind)
+            if time.monotonic() - started < RESTART_DELAY:
+                time.sleep(RESTART_DELAY)
+            pid = start_worker(host, port, backlog, server_socket)
+            children[pid] = time.monotonic()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        while children:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            children.pop(pid, None)
+
+
+def main(host, port, backlog=DEFAULT_BACKLOG, workers=1,
+         memory_size=static.DEFAULT_MEMORY_SIZE, access_log_path=None,
+         max_connections=admission.DEFAULT_MAX_CONNECTIONS):
+    """Main function of the script.
+
+    TCP socket will be created and bound to the specified port number on host.
+    The server will listen to for incoming TCP requests. Each accepted
+    connection is handed off to its own thread (see `handle_client`), so any
+    number of clients can be served at the same time. When a valid request
+    for a file is received, a response will be sent back to the client with the
+    file as payload. If the request is not valid, or requested file does not
+    exist then an appropriate error code will be sent back as response.
+
+    Files are indexed on startup (see `static.FileIndex`), so that their
+    header fields are only worked out once and small files can be sent from
+    memory. Their ETags are derived from a hash of their contents, computed
+    as they are indexed (or, without an index, once on startup).
+
+    With more than one worker, the server runs that many processes sharing
+    the port (see `supervise`), so that it can use more than one CPU core.
+    Each worker keeps metrics of its own, so a scrape of METRICS_PATH only
+    covers the worker that answers it.
+
+    Each worker serves up to max_connections connections at once, and
+    answers any more with `503 Service Unavailable` and Retry-After (see
+    `admission`), so that the clients already connected keep being served
+    promptly when the server is overloaded.
+
+    Args:
+        host: Hostname to bind to
+        port: Port number to bind to
+        backlog: Maximum number of pending connections in the listen queue
+        workers: Number of worker processes
+        memory_size: Memory budget (in bytes) for the contents of indexed
+            files, or 0 to look files up on disk for every request instead of
+            indexing them
+        access_log_path: Path of the access log (see `accesslog`), "-" for
+            standard output, or None for no access log
+        max_connections: Maximum number of connections served at once by
+            each worker
+
+    Returns:
+        None
+    """
+    global file_index, access_log, connection_limit, content_hashes
+    connection_limit = admission.ConnectionLimit(max_connections)
+    if access_log_path is not None:
+        access_log = accesslog.AccessLog(access_log_path)
+    if memory_size:
+        # Created before any worker is forked, so workers share its memory
+        file_index = static.FileIndex(FILES_DIR, memory_size)
+    else:
+        # Hashed before serving, so that the ETag of a file does not change
+        # after it has been sent
+        content_hashes = etags.HashIndex()
+        content_hashes.hash_all(FILES_DIR)
+    if workers > 1:
+        supervise(host, port, backlog, workers)
+        return
+    # Bind server to socket and listen for requests
+    server_socket = create_socket(host, port, backlog)
+    print(f"Server listening on port {port}...")
+    serve(server_socket)
 
 
 if __name__ == '__main__':
     try:
         hostname = 'localhost'
         port_number = 0
+        backlog = DEFAULT_BACKLOG
+        workers = 1
+        memory_size = static.DEFAULT_MEMORY_SIZE
+        access_log_path = None
+        max_connections = admission.DEFAULT_MAX_CONNECTIONS
         args = sys.argv[1:]
         for arg in args:
             split_arg = arg.split('=')
@@ -156,10 +610,26 @@ if __name__ == '__main__':
                 hostname = split_arg[1]
             elif split_arg[0] == 'PORT':
                 port_number = int(split_arg[1])
+            elif split_arg[0] == 'BACKLOG':
+                backlog = int(split_arg[1])
+            elif split_arg[0] == 'WORKERS':
+                workers = int(split_arg[1])
+                if workers < 1:
+                    raise ValueError('number of workers must be at least 1.')
+            elif split_arg[0] == 'MEMORY_SIZE':
+                memory_size = int(split_arg[1])
+            elif split_arg[0] == 'ACCESS_LOG':
+                access_log_path = split_arg[1]
+            elif split_arg[0] == 'MAX_CONNECTIONS':
+                max_connections = int(split_arg[1])
+                if max_connections < 1:
+                    raise ValueError(
+                        'maximum number of connections must be at least 1.')
             else:
                 raise ValueError(f'incorrect argument: {split_arg[0]}')
         if not port_number:
             raise ValueError('port number must be provided.')
-        main(hostname, port_number)
+        main(hostname, port_number, backlog, workers, memory_size,
+             access_log_path, max_connections)
     except ValueError as err:
         print('ValueError:', err)
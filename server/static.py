@@ -0,0 +1,401 @@
+"""Static Files
+
+Index of the files served by the server. Each file's response header fields
+(Content-Length, Content-Type, Last-Modified, ETag) are worked out once, and
+the contents of small files are kept in memory, so that a request only needs
+a dictionary lookup before the response is sent. The index is kept up to
+date by checking the modification times of the files in the background.
+ETags are strong entity tags derived from a hash of the contents (see
+`etags`).
+
+Text files are also offered compressed (see `choose_variant`). A compressed
+copy stored next to a file (e.g. `main.css.gz` or `main.css.br`) is used if
+it is at least as new as the file. Otherwise files held in memory are
+compressed when they are indexed.
+
+"""
+
+import gzip
+import os
+import threading
+import time
+from collections import namedtuple
+
+import etags
+from common import mime, validators
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DEFAULT_MEMORY_SIZE = 16 * 1024 * 1024  # bytes
+DEFAULT_MAX_FILE_SIZE = 256 * 1024  # bytes
+POLL_INTERVAL = 1.0  # seconds
+# Content codings offered to clients, most preferred first, with the suffix
+# of the pre-compressed copy of a file
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+StaticFile = namedtuple(
+    "StaticFile",
+    ["path", "size", "version", "fields", "last_modified", "body",
+     "variants"]
+)
+
+
+def compress(data, encoding):
+    """Compresses data with a content coding.
+
+    Args:
+        data: Bytes to compress
+        encoding: Content coding, one of ENCODINGS
+
+    Returns:
+        Compressed bytes, or None if the coding is not available
+    """
+    if encoding == "gzip":
+        # mtime=0 so that the output only depends on the data
+        return gzip.compress(data, 9, mtime=0)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(data)
+    return None
+
+
+def choose_variant(static_file, accept_encoding):
+    """Picks the copy of a file to send to a client.
+
+    Args:
+        static_file: StaticFile
+        accept_encoding: Value of the request's Accept-Encoding header
+
+    Returns:
+        The compressed variant with the highest weight in accept_encoding
+        (ties go to the first in ENCODINGS), or static_file itself if the
+        client accepts none of them
+    """
+    if not static_file.variants or not accept_encoding:
+        return static_file
+    weights = mime.parse_accept_encoding(accept_encoding)
+    best = static_file
+    best_weight = 0.0
+    for encoding, variant in static_file.variants.items():
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best = variant
+            best_weight = weight
+    return best
+
+
+def get_path(root, requested_file):
+    """Maps a requested path to a file under root.
+
+    Args:
+        root: Directory holding the files
+        requested_file: Requested path, e.g. "/styles/main.css"
+
+    Returns:
+        Path to the file, or None if the requested path points outside root
+    """
+    parts = requested_file.split('/')
+    if ".." in parts:
+        return None
+    return os.path.join(root, *[part for part in parts if part])
+
+
+def get_memory_size(static_file):
+    """Returns the number of bytes a file and its variants hold in memory.
+
+    Args:
+        static_file: StaticFile
+
+    Returns:
+        Size in bytes
+    """
+    return sum(
+        len(f.body) for f in [static_file, *static_file.variants.values()]
+        if f.body is not None
+    )
+
+
+def get_version(stat, siblings):
+    """Returns a value that changes whenever a file or its variants change.
+
+    Args:
+        stat: Result of os.stat() for the file
+        siblings: Dictionary of content codings to the result of os.stat()
+            for the pre-compressed copy of the file
+
+    Returns:
+        Tuple of sizes and modification times
+    """
+    return (stat.st_size, stat.st_mtime_ns) + tuple(
+        (encoding, s.st_size, s.st_mtime_ns)
+        for encoding, s in sorted(siblings.items())
+    )
+
+
+def get_etag(path, stat, hashes=None, wait=False):
+    """Returns the entity tag of a file, without quotes.
+
+    Args:
+        path: Path to the file
+        stat: Result of os.stat(path)
+        hashes: etags.HashIndex to take the digest of the contents from, if
+            any
+        wait: Whether to hash the file now if its digest is not known
+
+    Returns:
+        Digest of the contents, or a tag made of the size and modification
+        time of the file if the digest is not known
+
+    Raises:
+        OSError: If the file had to be hashed now and could not be read.
+    """
+    digest = None if hashes is None else hashes.get(path, stat, wait)
+    if digest is None:
+        return f"{stat.st_size:x}-{stat.st_mtime_ns:x}"
+    return digest
+
+
+def load_file(path, stat, siblings, keep_body=False, hashes=None,
+              wait=False):
+    """Works out the response header fields of a file and its variants.
+
+    Args:
+        path: Path to the file
+        stat: Result of os.stat(path)
+        siblings: Dictionary of content codings to the result of os.stat()
+            for the pre-compressed copy of the file, for those that exist
+        keep_body: Whether to read the contents of the file into memory
+        hashes: etags.HashIndex for the ETags of the file and its variants,
+            if any
+        wait: Whether to hash files whose digest is not known now (see
+            `get_etag`)
+
+    Returns:
+        StaticFile. Its fields are shared by every response for the file and
+        must not be changed.
+
+    Raises:
+        OSError: If the file could not be read.
+    """
+    # Compared against If-Modified-Since, to the same precision
+    last_modified = int(stat.st_mtime)
+    etag = get_etag(path, stat, hashes, wait)
+    content_type = mime.get_content_type(path)
+    fields = {
+        "Content-Length": stat.st_size,
+        "Content-Type": content_type,
+        "Last-Modified": validators.format_date(last_modified),
+        "ETag": f'"{etag}"',
+        "Accept-Ranges": "bytes"
+    }
+    body = None
+    if keep_body:
+        with open(path, "rb") as f:
+            body = f.read()
+
+    variants = {}
+    if mime.is_compressible(content_type):
+        # Caches must not send one client's encoding to another
+        fields["Vary"] = "Accept-Encoding"
+        for encoding, suffix in ENCODINGS.items():
+            sibling = siblings.get(encoding)
+            variant_path = None
+            variant_body = None
+            if sibling is not None and sibling.st_mtime_ns >= stat.st_mtime_ns:
+                variant_path = path + suffix
+                variant_size = sibling.st_size
+                # The copy is tagged by its own contents, as it may change
+                # on its own
+                variant_etag = get_etag(variant_path, sibling, hashes, wait)
+                if keep_body:
+                    with open(variant_path, "rb") as f:
+                        variant_body = f.read()
+            elif body is not None:
+                variant_body = compress(body, encoding)
+                if variant_body is None or len(variant_body) >= len(body):
+                    continue
+                variant_size = len(variant_body)
+                variant_etag = f"{etag}-{encoding}"
+            else:
+                continue
+            variants[encoding] = StaticFile(
+                variant_path,
+                variant_size,
+                None,
+                dict(fields, **{
+                    "Content-Length": variant_size,
+                    "Content-Encoding": encoding,
+                    "ETag": f'"{variant_etag}"'
+                }),
+                last_modified,
+                variant_body,
+                {}
+            )
+    return StaticFile(
+        path,
+        stat.st_size,
+        get_version(stat, siblings),
+        fields,
+        last_modified,
+        body,
+        variants
+    )
+
+
+def find_file(root, requested_file, hashes=None):
+    """Looks up a file on disk, without using an index.
+
+    Files are never hashed here: a file whose digest is not known (see
+    `etags.HashIndex.hash_all`) is tagged by its size and modification time,
+    a tag which stays the same until the file changes.
+
+    Args:
+        root: Directory holding the files
+        requested_file: Requested path, e.g. "/styles/main.css"
+        hashes: etags.HashIndex for the ETags of files, if any
+
+    Returns:
+        StaticFile, or None if there is no such file
+    """
+    path = get_path(root, requested_file)
+    if path is None:
+        return None
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if not os.path.isfile(path):
+        return None
+    siblings = {}
+    for encoding, suffix in ENCODINGS.items():
+        try:
+            siblings[encoding] = os.stat(path + suffix)
+        except OSError:
+            pass
+    try:
+        return load_file(path, stat, siblings, hashes=hashes)
+    except OSError:
+        return None
+
+
+class FileIndex:
+    """Index of every file under a directory, refreshed in the background.
+
+    Files up to max_file_size bytes are kept in memory, along with their
+    compressed variants, as long as they fit in max_size bytes in total.
+    Larger files are sent from disk. Files are hashed for their ETags as they
+    are indexed, so only ever on the thread refreshing the index (or on
+    startup).
+
+    Attributes:
+        root: Directory holding the files
+        max_size: Memory budget (in bytes) for the contents of files
+        max_file_size: Largest file (in bytes) kept in memory
+        size: Bytes of file contents currently kept in memory
+        hashes: etags.HashIndex of the files' contents
+    """
+
+    def __init__(self, root, max_size=DEFAULT_MEMORY_SIZE,
+                 max_file_size=DEFAULT_MAX_FILE_SIZE):
+        """
+        Args:
+            root: Directory holding the files
+            max_size: Memory budget (in bytes) for the contents of files
+            max_file_size: Largest file (in bytes) kept in memory
+        """
+        self.root = root
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.size = 0
+        self.hashes = etags.HashIndex()
+        self._files = {}
+        self.refresh()
+
+    def get(self, requested_file):
+        """Looks up a file.
+
+        Args:
+            requested_file: Requested path, e.g. "/styles/main.css"
+
+        Returns:
+            StaticFile, or None if there is no such file
+        """
+        return self._files.get(requested_file)
+
+    def refresh(self):
+        """Picks up files that were added, changed or removed.
+
+        Returns:
+            None
+        """
+        stats = {}
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    stats[path] = os.stat(path)
+                except OSError:
+                    # Removed since it was listed
+                    continue
+
+        files = {}
+        size = 0
+        for path, stat in stats.items():
+            key = "/" + os.path.relpath(path, self.root).replace(os.sep, "/")
+            siblings = {
+                encoding: stats[path + suffix]
+                for encoding, suffix in ENCODINGS.items()
+                if path + suffix in stats
+            }
+            old = self._files.get(key)
+            try:
+                if (old is not None
+                        and old.version == get_version(stat, siblings)):
+                    static_file = old
+                else:
+                    keep_body = (
+                        stat.st_size <= self.max_file_size
+                        and size + stat.st_size <= self.max_size
+                    )
+                    static_file = load_file(
+                        path, stat, siblings, keep_body, self.hashes, True)
+                if size + get_memory_size(static_file) > self.max_size:
+                    static_file = load_file(
+                        path, stat, siblings, hashes=self.hashes, wait=True)
+            except OSError:
+                # Removed (or unreadable) since it was listed
+                continue
+            size += get_memory_size(static_file)
+            files[key] = static_file
+        # Replace the index rather than changing it, so that readers never
+        # see it half updated
+        self._files = files
+        self.size = size
+        self.hashes.retain(stats)
+
+    def run(self, interval):
+        """Refreshes the index forever.
+
+        Args:
+            interval: Seconds between refreshes
+
+        Returns:
+            None
+        """
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+    def start(self, interval=POLL_INTERVAL):
+        """Keeps refreshing the index on a background thread.
+
+        Args:
+            interval: Seconds between refreshes
+
+        Returns:
+            None
+        """
+        threading.Thread(target=self.run, args=(interval,), daemon=True
+                         ).start()